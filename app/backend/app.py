@@ -4,19 +4,28 @@ from pathlib import Path
 
 from aiohttp import web
 from azure.core.credentials import AzureKeyCredential
-from azure.identity import AzureDeveloperCliCredential, DefaultAzureCredential
 from dotenv import load_dotenv
 
+from metrics import metrics_registry
+from order_state import order_state_singleton
+from readiness import readiness_probe
+from session_store import InMemorySessionStore, RedisSessionStore
+from structured_logging import configure_logging, parse_sample_rates
 from tools import attach_tools_rtmt
-from rtmt import RTMiddleTier
-from azurespeech import AzureSpeech
+from rtmt import RelayOverflowPolicy, RTMiddleTier
+from token_cache import TokenCache
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("voicerag")
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Log records are formatted and written by a background thread, never on the event loop
+configure_logging(level=os.environ.get("LOG_LEVEL") or "INFO",
+                  json_format=os.environ.get("LOG_FORMAT") == "json",
+                  sample_rates=parse_sample_rates(os.environ.get("LOG_SAMPLE_RATES") or ""),
+                  skip_caller=os.environ.get("LOG_SKIP_CALLER") == "true")
+
 # Create the web application
 async def create_app():
     if not os.environ.get("RUNNING_IN_PRODUCTION"):
@@ -30,16 +39,22 @@ async def create_app():
 
     credential = None
     if not llm_key or not search_key:
+        # Only needed without API keys, and slow to import
+        from azure.identity import AzureDeveloperCliCredential, DefaultAzureCredential
         if tenant_id := os.environ.get("AZURE_TENANT_ID"):
             logger.info("Using AzureDeveloperCliCredential with tenant_id %s", tenant_id)
             credential = AzureDeveloperCliCredential(tenant_id=tenant_id, process_timeout=60)
         else:
             logger.info("Using DefaultAzureCredential")
             credential = DefaultAzureCredential()
+        # Share one background-refreshed token cache between the realtime middle tier and search
+        credential = TokenCache(credential)
     llm_credential = AzureKeyCredential(llm_key) if llm_key else credential
     search_credential = AzureKeyCredential(search_key) if search_key else credential
     
     app = web.Application()
+    if credential is not None:
+        credential.attach_to_app(app)
 
     rtmt = RTMiddleTier(
         credentials=llm_credential,
@@ -48,6 +63,30 @@ async def create_app():
         voice_choice=os.environ.get("AZURE_OPENAI_REALTIME_VOICE_CHOICE") or "alloy"
     )
     rtmt.temperature = 0.6
+    rtmt.warm_pool_size = int(os.environ.get("AZURE_OPENAI_REALTIME_WARM_POOL_SIZE") or 0)
+    rtmt.upstream_connection_limit = int(os.environ.get("AZURE_OPENAI_REALTIME_MAX_CONNECTIONS") or 1000)
+    # Frames buffered per connection while a socket is slow to take them, and what to do about clients that fall behind
+    rtmt.server_queue_bytes = int(os.environ.get("AZURE_OPENAI_REALTIME_SERVER_QUEUE_KB") or 1024) * 1024
+    rtmt.client_queue_bytes = int(os.environ.get("AZURE_OPENAI_REALTIME_CLIENT_QUEUE_KB") or 2048) * 1024
+    rtmt.slow_client_policy = RelayOverflowPolicy(os.environ.get("AZURE_OPENAI_REALTIME_SLOW_CLIENT_POLICY") or "coalesce")
+    # Merge small input_audio_buffer.append frames from clients into fewer, larger upstream frames
+    rtmt.audio_coalesce_bytes = int(os.environ.get("AZURE_OPENAI_REALTIME_AUDIO_COALESCE_KB") or 0) * 1024
+    rtmt.audio_coalesce_window = float(os.environ.get("AZURE_OPENAI_REALTIME_AUDIO_COALESCE_MS") or 20) / 1000
+    # Keep long silences, e.g. while customers read the menu, from being sent upstream
+    rtmt.vad_enabled = os.environ.get("AZURE_OPENAI_REALTIME_VAD_ENABLED") == "true"
+    rtmt.vad_pre_roll = float(os.environ.get("AZURE_OPENAI_REALTIME_VAD_PRE_ROLL_MS") or 300) / 1000
+    rtmt.vad_hangover = float(os.environ.get("AZURE_OPENAI_REALTIME_VAD_HANGOVER_MS") or 1000) / 1000
+    rtmt.vad_margin_db = float(os.environ.get("AZURE_OPENAI_REALTIME_VAD_MARGIN_DB") or 10)
+    if rtmt.vad_enabled:
+        # The gate classifies audio with numpy, fail at startup rather than on every connection's first audio frame
+        import numpy  # noqa: F401
+    # How long a stopping worker waits for live conversations to finish their turn before handing them to another worker
+    rtmt.drain_timeout = float(os.environ.get("AZURE_OPENAI_REALTIME_DRAIN_TIMEOUT") or 20)
+    # More realtime deployments to balance clients across and fail over to, as endpoint|deployment|weight|api_key
+    for upstream in (os.environ.get("AZURE_OPENAI_REALTIME_ENDPOINTS") or "").split(","):
+        if upstream.strip():
+            endpoint, deployment, weight, key = (upstream.strip().split("|") + [""] * 3)[:4]
+            rtmt.add_upstream(endpoint, deployment or None, float(weight or 1), key or None)
     rtmt.system_message = (
         "You are a virtual barista assistant for a café, dedicated to providing an exceptional customer experience. "
         "Your role is to assist customers in ordering beverages from the café menu and managing their orders with accuracy, clarity, and friendliness. "
@@ -71,7 +110,7 @@ async def create_app():
         "4. Where appropriate, ask the customer if they would like to add whipped cream ($0.50), a flavor shot ($0.75), or an extra shot of espresso ($1.00) as separate items to their order. Ensure these are added as individual line items with their respective costs in the itemized order. "
     )
 
-    attach_tools_rtmt(rtmt,
+    indexer_watcher = attach_tools_rtmt(rtmt,
         credentials=search_credential,
         search_endpoint=os.environ.get("AZURE_SEARCH_ENDPOINT"),
         search_index=os.environ.get("AZURE_SEARCH_INDEX"),
@@ -80,13 +119,61 @@ async def create_app():
         content_field=os.environ.get("AZURE_SEARCH_CONTENT_FIELD") or "chunk",
         embedding_field=os.environ.get("AZURE_SEARCH_EMBEDDING_FIELD") or "text_vector",
         title_field=os.environ.get("AZURE_SEARCH_TITLE_FIELD") or "title",
-        use_vector_query=(os.environ.get("AZURE_SEARCH_USE_VECTOR_QUERY") == "true") or True
+        use_vector_query=(os.environ.get("AZURE_SEARCH_USE_VECTOR_QUERY") == "true") or True,
+        search_backend=os.environ.get("SEARCH_BACKEND") or "azure",
+        menu_path=os.environ.get("LOCAL_SEARCH_MENU_PATH"),
+        menu_embeddings_path=os.environ.get("LOCAL_SEARCH_EMBEDDINGS_PATH"),
+        search_cache_size=int(os.environ.get("AZURE_SEARCH_CACHE_SIZE") or 256),
+        search_cache_ttl=float(os.environ.get("AZURE_SEARCH_CACHE_TTL") or 300),
+        default_projection=os.environ.get("SEARCH_RESULT_FIELDS") or "full",
+        search_indexer=os.environ.get("AZURE_SEARCH_INDEXER") or os.environ.get("AZURE_SEARCH_INDEX"),
+        search_indexer_poll=float(os.environ.get("AZURE_SEARCH_CACHE_INDEXER_POLL") or 60)
     )
+    # Every worker clears its search cache when the indexer finishes a reindex
+    if indexer_watcher is not None:
+        indexer_watcher.attach_to_app(app)
+
+    # Keep order sessions in Redis when running several workers or nodes, so any of them can serve a session
+    session_idle_ttl = float(os.environ.get("ORDER_SESSION_IDLE_TTL") or 1800)
+    if os.environ.get("ORDER_SESSION_STORE") == "redis":
+        order_state_singleton.use_store(RedisSessionStore.from_url(os.environ.get("REDIS_URL") or "redis://localhost:6379/0", idle_ttl=session_idle_ttl))
+        if not os.environ.get("ORDER_SESSION_RESUME_SECRET"):
+            logger.warning("ORDER_SESSION_RESUME_SECRET is not set, so resume tokens only verify in this process. "
+                           "Set it to the same value on every worker and replica sharing the Redis store")
+    else:
+        order_state_singleton.use_store(InMemorySessionStore(idle_ttl=session_idle_ttl))
+        if int(os.environ.get("WEB_WORKERS") or 1) > 1:
+            logger.warning("Order sessions are kept in each worker's memory, a client that reconnects to another worker "
+                           "starts a new order. Set ORDER_SESSION_STORE=redis when running several workers")
+    # A disconnected client can resume its order with the token it was given for this many seconds
+    order_state_singleton.close_grace = float(os.environ.get("ORDER_SESSION_CLOSE_GRACE") or 120)
+    if resume_secret := os.environ.get("ORDER_SESSION_RESUME_SECRET"):
+        order_state_singleton.resume_secret = resume_secret.encode()
+    order_state_singleton.attach_to_app(app)
 
     rtmt.attach_to_app(app, "/realtime")
 
-    # azurespeech = AzureSpeech(system_message=rtmt.system_message)
-    # azurespeech.attach_to_app(app, "/azurespeech")
+    # The speech-to-text, chat and text-to-speech endpoints run off the event loop, so they can share the process with /realtime
+    if os.environ.get("AZURE_SPEECH_ENABLED") == "true":
+        # The Speech and OpenAI SDKs take most of the backend's import time, so they are only loaded when used
+        from azurespeech import AzureSpeech
+        from tts_cache import TTSCache
+        # Repeated assistant phrases are served from this cache instead of being synthesized again
+        tts_cache = None
+        tts_cache_mb = float(os.environ.get("AZURE_SPEECH_TTS_CACHE_MB") or 64)
+        if tts_cache_mb > 0:
+            tts_cache = TTSCache(max_bytes=int(tts_cache_mb * 1024 * 1024), persist_dir=os.environ.get("AZURE_SPEECH_TTS_CACHE_DIR") or None)
+        azurespeech = AzureSpeech(system_message=rtmt.system_message,
+                                  max_workers=int(os.environ.get("AZURE_SPEECH_MAX_WORKERS") or 4),
+                                  max_pending=int(os.environ.get("AZURE_SPEECH_MAX_PENDING") or 16),
+                                  tts_cache=tts_cache)
+        azurespeech.attach_to_app(app, "/azurespeech")
+
+    # Latency histograms and relay counters in the Prometheus text format
+    if os.environ.get("METRICS_ENABLED") != "false":
+        metrics_registry.attach_to_app(app, os.environ.get("METRICS_PATH") or "/metrics")
+    # Answers 503 until the background warm-up (first bearer tokens, search client) is done, for the load balancer
+    readiness_probe.attach_to_app(app, os.environ.get("READINESS_PATH") or "/ready")
 
     current_directory = Path(__file__).parent
     app.add_routes([web.get('/', lambda _: web.FileResponse(current_directory / 'static/index.html'))])
@@ -98,4 +185,4 @@ async def create_app():
 if __name__ == "__main__":
     host = os.environ.get("HOST", "localhost")  # Change default host to localhost
     port = int(os.environ.get("PORT", 8000))  # Change default port to 8000
-    web.run_app(create_app(), host=host, port=port)
+    web.run_app(create_app(), host=host, port=port, shutdown_timeout=float(os.environ.get("WEB_GRACEFUL_TIMEOUT") or 30))
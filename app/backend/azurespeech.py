@@ -1,21 +1,163 @@
+import asyncio
+import base64
+import importlib
 import os
 import logging
+import re
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Optional
 from aiohttp import web
-from azure.cognitiveservices.speech import SpeechConfig, SpeechRecognizer, SpeechSynthesizer, AudioConfig, SpeechConfig, ResultReason
-from azure.cognitiveservices.speech.audio import AudioConfig
-from openai import AzureOpenAI
 from dotenv import load_dotenv
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+from metrics import metrics_registry
+from readiness import readiness_probe
+from tts_cache import Audio, TTSCache
+
+if TYPE_CHECKING:
+    import azure.cognitiveservices.speech as speechsdk
+    from openai import AsyncAzureOpenAI
+else:
+    # Imported by _load_sdks
+    speechsdk = AsyncAzureOpenAI = None
+
+logger = logging.getLogger("coffee-chat")
 
 # Load environment variables
 load_dotenv()
 
+_in_flight = metrics_registry.gauge("azurespeech_stage_in_flight", "Speech SDK calls running or queued on the speech worker pool")
+_rejected = metrics_registry.counter("azurespeech_rejected_total", "Requests turned away because the speech worker pool was saturated")
+
+# Largest WAV header accepted before the sample data, metadata chunks included
+_MAX_WAV_HEADER = 64 * 1024
+
+_sdk_lock = threading.Lock()
+
+def _load_sdks():
+    # The Speech and OpenAI SDKs take most of the backend's import time, so they are imported when
+    # AzureSpeech first needs them rather than along with this module
+    global speechsdk, AsyncAzureOpenAI
+    with _sdk_lock:
+        if speechsdk is None:
+            AsyncAzureOpenAI = importlib.import_module("openai").AsyncAzureOpenAI
+            importlib.import_module("azure.cognitiveservices.speech.audio")
+            speechsdk = importlib.import_module("azure.cognitiveservices.speech")
+
+def _stage_seconds(stage: str):
+    return metrics_registry.histogram("azurespeech_stage_seconds", "Latency of each stage of the speech-to-text, chat and text-to-speech pipeline", {"stage": stage})
+
+def _time_to_stage(stage: str):
+    return metrics_registry.histogram("azurespeech_stream_time_to_stage_seconds", "Time from a streaming request until each stage produced its first output", {"stage": stage})
+
+# A sentence ends at ., ! or ? (plus any closing quotes or brackets) followed by whitespace, or at a line break.
+# Requiring the whitespace keeps prices like $0.50 in one piece.
+_SENTENCE_END = re.compile(r"""[.!?]+["')\]]*\s+|\n+""")
+
+# A whole sentence in single quotes, e.g. respond with, 'I'm sorry, ...' in the system prompt
+_QUOTED_SENTENCE = re.compile(r"'([A-Z](?:[^']|'(?=[a-z]))*[.!?])'")
+
+# Things the assistant says word for word often enough to be worth synthesizing ahead of the first customer
+STOCK_PHRASES = [
+    "Hi there! Welcome to the coffee shop. What can I get for you today?",
+    "Would you like to add whipped cream for $0.50, a flavor shot for $0.75, or an extra shot of espresso for $1.00?",
+    "Is there anything else I can get for you?",
+    "Sure, I've added that to your order.",
+    "Thank you for your order! Have a great day.",
+]
+
+def stock_phrases(system_message: str) -> list[str]:
+    """
+    The stock phrases plus any sentence the system prompt tells the model to say verbatim.
+    """
+    phrases = list(STOCK_PHRASES)
+    for quoted in _QUOTED_SENTENCE.findall(system_message or ""):
+        if quoted not in phrases:
+            phrases.append(quoted)
+    return phrases
+
+def parse_wav_header(data: bytes) -> Optional[tuple["speechsdk.audio.AudioStreamFormat", int]]:
+    """
+    Return the stream format of an upload and the offset its sample data starts at, or None if
+    data doesn't hold the whole header yet. Anything that isn't a RIFF/WAVE file is taken to be
+    raw 16 kHz 16-bit mono PCM, the Speech SDK's default.
+    """
+    if len(data) < 12:
+        return None
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return speechsdk.audio.AudioStreamFormat(), 0
+    stream_format = None
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id, chunk_size = struct.unpack_from("<4sI", data, offset)
+        if chunk_id == b"data":
+            if stream_format is None:
+                raise ValueError("WAV data chunk before its fmt chunk")
+            return stream_format, offset + 8
+        if chunk_id == b"fmt ":
+            if offset + 8 + 16 > len(data):
+                return None
+            _, channels, sample_rate, _, _, bits_per_sample = struct.unpack_from("<HHIIHH", data, offset + 8)
+            stream_format = speechsdk.audio.AudioStreamFormat(samples_per_second=sample_rate, bits_per_sample=bits_per_sample, channels=channels)
+        # Chunks are padded to an even length
+        offset += 8 + chunk_size + (chunk_size & 1)
+    if len(data) > _MAX_WAV_HEADER:
+        raise ValueError("WAV header too large")
+    return None
+
+class SentenceSplitter:
+    """
+    Cuts a stream of completion tokens into sentences as soon as each one is complete.
+    """
+    def __init__(self, min_length: int = 12):
+        # Shorter fragments ("Sure." "Hi!") are held and sent with the next sentence
+        self.min_length = min_length
+        self._buffer = ""
+
+    def feed(self, text: str) -> list[str]:
+        self._buffer += text
+        sentences = []
+        start = 0
+        for match in _SENTENCE_END.finditer(self._buffer):
+            sentence = self._buffer[start:match.end()].strip()
+            if len(sentence) >= self.min_length:
+                sentences.append(sentence)
+                start = match.end()
+        self._buffer = self._buffer[start:]
+        return sentences
+
+    def flush(self) -> Optional[str]:
+        sentence, self._buffer = self._buffer.strip(), ""
+        return sentence or None
+
 class AzureSpeech:
-    def __init__(self, system_message):
+    """
+    Speech-to-text, chat completion and text-to-speech endpoints that share the process with /realtime.
+
+    The Speech SDK only offers blocking calls, so they run on a small dedicated thread pool and the
+    chat completion uses the async OpenAI client; the event loop never waits on either. When the
+    pool already has max_pending calls running or queued, new requests get a 503 with Retry-After
+    instead of piling up behind it.
+
+    Synthesized phrases go through tts_cache when one is given, so repeated utterances skip the
+    Speech service and the pool altogether. The prewarm phrases are synthesized in the background
+    at startup, one at a time so live requests keep the rest of the pool.
+
+    The SDKs are imported and the clients built on a worker thread once the app has started (warm),
+    the readiness probe waits for it.
+    """
+    def __init__(self, system_message, max_workers: int = 4, max_pending: int = 16,
+                 tts_cache: Optional[TTSCache] = None, prewarm: Optional[list[str]] = None):
         self.system_message = system_message
-        
+        self.max_pending = max_pending
+        self.tts_cache = tts_cache
+        self.prewarm = stock_phrases(system_message) if prewarm is None else prewarm
+        self._prewarm_task: Optional[asyncio.Task] = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="azurespeech")
+        self._pending = 0
+
         # Azure OpenAI Variables
         self.aoai_eastus_endpoint = os.getenv("AZURE_OPENAI_EASTUS_ENDPOINT")
         self.aoai_eastus_api_key = os.getenv("AZURE_OPENAI_EASTUS_API_KEY")
@@ -25,108 +167,352 @@ class AzureSpeech:
         # Azure Speech Service Variables
         self.speech_key = os.getenv("AZURE_SPEECH_KEY")
         self.speech_region = os.getenv("AZURE_SPEECH_REGION")
-        self.speech_config = SpeechConfig(subscription=self.speech_key, region=self.speech_region)
-        self.speech_config.speech_synthesis_voice_name = "en-US-AvaMultilingualNeural"
+        self.voice_name = "en-US-AvaMultilingualNeural"
+
+        # Speech config and Azure OpenAI client, built by load()
+        self._speech_config: Optional[speechsdk.SpeechConfig] = None
+        self._aoai_client: Optional[AsyncAzureOpenAI] = None
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        """
+        Import the SDKs and build the clients, blocking; warm() does it off the event loop.
+        """
+        with self._load_lock:
+            if self._aoai_client is not None:
+                return
+            _load_sdks()
+            speech_config = speechsdk.SpeechConfig(subscription=self.speech_key, region=self.speech_region)
+            speech_config.speech_synthesis_voice_name = self.voice_name
+            self._speech_config = speech_config
+            self._aoai_client = AsyncAzureOpenAI(
+                azure_endpoint=self.aoai_eastus_endpoint,
+                api_version=self.aoai_openai_api_version,
+                api_key=self.aoai_eastus_api_key,
+            )
+
+    async def warm(self):
+        if self._aoai_client is None:
+            await asyncio.to_thread(self.load)
+
+    @property
+    def speech_config(self) -> "speechsdk.SpeechConfig":
+        if self._speech_config is None:
+            self.load()
+        return self._speech_config
+
+    @property
+    def aoai_client(self) -> "AsyncAzureOpenAI":
+        if self._aoai_client is None:
+            self.load()
+        return self._aoai_client
+
+    async def _run_blocking(self, stage: str, func: Callable[..., Any], *args) -> Any:
+        """
+        Run a blocking Speech SDK call on the worker pool, or fail fast with a 503 when the pool is saturated.
+        """
+        if self._pending >= self.max_pending:
+            _rejected.inc()
+            logger.warning("Speech worker pool saturated, rejecting %s request.", stage)
+            raise web.HTTPServiceUnavailable(reason="Speech service busy, please retry.", headers={"Retry-After": "1"})
+        self._pending += 1
+        _in_flight.inc()
+        start = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            _stage_seconds(stage).observe(time.monotonic() - start)
+            self._pending -= 1
+            _in_flight.dec()
+
+    def _recognize(self, push_stream: "speechsdk.audio.PushAudioInputStream"):
+        audio_config = speechsdk.audio.AudioConfig(stream=push_stream)
+        speech_recognizer = speechsdk.SpeechRecognizer(speech_config=self.speech_config, audio_config=audio_config)
+        return speech_recognizer.recognize_once()
+
+    def _recognize_bytes(self, audio: bytes):
+        parsed = parse_wav_header(audio)
+        if parsed is None:
+            raise ValueError("Truncated WAV audio")
+        stream_format, offset = parsed
+        push_stream = speechsdk.audio.PushAudioInputStream(stream_format=stream_format)
+        push_stream.write(audio[offset:])
+        push_stream.close()
+        return self._recognize(push_stream)
+
+    def _synthesize(self, text: str):
+        synthesizer = speechsdk.SpeechSynthesizer(speech_config=self.speech_config, audio_config=None)
+        return synthesizer.speak_text_async(text).get()
 
-        # Azure OpenAI Client
-        self.aoai_client = AzureOpenAI(
-            azure_endpoint=self.aoai_eastus_endpoint,
-            api_version=self.aoai_openai_api_version,
-            api_key=self.aoai_eastus_api_key,
-        )
+    def _synthesize_and_cache(self, text: str) -> Audio:
+        start = time.monotonic()
+        result = self._synthesize(text)
+        if self.tts_cache is None or result.reason != speechsdk.ResultReason.SynthesizingAudioCompleted:
+            return result.audio_data
+        return self.tts_cache.put(self.voice_name, text, result.audio_data, time.monotonic() - start)
+
+    async def _speak(self, text: str) -> Audio:
+        """
+        Audio for text, from the phrase cache when it has been synthesized before.
+        """
+        if self.tts_cache is not None:
+            audio = self.tts_cache.get(self.voice_name, text)
+            if audio is not None:
+                return audio
+        return await self._run_blocking("tts", self._synthesize_and_cache, text)
+
+    async def _prewarm_phrases(self):
+        await self.warm()
+        voice = self.voice_name
+        warmed = 0
+        for phrase in self.prewarm:
+            if (voice, phrase) in self.tts_cache:
+                continue
+            try:
+                await self._run_blocking("tts", self._synthesize_and_cache, phrase)
+                warmed += 1
+            except Exception as e:
+                logger.warning("Pre-warming the phrase cache failed: %s", e)
+                return
+        logger.info("Pre-warmed %d of %d stock phrases.", warmed, len(self.prewarm))
 
     async def speech_to_text(self, request):
         """Convert audio to text using Azure Speech-to-Text."""
+        await self.warm()
+        push_stream = None
         try:
-            logging.info("Received speech-to-text request.")
+            logger.info("Received speech-to-text request.")
             reader = await request.multipart()
             audio_part = await reader.next()
-            audio_file_path = "./uploaded_audio.wav"
-
-            # Save uploaded audio
-            with open(audio_file_path, "wb") as audio_file:
-                while True:
-                    chunk = await audio_part.read_chunk()
-                    if not chunk:
-                        break
-                    audio_file.write(chunk)
-
-            # Log file details
-            if not os.path.exists(audio_file_path):
-                logging.error("Uploaded audio file is missing.")
-            else:
-                file_size = os.path.getsize(audio_file_path)
-                logging.info(f"Uploaded audio file size: {file_size} bytes")
-
-            # Validate file size
-            if file_size == 0:
-                logging.error("Uploaded audio file is empty.")
+            if audio_part is None:
                 raise web.HTTPBadRequest(reason="Empty audio file.")
 
+            # Upload chunks go straight into the recognizer's push stream while it is already listening,
+            # once enough has arrived to read the WAV header
+            header = b""
+            recognition = None
+            audio_size = 0
+            while chunk := await audio_part.read_chunk():
+                if push_stream is None:
+                    header += chunk
+                    try:
+                        parsed = parse_wav_header(header)
+                    except ValueError as e:
+                        raise web.HTTPBadRequest(reason=f"Invalid audio file: {e}.")
+                    if parsed is None:
+                        continue
+                    stream_format, offset = parsed
+                    push_stream = speechsdk.audio.PushAudioInputStream(stream_format=stream_format)
+                    logger.info("Starting speech recognition.")
+                    recognition = asyncio.ensure_future(self._run_blocking("stt", self._recognize, push_stream))
+                    chunk = header[offset:]
+                if recognition.done():
+                    # Rejected by backpressure or failed, stop reading the upload
+                    break
+                push_stream.write(chunk)
+                audio_size += len(chunk)
 
-            # Verify file existence and size
-            if not os.path.exists(audio_file_path) or os.path.getsize(audio_file_path) == 0:
-                logging.error("Uploaded audio file is empty or missing.")
-                raise web.HTTPBadRequest(reason="Invalid audio file.")
-
-            # Speech-to-text conversion
-            logging.info("Starting speech recognition.")
-            audio_config = AudioConfig(filename=audio_file_path)
-            speech_recognizer = SpeechRecognizer(speech_config=self.speech_config, audio_config=audio_config)
-            result = speech_recognizer.recognize_once()
+            if push_stream is None:
+                logger.error("Uploaded audio file is empty or missing.")
+                raise web.HTTPBadRequest(reason="Empty audio file." if not header else "Invalid audio file.")
+            push_stream.close()
+            logger.info("Uploaded audio size: %d bytes", audio_size)
+            result = await recognition
+            if audio_size == 0:
+                raise web.HTTPBadRequest(reason="Empty audio file.")
 
-            if result.reason == ResultReason.RecognizedSpeech:
-                logging.info(f"Speech recognized: {result.text}")
+            if result.reason == speechsdk.ResultReason.RecognizedSpeech:
+                logger.info("Speech recognized: %s", result.text)
                 return web.json_response({"transcription": result.text})
-            elif result.reason == ResultReason.NoMatch:
-                logging.warning("No speech could be recognized.")
+            elif result.reason == speechsdk.ResultReason.NoMatch:
+                logger.warning("No speech could be recognized.")
                 return web.json_response({"error": "No speech could be recognized."})
             else:
-                logging.error(f"Speech recognition canceled: {result.cancellation_details.error_details}")
+                logger.error("Speech recognition canceled: %s", result.cancellation_details.error_details)
                 raise web.HTTPInternalServerError(reason="Speech recognition canceled.")
+        except web.HTTPException:
+            raise
         except Exception as e:
-            logging.error(f"Speech-to-text processing failed: {e}")
+            logger.error("Speech-to-text processing failed: %s", e)
             raise web.HTTPInternalServerError(reason="Internal server error.")
+        finally:
+            # Never leave a recognizer thread waiting on audio that won't come, e.g. when the upload was cut off
+            if push_stream is not None:
+                push_stream.close()
 
 
     async def generate_response(self, request):
         """Generate AI response using Azure OpenAI GPT."""
+        await self.warm()
         try:
             data = await request.json()
             prompt = data.get("content", "")
 
-            response = self.aoai_client.chat.completions.create(
-                model=self.aoai_gpt4o_mini_deployment,
-                messages=[
-                    {"role": "system", "content": self.system_message},
-                    {"role": "user", "content": prompt},
-                ],
-                temperature=0.6,
-            )
+            start = time.monotonic()
+            try:
+                response = await self.aoai_client.chat.completions.create(
+                    model=self.aoai_gpt4o_mini_deployment,
+                    messages=[
+                        {"role": "system", "content": self.system_message},
+                        {"role": "user", "content": prompt},
+                    ],
+                    temperature=0.6,
+                )
+            finally:
+                _stage_seconds("llm").observe(time.monotonic() - start)
             return web.json_response({"response": response.choices[0].message.content})
         except Exception as e:
-            logging.error(f"Error generating AI response: {e}")
+            logger.error("Error generating AI response: %s", e)
             return web.json_response({"error": "Internal server error."}, status=500)
 
     async def text_to_speech(self, request):
         """Convert text to speech using Azure TTS."""
+        await self.warm()
         try:
             data = await request.json()
             text = data.get("content", "")
 
-            synthesizer = SpeechSynthesizer(speech_config=self.speech_config, audio_config=None)
-            result = synthesizer.speak_text_async(text).get()
+            audio = await self._speak(text)
 
-            audio_file_path = "./response_audio.wav"
-            with open(audio_file_path, "wb") as audio_file:
-                audio_file.write(result.audio_data)
-            return web.json_response({"audio_url": "/static/response_audio.wav"})
+            # Clients that ask for audio get it in the response body, others get it inline as a data URL. Both
+            # work whichever worker or replica serves the request, a URL to fetch later would only work on this one
+            if "audio/" in request.headers.get("Accept", ""):
+                return web.Response(body=audio, content_type="audio/wav")
+            return web.json_response({"audio_url": f"data:audio/wav;base64,{base64.b64encode(audio).decode()}"})
+        except web.HTTPException:
+            raise
         except Exception as e:
-            logging.error(f"Text-to-speech failed: {e}")
+            logger.error("Text-to-speech failed: %s", e)
             return web.json_response({"error": "Internal server error."}, status=500)
 
+    async def stream(self, request):
+        """
+        Streaming pipeline over a websocket. Each request message is {"type": "text", "content": ...} or
+        {"type": "audio", "audio": <base64 WAV>}. The chat completion is streamed and cut into sentences,
+        and every sentence is synthesized as soon as it is complete while the model keeps generating. Audio
+        goes back one {"type": "audio"} message per sentence, in order, followed by {"type": "done"} with
+        the time each stage took to produce its first output.
+        """
+        await self.warm()
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for msg in ws:
+            if msg.type != web.WSMsgType.TEXT:
+                continue
+            try:
+                await self._stream_reply(ws, msg.json())
+            except web.HTTPServiceUnavailable:
+                await ws.send_json({"type": "error", "error": "Speech service busy, please retry.", "retry_after": 1})
+            except Exception as e:
+                logger.error("Streaming speech pipeline failed: %s", e)
+                await ws.send_json({"type": "error", "error": "Internal server error."})
+        return ws
+
+    async def _stream_reply(self, ws: web.WebSocketResponse, message: dict):
+        start = time.monotonic()
+        timings: dict[str, float] = {}
+
+        def reached(stage: str):
+            if stage not in timings:
+                timings[stage] = time.monotonic() - start
+                _time_to_stage(stage).observe(timings[stage])
+
+        if message.get("type") == "audio":
+            result = await self._run_blocking("stt", self._recognize_bytes, base64.b64decode(message["audio"]))
+            if result.reason != speechsdk.ResultReason.RecognizedSpeech:
+                await ws.send_json({"type": "error", "error": "No speech could be recognized."})
+                return
+            prompt = result.text
+            reached("stt")
+            await ws.send_json({"type": "transcript", "text": prompt})
+        else:
+            prompt = message.get("content", "")
+
+        # Sentences are synthesized concurrently with the rest of the completion but sent in order;
+        # the bounded queue keeps a fast model from running far ahead of playback
+        synthesis: asyncio.Queue[Optional[tuple[str, asyncio.Task]]] = asyncio.Queue(maxsize=2)
+
+        failure: Optional[Exception] = None
+
+        async def send_audio():
+            nonlocal failure
+            index = 0
+            while (entry := await synthesis.get()) is not None:
+                sentence, task = entry
+                if failure is not None:
+                    # Keep draining so the completion loop never blocks on a full queue, but skip the rest of the reply
+                    task.cancel()
+                    continue
+                try:
+                    audio = await task
+                    reached("tts")
+                    await ws.send_json({"type": "audio", "index": index, "text": sentence,
+                                        "audio": base64.b64encode(audio).decode("ascii")})
+                except Exception as e:
+                    failure = e
+                index += 1
+
+        sender = asyncio.create_task(send_audio())
+        splitter = SentenceSplitter()
+        try:
+            llm_start = time.monotonic()
+            try:
+                completion = await self.aoai_client.chat.completions.create(
+                    model=self.aoai_gpt4o_mini_deployment,
+                    messages=[
+                        {"role": "system", "content": self.system_message},
+                        {"role": "user", "content": prompt},
+                    ],
+                    temperature=0.6,
+                    stream=True,
+                )
+                async for chunk in completion:
+                    if failure is not None:
+                        break
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    reached("llm")
+                    delta = chunk.choices[0].delta.content
+                    await ws.send_json({"type": "text.delta", "delta": delta})
+                    for sentence in splitter.feed(delta):
+                        reached("sentence")
+                        await synthesis.put((sentence, asyncio.create_task(self._speak(sentence))))
+            finally:
+                _stage_seconds("llm").observe(time.monotonic() - llm_start)
+            if (sentence := splitter.flush()) is not None:
+                reached("sentence")
+                await synthesis.put((sentence, asyncio.create_task(self._speak(sentence))))
+            await synthesis.put(None)
+            await sender
+            if failure is not None:
+                raise failure
+        finally:
+            if not sender.done():
+                sender.cancel()
+            while not synthesis.empty():
+                if (entry := synthesis.get_nowait()) is not None:
+                    entry[1].cancel()
+
+        timings["total"] = time.monotonic() - start
+        await ws.send_json({"type": "done", "time_to_first": {stage: round(seconds, 3) for stage, seconds in timings.items()}})
+
+    async def _on_startup(self, app):
+        if self.tts_cache is not None and self.prewarm:
+            self._prewarm_task = asyncio.create_task(self._prewarm_phrases())
+
+    async def _on_cleanup(self, app):
+        if self._prewarm_task is not None:
+            self._prewarm_task.cancel()
+        if self._aoai_client is not None:
+            await self._aoai_client.close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
     def attach_to_app(self, app, path_prefix="/azurespeech"):
         """Attach routes to aiohttp app."""
         app.router.add_post(f"{path_prefix}/speech-to-text", self.speech_to_text)
         app.router.add_post(f"{path_prefix}/text-to-speech", self.text_to_speech)
         app.router.add_post(f"{path_prefix}/generate-response", self.generate_response)
+        app.router.add_get(f"{path_prefix}/stream", self.stream)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        readiness_probe.warm_up("speech SDKs", self.warm)
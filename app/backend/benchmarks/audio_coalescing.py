@@ -0,0 +1,124 @@
+"""
+Latency and overhead of coalescing client input_audio_buffer.append frames.
+
+Streams coffeetest.wav (downsampled to the 24 kHz the realtime API takes) in
+real time through the middle tier to a local fake realtime server, the way a
+client does while the customer speaks. Two client framings are compared:
+one append per 128-sample render quantum, as the audio worklet produces them,
+and the 100ms appends useRealtime sends after useAudioRecorder's buffering.
+Each runs with coalescing off and with each --windows setting, reporting the
+upstream frame count and wire bytes per second of audio, and how much later
+the audio reached upstream than with coalescing off (mean and p99 per chunk).
+
+Usage (from app/backend):
+    python benchmarks/audio_coalescing.py [--seconds 3] [--windows 0,10,20,50] [--max-kb 16]
+"""
+import argparse
+import array
+import asyncio
+import base64
+import bisect
+import json
+import os
+import sys
+import time
+import wave
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+from azure.core.credentials import AzureKeyCredential  # noqa: E402
+from fake_realtime import FakeRealtimeServer  # noqa: E402
+
+from rtmt import RTMiddleTier  # noqa: E402
+
+WAV_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "..", "coffeetest.wav")
+SAMPLE_RATE = 24000
+FRAMINGS = {"render quantum": 128 * 2, "100ms buffer": 4800}
+
+
+def load_audio(path: str, seconds: float) -> bytes:
+    with wave.open(path, "rb") as wav:
+        assert wav.getnchannels() == 1 and wav.getsampwidth() == 2, "expects mono 16-bit PCM"
+        samples = array.array("h", wav.readframes(wav.getnframes()))
+        rate = wav.getframerate()
+    # Nearest-sample resampling is plenty for timing frames
+    step = rate / SAMPLE_RATE
+    resampled = array.array("h", (samples[int(i * step)] for i in range(int(len(samples) / step))))
+    return resampled.tobytes()[:int(seconds * SAMPLE_RATE) * 2]
+
+
+async def run(audio: bytes, chunk_bytes: int, coalesce_bytes: int, window: float) -> dict:
+    server = FakeRealtimeServer(tool_name=None, track_audio_arrivals=True)
+    await server.start()
+    rtmt = RTMiddleTier(endpoint=server.endpoint, deployment="fake", credentials=AzureKeyCredential("fake"))
+    rtmt.audio_coalesce_bytes = coalesce_bytes
+    rtmt.audio_coalesce_window = window
+    app = web.Application()
+    rtmt.attach_to_app(app, "/realtime")
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+
+    sent: list[tuple[float, int]] = []
+    try:
+        async with aiohttp.ClientSession() as http:
+            async with http.ws_connect(f"http://{host}:{port}/realtime") as ws:
+                await ws.receive()
+                start = time.monotonic()
+                for offset in range(0, len(audio), chunk_bytes):
+                    # Paced like a microphone: a chunk is sent once it has been recorded
+                    end = min(offset + chunk_bytes, len(audio))
+                    await asyncio.sleep(max(0.0, start + end / (2 * SAMPLE_RATE) - time.monotonic()))
+                    await ws.send_str(json.dumps({"type": "input_audio_buffer.append", "audio": base64.b64encode(audio[offset:end]).decode("ascii")}))
+                    sent.append((time.monotonic(), end))
+                await asyncio.sleep(window + 0.1)
+        await asyncio.sleep(0.05)
+    finally:
+        await runner.cleanup()
+        await server.stop()
+
+    arrival_times = [arrived for arrived, _ in server.audio_arrivals]
+    arrival_bytes = [received for _, received in server.audio_arrivals]
+    delays = []
+    for sent_at, end in sent:
+        index = bisect.bisect_left(arrival_bytes, end)
+        if index < len(arrival_times):
+            delays.append(arrival_times[index] - sent_at)
+    delays.sort()
+    seconds = len(audio) / (2 * SAMPLE_RATE)
+    wire_bytes = sum(len(json.dumps({"type": "input_audio_buffer.append", "audio": ""})) for _ in range(server.append_frames)) + len(audio) * 4 // 3
+    return {
+        "frames": server.append_frames / seconds,
+        "wire": wire_bytes / seconds,
+        "delay": sum(delays) / len(delays),
+        "p99": delays[int(len(delays) * 0.99) - 1],
+        "complete": arrival_bytes[-1] == len(audio) if arrival_bytes else False,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wav", default=WAV_PATH)
+    parser.add_argument("--seconds", type=float, default=3.0, help="seconds of the recording to stream per run")
+    parser.add_argument("--windows", default="0,10,20,50", help="coalescing windows to try, in milliseconds")
+    parser.add_argument("--max-kb", type=int, default=16, help="audio per merged upstream frame")
+    args = parser.parse_args()
+
+    audio = load_audio(args.wav, args.seconds)
+    print(f"{len(audio) / (2 * SAMPLE_RATE):.1f}s of {os.path.basename(args.wav)} at {SAMPLE_RATE} Hz, merged frames up to {args.max_kb} KiB")
+    for framing, chunk_bytes in FRAMINGS.items():
+        print(f"{framing} ({chunk_bytes} byte appends):")
+        baseline = await run(audio, chunk_bytes, 0, 0.0)
+        runs = [("off", baseline)] + [(f"{window}ms", await run(audio, chunk_bytes, args.max_kb * 1024, int(window) / 1000))
+                                      for window in args.windows.split(",")]
+        for label, result in runs:
+            print(f"  coalescing {label:<5}: {result['frames']:6.1f} upstream frames/s, {result['wire'] / 1024:5.1f} KiB/s on the wire, "
+                  f"audio upstream {(result['delay'] - baseline['delay']) * 1000:+6.1f}ms mean, {(result['p99'] - baseline['p99']) * 1000:+6.1f}ms p99 vs off"
+                  f"{'' if result['complete'] else ', AUDIO MISSING'}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
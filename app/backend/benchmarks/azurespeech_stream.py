@@ -0,0 +1,139 @@
+"""
+Time-to-first-audio of the /azurespeech pipeline, one shot versus streaming.
+
+By default runs AzureSpeech in process against simulated Azure OpenAI and
+Speech services with configurable latencies: the chat completion produces
+tokens at --token-interval after --first-token-latency, and synthesis takes
+--tts-base plus --tts-per-char per character. The one-shot path waits for the
+whole completion and synthesizes the whole reply, as the generate-response and
+text-to-speech endpoints do; the streaming path is the /stream websocket.
+
+With --url the streaming websocket of a running server is measured instead,
+e.g. --url ws://localhost:8000/azurespeech/stream (needs AZURE_SPEECH_ENABLED=true).
+
+--tts-cache puts the phrase cache in front of the simulated synthesis; every
+request after the first then finds the reply's sentences already cached.
+
+Usage (from app/backend):
+    python benchmarks/azurespeech_stream.py [--requests 5] [--tts-cache] [--url ws://...]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+REPLY = ("Sure! A large latte is $4.50. Would you like to add whipped cream for $0.50, a flavor shot for $0.75, "
+         "or an extra shot of espresso for $1.00? I have added the large latte to your order. Is there anything else I can get you today?")
+PROMPT = "Can I get a large latte please?"
+
+
+class SimulatedCompletions:
+    def __init__(self, first_token_latency: float, token_interval: float):
+        self.first_token_latency = first_token_latency
+        self.token_interval = token_interval
+
+    async def create(self, stream: bool = False, **kwargs):
+        tokens = [REPLY[i:i + 4] for i in range(0, len(REPLY), 4)]
+        if not stream:
+            await asyncio.sleep(self.first_token_latency + self.token_interval * len(tokens))
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=REPLY))])
+
+        async def chunks():
+            await asyncio.sleep(self.first_token_latency)
+            for token in tokens:
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+                await asyncio.sleep(self.token_interval)
+        return chunks()
+
+
+def simulated_speech(args):
+    from azure.cognitiveservices.speech import ResultReason
+
+    from azurespeech import AzureSpeech
+    from tts_cache import TTSCache
+
+    os.environ.setdefault("AZURE_SPEECH_KEY", "simulated")
+    os.environ.setdefault("AZURE_SPEECH_REGION", "eastus")
+    os.environ.setdefault("AZURE_OPENAI_EASTUS_ENDPOINT", "https://simulated.openai.azure.com")
+    os.environ.setdefault("AZURE_OPENAI_EASTUS_API_KEY", "simulated")
+    os.environ.setdefault("AZURE_OPENAI_API_VERSION", "2024-08-01-preview")
+    speech = AzureSpeech(system_message="You are a barista.", tts_cache=TTSCache() if args.tts_cache else None, prewarm=[])
+    speech.aoai_client.chat.completions = SimulatedCompletions(args.first_token_latency, args.token_interval)
+
+    def synthesize(text: str):
+        time.sleep(args.tts_base + args.tts_per_char * len(text))
+        return SimpleNamespace(reason=ResultReason.SynthesizingAudioCompleted, audio_data=b"\0" * 32 * len(text))
+    speech._synthesize = synthesize
+    return speech
+
+
+async def one_shot(http: aiohttp.ClientSession, base_url: str) -> float:
+    start = time.perf_counter()
+    async with http.post(f"{base_url}/generate-response", json={"content": PROMPT}) as response:
+        reply = (await response.json())["response"]
+    async with http.post(f"{base_url}/text-to-speech", json={"content": reply}) as response:
+        await response.read()
+    return time.perf_counter() - start
+
+
+async def streaming(http: aiohttp.ClientSession, ws_url: str) -> tuple[float, dict]:
+    async with http.ws_connect(ws_url) as ws:
+        start = time.perf_counter()
+        await ws.send_json({"type": "text", "content": PROMPT})
+        first_audio = None
+        while True:
+            event = await ws.receive_json()
+            if event["type"] == "audio" and first_audio is None:
+                first_audio = time.perf_counter() - start
+            elif event["type"] in ("done", "error"):
+                return first_audio, event
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5)
+    parser.add_argument("--url", help="streaming websocket of a running server, skips the simulation")
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--tts-base", type=float, default=0.15)
+    parser.add_argument("--tts-per-char", type=float, default=0.002)
+    parser.add_argument("--tts-cache", action="store_true", help="serve repeated sentences from the phrase cache")
+    args = parser.parse_args()
+
+    async with aiohttp.ClientSession() as http:
+        if args.url:
+            for _ in range(args.requests):
+                first_audio, done = await streaming(http, args.url)
+                print(f"streaming: first audio {first_audio * 1000:.0f}ms, stages {done.get('time_to_first')}")
+            return
+
+        speech = simulated_speech(args)
+        app = web.Application()
+        speech.attach_to_app(app, "/azurespeech")
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        host, port = runner.addresses[0][:2]
+        base_url = f"http://{host}:{port}/azurespeech"
+        try:
+            one_shot_times, streaming_times = [], []
+            for _ in range(args.requests):
+                one_shot_times.append(await one_shot(http, base_url))
+                first_audio, done = await streaming(http, f"{base_url}/stream")
+                streaming_times.append(first_audio)
+            print(f"one shot : first audio {sum(one_shot_times) / len(one_shot_times) * 1000:.0f}ms")
+            print(f"streaming: first audio {sum(streaming_times) / len(streaming_times) * 1000:.0f}ms, "
+                  f"stages of last request {done['time_to_first']}")
+        finally:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
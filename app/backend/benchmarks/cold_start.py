@@ -0,0 +1,116 @@
+"""
+How long a new backend process takes to start serving.
+
+First imports app in a fresh interpreter under -X importtime and breaks the
+import time down by top-level package. Then starts app.py --runs times, with
+the Azure AI Search backend and the Speech endpoints enabled against
+placeholder endpoints (nothing is contacted at startup), and measures from
+spawning the process until it answers HTTP at all (listening) and until
+/ready passes (warm). The warm-up itself, importing the search SDK and
+building its client on a worker thread, is also read back from /metrics.
+
+Uses API keys, so no bearer tokens are fetched; with managed identity their
+first fetch adds to the warm time, not the listening time.
+
+Usage (from app/backend):
+    python benchmarks/cold_start.py [--runs 5] [--top 10]
+"""
+import argparse
+import asyncio
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import aiohttp  # noqa: E402
+from load_test import BACKEND_DIR, free_port, start_app  # noqa: E402
+
+_IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| *(\S+)")
+
+APP_ENV = {
+    "SEARCH_BACKEND": "azure",
+    "AZURE_SEARCH_ENDPOINT": "https://cold-start.search.windows.net",
+    "AZURE_SEARCH_INDEX": "menu",
+    "AZURE_SPEECH_ENABLED": "true",
+    "AZURE_SPEECH_KEY": "cold-start",
+    "AZURE_SPEECH_REGION": "eastus2",
+    "AZURE_OPENAI_EASTUS_ENDPOINT": "https://cold-start.openai.azure.com",
+    "AZURE_OPENAI_EASTUS_API_KEY": "cold-start",
+    "AZURE_OPENAI_API_VERSION": "2024-10-21",
+}
+
+
+def import_breakdown() -> tuple[float, dict[str, float]]:
+    """
+    Seconds to import app, and the share of it spent in each top-level package.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=BACKEND_DIR,
+                            env={**os.environ, **APP_ENV}, capture_output=True, text=True, check=True)
+    total, packages = 0.0, defaultdict(float)
+    for line in result.stderr.splitlines():
+        if match := _IMPORT_TIME_LINE.match(line):
+            self_us, cumulative_us, name = match.groups()
+            packages[name.split(".")[0]] += int(self_us) / 1e6
+            if name == "app":
+                total = int(cumulative_us) / 1e6
+    return total, packages
+
+
+async def time_startup(port: int, log) -> tuple[float, float, float]:
+    started = time.perf_counter()
+    app = start_app("wss://cold-start.openai.azure.com", port, 1, log, APP_ENV)
+    listening = None
+    try:
+        async with aiohttp.ClientSession() as http:
+            while time.perf_counter() - started < 60:
+                if app.poll() is not None:
+                    raise RuntimeError(f"app.py exited with {app.returncode}, see {log.name}")
+                try:
+                    async with http.get(f"http://127.0.0.1:{port}/ready") as response:
+                        listening = listening or time.perf_counter() - started
+                        if response.status == 200:
+                            warm = time.perf_counter() - started
+                            async with http.get(f"http://127.0.0.1:{port}/metrics") as metrics:
+                                exposition = await metrics.text()
+                            warm_up = float(re.search(r"^app_warm_up_seconds (\S+)", exposition, re.M).group(1))
+                            return listening, warm, warm_up
+                except aiohttp.ClientConnectionError:
+                    pass
+                await asyncio.sleep(0.005)
+        raise RuntimeError("app.py did not get ready within 60s")
+    finally:
+        app.terminate()
+        app.wait()
+
+
+async def main(args) -> int:
+    # Compile the bytecode first, as in the container image
+    subprocess.run([sys.executable, "-c", "import app"], cwd=BACKEND_DIR, env={**os.environ, **APP_ENV}, check=True)
+    total, packages = import_breakdown()
+    print(f"import app: {total * 1000:.0f}ms, by package:")
+    for package, seconds in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"  {package:<24} {seconds * 1000:6.1f}ms")
+
+    timings = []
+    with tempfile.NamedTemporaryFile("w+", prefix="cold_start_app_", suffix=".log", delete=False) as log:
+        for _ in range(args.runs):
+            timings.append(await time_startup(free_port(), log))
+    listening, warm, warm_up = (statistics.median(column) for column in zip(*timings))
+    print(f"median of {args.runs} starts: listening after {listening * 1000:.0f}ms, "
+          f"ready after {warm * 1000:.0f}ms (warm-up {warm_up * 1000:.0f}ms of it)")
+    os.unlink(log.name)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="packages to list in the import time breakdown")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args)))
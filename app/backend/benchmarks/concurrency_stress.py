@@ -0,0 +1,142 @@
+"""
+Concurrency stress test for RTMiddleTier's per-connection state.
+
+Runs the middle tier against a local fake realtime server and drives many
+simultaneous client websockets through tool-calling turns. Fails if a tool
+output reaches the wrong upstream socket or a client sees another client's
+order. With --reconnect every client resumes its order on a new socket after
+the first turn, which must carry on from the same order, and the
+reconnect-to-first-audio latency is reported. Half the clients close the old
+socket first, the other half resume while it is still open, as a client whose
+old connection hasn't timed out yet, and their session must stay theirs once
+the middle tier closes the old socket.
+
+Usage (from app/backend):
+    python benchmarks/concurrency_stress.py [--clients 200] [--turns 3] [--warm-pool 0] [--reconnect]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+from azure.core.credentials import AzureKeyCredential  # noqa: E402
+from fake_realtime import FakeRealtimeServer  # noqa: E402
+
+from metrics import metrics_registry  # noqa: E402
+from order_state import order_state_singleton  # noqa: E402
+from rtmt import RTMiddleTier, Tool  # noqa: E402
+from tools import (  # noqa: E402
+    get_order,
+    get_order_tool_schema,
+    update_order,
+    update_order_tool_schema,
+)
+
+
+async def start_middle_tier(endpoint: str, warm_pool_size: int) -> tuple[web.AppRunner, str]:
+    rtmt = RTMiddleTier(endpoint=endpoint, deployment="fake", credentials=AzureKeyCredential("fake"))
+    rtmt.warm_pool_size = warm_pool_size
+    rtmt.tools["update_order"] = Tool(schema=update_order_tool_schema, target=lambda args, session_id: update_order(args, session_id))
+    rtmt.tools["get_order"] = Tool(schema=get_order_tool_schema, target=lambda _, session_id: get_order(session_id))
+    app = web.Application()
+    rtmt.attach_to_app(app, "/realtime")
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}/realtime"
+
+
+async def run_client(http: aiohttp.ClientSession, url: str, turns: int, reconnect: bool, overlap: bool) -> list[str]:
+    errors = []
+    resume_token = None
+    completed = 0
+    previous = None
+    # With reconnect, the first connection runs one turn and a resumed connection runs the rest
+    connections = [1, turns - 1] if reconnect and turns > 1 else [turns]
+    for connection_turns in connections:
+        connect_url = f"{url}?resume_token={resume_token}" if resume_token else url
+        if previous is not None and not overlap:
+            await previous.close()
+        ws = await http.ws_connect(connect_url)
+        hello = json.loads((await ws.receive()).data)
+        if hello["resumed"] != (resume_token is not None):
+            errors.append(f"connection after turn {completed}: resumed is {hello['resumed']}")
+        resume_token = hello["resume_token"]
+        if previous is not None and overlap:
+            # The middle tier closes the old socket once the new one has taken over the session
+            while (await previous.receive()).type not in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED):
+                pass
+            await previous.close()
+        # A resumed connection first gets the order replayed, holding the turns before the reconnect
+        replay_pending = hello["resumed"]
+        await ws.send_json({"type": "session.update", "session": {"turn_detection": {"type": "server_vad"}}})
+        for _ in range(connection_turns):
+            turn = completed + 1
+            await ws.send_json({"type": "input_audio_buffer.append", "audio": "AAAA"})
+            await ws.send_json({"type": "input_audio_buffer.commit"})
+            responses_done = 0
+            while responses_done < 2:
+                event = json.loads((await ws.receive()).data)
+                if event["type"] == "response.done":
+                    responses_done += 1
+                elif event["type"] == "extension.middle_tier_tool_response":
+                    items = json.loads(event["tool_result"])["items"]
+                    expected = completed if replay_pending else turn
+                    replay_pending = False
+                    if len(items) != 1 or items[0]["quantity"] != expected:
+                        errors.append(f"turn {turn}: unexpected order {items}")
+            completed = turn
+        if hello["resumed"] and resume_token.partition(".")[0] in order_state_singleton.store._released:
+            errors.append(f"connection after turn {completed - connection_turns}: order released while its client is connected")
+        previous = ws
+    await previous.close()
+    return errors
+
+
+async def main(clients: int, turns: int, warm_pool_size: int, reconnect: bool):
+    order_state_singleton.close_grace = 60 if reconnect else 0
+    fake = FakeRealtimeServer(audio_deltas=5)
+    await fake.start()
+    runner, url = await start_middle_tier(fake.endpoint, warm_pool_size)
+    if warm_pool_size:
+        # Give the pool a moment to fill before the clients arrive
+        await asyncio.sleep(0.5)
+    try:
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as http:
+            start = time.perf_counter()
+            results = await asyncio.gather(*(run_client(http, url, turns, reconnect, overlap=client % 2 == 1) for client in range(clients)))
+            elapsed = time.perf_counter() - start
+    finally:
+        await runner.cleanup()
+        await fake.stop()
+
+    errors = [error for result in results for error in result]
+    print(f"{clients} clients x {turns} turns in {elapsed:.2f}s: {fake.completed_turns} turns completed, "
+          f"{fake.mismatched_outputs} misrouted tool outputs, {len(errors)} order errors")
+    ttfa = metrics_registry.histogram("rtmt_time_to_first_audio_seconds", "")
+    hits = metrics_registry.counter("rtmt_warm_pool_hits_total", "")
+    print(f"mean time to first upstream audio {ttfa.sum / max(ttfa.count, 1) * 1000:.1f}ms, {hits.value:.0f} warm pool hits")
+    if reconnect:
+        reconnect_ttfa = metrics_registry.histogram("rtmt_reconnect_to_first_audio_seconds", "")
+        print(f"{fake.context_items} orders replayed, mean reconnect to first response audio {reconnect_ttfa.sum / max(reconnect_ttfa.count, 1) * 1000:.1f}ms")
+    for error in errors[:10]:
+        print("  " + error)
+    return 1 if errors or fake.mismatched_outputs or fake.completed_turns != clients * turns else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--warm-pool", type=int, default=0)
+    parser.add_argument("--reconnect", action="store_true", help="resume every client's order on a new connection after its first turn")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.clients, args.turns, args.warm_pool, args.reconnect)))
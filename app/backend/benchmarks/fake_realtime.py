@@ -0,0 +1,180 @@
+"""
+Local fake of the Azure OpenAI /openai/realtime websocket protocol.
+
+Every committed input buffer gets a response that first calls a tool, then,
+once the middle tier has sent the function_call_output and response.create,
+streams audio deltas, a transcript and response.done. Tool outputs are checked
+against the call ids issued on the same socket, so outputs delivered to the
+wrong upstream connection show up in `mismatched_outputs`.
+
+With transcript_deltas every audio delta is followed by a transcript delta
+carrying the next word of the transcript. With track_audio_arrivals every
+input_audio_buffer.append is timestamped in `audio_arrivals` as (monotonic
+time, total audio bytes received on its socket).
+
+With tool_script, the nth committed input buffer on a socket calls the tool
+of the nth (name, arguments) entry instead, cycling through the script; an
+entry with no name gets a plain audio response.
+
+Faults can be injected for failover testing: connect_delay stalls the
+websocket handshake, response_delay stalls every response before its first
+event, and while reject_status is set the handshake fails with that HTTP
+status. All three may be changed while the server runs.
+"""
+import asyncio
+import base64
+import json
+import os
+import time
+import uuid
+from typing import Optional
+
+from aiohttp import web
+
+
+class FakeRealtimeServer:
+    def __init__(self,
+        audio_deltas: int = 10,
+        delta_interval: float = 0.0,
+        audio_chunk_bytes: int = 4800,
+        tool_name: Optional[str] = "update_order",
+        tool_arguments: Optional[dict] = None,
+        tool_delay: float = 0.0,
+        transcript_deltas: bool = False,
+        track_audio_arrivals: bool = False,
+        connect_delay: float = 0.0,
+        response_delay: float = 0.0,
+        reject_status: Optional[int] = None,
+        tool_script: Optional[list[tuple[Optional[str], dict]]] = None):
+        self.audio_deltas = audio_deltas
+        self.delta_interval = delta_interval
+        self.tool_name = tool_name
+        self.tool_arguments = tool_arguments or {"action": "add", "item_name": "Latte", "size": "small", "quantity": 1, "price": 3.5}
+        self.tool_delay = tool_delay
+        self.transcript_deltas = transcript_deltas
+        self.track_audio_arrivals = track_audio_arrivals
+        self.connect_delay = connect_delay
+        self.response_delay = response_delay
+        self.reject_status = reject_status
+        self.tool_script = tool_script
+        self._audio_chunk = base64.b64encode(os.urandom(audio_chunk_bytes)).decode("ascii")
+        self._runner: Optional[web.AppRunner] = None
+
+        self.connections = 0
+        self.rejected_connections = 0
+        self.completed_turns = 0
+        self.mismatched_outputs = 0
+        self.audio_bytes_received = 0
+        self.context_items = 0
+        self.append_frames = 0
+        self.audio_arrivals: list[tuple[float, int]] = []
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_get("/openai/realtime", self._handler)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return self.endpoint
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _handler(self, request: web.Request) -> web.StreamResponse:
+        if self.connect_delay:
+            await asyncio.sleep(self.connect_delay)
+        if self.reject_status is not None:
+            self.rejected_connections += 1
+            return web.Response(status=self.reject_status, text="Injected failure")
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.connections += 1
+        outstanding: set[str] = set()
+        audio_received = 0
+        commits = 0
+
+        await ws.send_json({"type": "session.created", "event_id": _event_id(), "session": {
+            "id": f"sess_{uuid.uuid4().hex}", "instructions": "Fake realtime session", "voice": "alloy",
+            "tools": [], "tool_choice": "auto", "max_response_output_tokens": "inf"}})
+
+        async for msg in ws:
+            event = json.loads(msg.data)
+            if event["type"] == "session.update":
+                await ws.send_json({"type": "session.updated", "event_id": _event_id(), "session": event["session"]})
+            elif event["type"] == "input_audio_buffer.append":
+                self.audio_bytes_received += len(event["audio"]) * 3 // 4
+                self.append_frames += 1
+                if self.track_audio_arrivals:
+                    audio_received += len(base64.b64decode(event["audio"]))
+                    self.audio_arrivals.append((time.monotonic(), audio_received))
+            elif event["type"] == "input_audio_buffer.commit":
+                tool_name, tool_arguments = self.tool_name, self.tool_arguments
+                if self.tool_script:
+                    tool_name, tool_arguments = self.tool_script[commits % len(self.tool_script)]
+                commits += 1
+                if tool_name is not None:
+                    await self._send_tool_call(ws, outstanding, tool_name, tool_arguments)
+                else:
+                    await self._send_audio_response(ws)
+            elif event["type"] == "conversation.item.create":
+                item = event["item"]
+                if item["type"] == "function_call_output":
+                    if item["call_id"] in outstanding:
+                        outstanding.discard(item["call_id"])
+                    else:
+                        self.mismatched_outputs += 1
+                elif item["type"] == "message":
+                    self.context_items += 1
+            elif event["type"] == "response.create":
+                await self._send_audio_response(ws)
+        return ws
+
+    async def _send_tool_call(self, ws: web.WebSocketResponse, outstanding: set[str], tool_name: str, tool_arguments: dict):
+        if self.response_delay:
+            await asyncio.sleep(self.response_delay)
+        response_id = f"resp_{uuid.uuid4().hex}"
+        call_id = f"call_{uuid.uuid4().hex}"
+        item = {"id": f"item_{uuid.uuid4().hex}", "type": "function_call", "call_id": call_id,
+                "name": tool_name, "arguments": json.dumps(tool_arguments)}
+        outstanding.add(call_id)
+        await ws.send_json({"type": "response.created", "event_id": _event_id(), "response": {"id": response_id, "status": "in_progress", "output": []}})
+        if self.tool_delay:
+            await asyncio.sleep(self.tool_delay)
+        await ws.send_json({"type": "response.output_item.added", "event_id": _event_id(), "response_id": response_id, "output_index": 0, "item": item})
+        await ws.send_json({"type": "conversation.item.created", "event_id": _event_id(), "previous_item_id": None, "item": item})
+        await ws.send_json({"type": "response.function_call_arguments.done", "event_id": _event_id(), "response_id": response_id, "call_id": call_id, "arguments": item["arguments"]})
+        await ws.send_json({"type": "response.output_item.done", "event_id": _event_id(), "response_id": response_id, "output_index": 0, "item": item})
+        await ws.send_json({"type": "response.done", "event_id": _event_id(), "response": {"id": response_id, "status": "completed", "output": [item]}})
+
+    async def _send_audio_response(self, ws: web.WebSocketResponse):
+        if self.response_delay:
+            await asyncio.sleep(self.response_delay)
+        response_id = f"resp_{uuid.uuid4().hex}"
+        item_id = f"item_{uuid.uuid4().hex}"
+        await ws.send_json({"type": "response.created", "event_id": _event_id(), "response": {"id": response_id, "status": "in_progress", "output": []}})
+        for i in range(self.audio_deltas):
+            await ws.send_str(json.dumps({"type": "response.audio.delta", "event_id": _event_id(), "response_id": response_id,
+                                          "item_id": item_id, "output_index": 0, "content_index": 0, "delta": self._audio_chunk}))
+            if self.transcript_deltas:
+                await ws.send_str(json.dumps({"type": "response.audio_transcript.delta", "event_id": _event_id(), "response_id": response_id,
+                                              "item_id": item_id, "output_index": 0, "content_index": 0, "delta": transcript_word(i)}))
+            if self.delta_interval:
+                await asyncio.sleep(self.delta_interval)
+        await ws.send_json({"type": "response.audio_transcript.done", "event_id": _event_id(), "response_id": response_id,
+                            "item_id": item_id, "output_index": 0, "content_index": 0, "transcript": "Your latte has been added."})
+        await ws.send_json({"type": "response.done", "event_id": _event_id(), "response": {"id": response_id, "status": "completed", "output": []}})
+        self.completed_turns += 1
+
+
+def transcript_word(index: int) -> str:
+    return f"word{index} "
+
+
+def _event_id() -> str:
+    return f"event_{uuid.uuid4().hex}"
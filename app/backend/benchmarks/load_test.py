@@ -0,0 +1,258 @@
+"""
+How many concurrent conversations one app.py process sustains.
+
+Starts app.py in a child process with its realtime endpoint pointed at a local
+fake realtime server (benchmarks/fake_realtime.py) and the search tool served
+from the local menu, then drives rising numbers of concurrent conversations
+through /realtime. Every conversation replays a scripted order (search the
+menu, add a latte, add whipped cream, read the order back), one turn per
+step: a slice of coffeetest.wav streamed in 100ms appends at --speed times
+real time, then a commit, to which the fake answers with the step's tool call
+and, after the tool output, an audio response.
+
+For each concurrency level it reports the p50 and p99 turn latency (commit
+until the first response audio reaches the client), failed conversations, the
+app's CPU time per conversation, in total and on the event loop thread, and
+its CPU utilization. The highest level without failures, within --slo-ms at
+p99 and under --max-cpu is the max sustainable concurrency. The clients and
+the fake server share this process; when its own CPU nears a full core the
+numbers say more about the driver than the app, which is flagged.
+
+With --workers above 1 the app is served by gunicorn with that many workers,
+as in the container, and the CPU times cover all of them: the event loop
+figure is then the busiest worker's.
+
+Reads the app's CPU time from /proc, so it runs on Linux (as in the container).
+
+Usage (from app/backend):
+    python benchmarks/load_test.py [--concurrency 5,10,25,50,100] [--speed 1] [--slo-ms 1000] [--workers 1]
+                                   [--app-env NAME=VALUE ...]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import aiohttp  # noqa: E402
+from audio_coalescing import SAMPLE_RATE, WAV_PATH, load_audio  # noqa: E402
+from fake_realtime import FakeRealtimeServer  # noqa: E402
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..")
+CHUNK_BYTES = SAMPLE_RATE * 2 // 10
+
+ORDER_FLOW = [
+    ("search", {"query": "latte"}),
+    ("update_order", {"action": "add", "item_name": "Latte", "size": "large", "quantity": 1, "price": 4.5}),
+    ("update_order", {"action": "add", "item_name": "Whipped Cream", "size": "standard", "quantity": 1, "price": 0.5}),
+    ("get_order", {}),
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def stat_fields(path: str) -> list[str]:
+    with open(path) as stat:
+        # Fields after the parenthesized command name, the state (3rd overall) comes first
+        return stat.read().rsplit(")", 1)[1].split()
+
+
+def process_cpu_seconds(pid: int, thread: bool = False) -> float:
+    # The main thread of the app runs the event loop, its task id is the process id
+    fields = stat_fields(f"/proc/{pid}/task/{pid}/stat" if thread else f"/proc/{pid}/stat")
+    # utime and stime are the 14th and 15th overall
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def worker_pids(pid: int) -> list[int]:
+    """
+    The gunicorn workers under the master process pid, or just pid when it has no children.
+    """
+    children = []
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                if int(stat_fields(f"/proc/{entry}/stat")[1]) == pid:
+                    children.append(int(entry))
+            except (OSError, IndexError):
+                pass
+    return children or [pid]
+
+
+def app_cpu_seconds(pid: int) -> tuple[float, dict[int, float]]:
+    """
+    CPU time of the app and its workers, and of each worker's event loop thread.
+    """
+    workers = worker_pids(pid)
+    total = process_cpu_seconds(pid) + (sum(process_cpu_seconds(worker) for worker in workers) if workers != [pid] else 0)
+    return total, {worker: process_cpu_seconds(worker, thread=True) for worker in workers}
+
+
+def start_app(endpoint: str, port: int, workers: int, log, env_overrides: Optional[dict[str, str]] = None) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "RUNNING_IN_PRODUCTION": "true",
+        # As in the container, so output costs what it does there
+        "PYTHONUNBUFFERED": "1",
+        "HOST": "127.0.0.1",
+        "PORT": str(port),
+        "AZURE_OPENAI_EASTUS2_ENDPOINT": endpoint,
+        "AZURE_OPENAI_EASTUS2_API_KEY": "load-test",
+        "AZURE_OPENAI_REALTIME_DEPLOYMENT": "load-test",
+        "AZURE_OPENAI_REALTIME_ENDPOINTS": "",
+        "AZURE_SEARCH_API_KEY": "load-test",
+        "SEARCH_BACKEND": "local",
+        "ORDER_SESSION_STORE": "memory",
+        "AZURE_SPEECH_ENABLED": "false",
+        "METRICS_ENABLED": "true",
+        "METRICS_PATH": "/metrics",
+        "WEB_WORKERS": str(workers),
+        **(env_overrides or {}),
+    }
+    static = os.path.join(BACKEND_DIR, "static")
+    if not os.path.isdir(static):
+        # The frontend build goes here and create_app serves it, an empty directory is enough to start
+        print(f"No frontend build in {static}, creating it empty")
+        os.makedirs(static)
+    command = [sys.executable, "app.py"] if workers == 1 else [sys.executable, "-m", "gunicorn", "app:create_app", "-b", f"127.0.0.1:{port}"]
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_ready(http: aiohttp.ClientSession, url: str, app: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if app.poll() is not None:
+            raise RuntimeError(f"app.py exited with {app.returncode}, see its log")
+        try:
+            async with http.get(url) as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("app.py did not come up")
+
+
+async def conversation(http: aiohttp.ClientSession, url: str, utterances: list[list[str]], speed: float, delay: float) -> list[float]:
+    await asyncio.sleep(delay)
+    latencies = []
+    async with http.ws_connect(url) as ws:
+        await ws.receive()
+        await ws.send_json({"type": "session.update", "session": {"turn_detection": {"type": "server_vad"}}})
+        for (tool_name, _), appends in zip(ORDER_FLOW, utterances):
+            for append in appends:
+                await ws.send_str(append)
+                if speed > 0:
+                    await asyncio.sleep(0.1 / speed)
+            start = time.perf_counter()
+            await ws.send_json({"type": "input_audio_buffer.commit"})
+            first_audio = None
+            # The tool call and the audio response after its output each end with a response.done
+            responses_left = 2 if tool_name is not None else 1
+            while responses_left:
+                msg = await ws.receive()
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    raise ConnectionError(f"closed mid-turn ({msg.type.name})")
+                event = json.loads(msg.data)
+                if event["type"] == "response.audio.delta" and first_audio is None:
+                    first_audio = time.perf_counter() - start
+                elif event["type"] == "response.done":
+                    responses_left -= 1
+            latencies.append(first_audio)
+    return latencies
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+async def main(args) -> int:
+    audio = load_audio(WAV_PATH, 60)
+    turn_bytes = len(audio) // len(ORDER_FLOW) // CHUNK_BYTES * CHUNK_BYTES
+    utterances = [[json.dumps({"type": "input_audio_buffer.append", "audio": base64.b64encode(audio[i:i + CHUNK_BYTES]).decode("ascii")})
+                   for i in range(turn * turn_bytes, (turn + 1) * turn_bytes, CHUNK_BYTES)]
+                  for turn in range(len(ORDER_FLOW))]
+
+    fake = FakeRealtimeServer(audio_deltas=args.audio_deltas, delta_interval=args.delta_interval_ms / 1000,
+                              response_delay=args.first_delta_ms / 1000, tool_script=ORDER_FLOW)
+    endpoint = await fake.start()
+    port = free_port()
+    log = tempfile.NamedTemporaryFile("w+", prefix="load_test_app_", suffix=".log", delete=False)
+    app = start_app(endpoint, port, args.workers, log, dict(setting.split("=", 1) for setting in args.app_env))
+    base_url = f"http://127.0.0.1:{port}"
+    sustainable = 0
+    print(f"app.py log in {log.name}")
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as http:
+            await wait_ready(http, f"{base_url}/metrics", app)
+            # The workers' own metrics endpoints answer once they are up, give the others a moment too
+            await asyncio.sleep(1.0 if args.workers > 1 else 0)
+            print(f"app.py pid {app.pid} ({args.workers} workers) on {base_url}, {sum(len(u) for u in utterances) * 0.1:.1f}s of audio over "
+                  f"{len(ORDER_FLOW)} turns per conversation at {args.speed}x")
+            for level in (int(level) for level in args.concurrency.split(",")):
+                app_cpu, loop_cpu = app_cpu_seconds(app.pid)
+                driver_cpu, wall = time.process_time(), time.perf_counter()
+                results = await asyncio.gather(*(conversation(http, f"{base_url}/realtime", utterances, args.speed, random.uniform(0, args.ramp))
+                                                 for _ in range(level)), return_exceptions=True)
+                wall = time.perf_counter() - wall
+                app_cpu_after, loop_cpu_after = app_cpu_seconds(app.pid)
+                app_cpu = app_cpu_after - app_cpu
+                loops = sorted((loop_cpu_after[worker] - loop_cpu.get(worker, 0) for worker in loop_cpu_after), reverse=True)
+                driver_cpu = time.process_time() - driver_cpu
+                failed = [result for result in results if isinstance(result, BaseException)]
+                latencies = sorted(latency for result in results if not isinstance(result, BaseException) for latency in result)
+                p50 = statistics.median(latencies) * 1000 if latencies else float("inf")
+                p99 = percentile(latencies, 0.99) * 1000 if latencies else float("inf")
+                utilization = app_cpu / wall
+                ok = not failed and p99 <= args.slo_ms and utilization <= args.max_cpu
+                print(f"{level:4d} conversations: turn latency p50 {p50:6.0f}ms p99 {p99:6.0f}ms, {len(failed)} failed, "
+                      f"app CPU {app_cpu / level * 1000:5.1f}ms per conversation ({loops[0] / level * 1000:5.1f}ms on the event loop), "
+                      f"{utilization:4.0%} of a core"
+                      f"{'' if ok else '  <- over budget'}{'  (driver saturated)' if driver_cpu / wall > 0.9 else ''}")
+                if len(loops) > 1:
+                    print(f"       event loop CPU per worker: {', '.join(f'{seconds * 1000:.0f}ms' for seconds in loops)}")
+                for error in failed[:3]:
+                    print(f"       {type(error).__name__}: {error}")
+                if not ok:
+                    break
+                sustainable = level
+    finally:
+        app.terminate()
+        app.wait()
+        log.close()
+        await fake.stop()
+    print(f"max sustainable concurrency: {sustainable or 'none of the levels'} "
+          f"(p99 <= {args.slo_ms:.0f}ms, no failures, app CPU <= {args.max_cpu:.0%})")
+    return 0 if sustainable else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="5,10,25,50,100", help="comma separated concurrency levels, in increasing order")
+    parser.add_argument("--speed", type=float, default=1.0, help="audio replay speed relative to real time, 0 sends it as fast as possible")
+    parser.add_argument("--ramp", type=float, default=1.0, help="seconds over which each level's conversations start")
+    parser.add_argument("--slo-ms", type=float, default=1000.0, help="p99 turn latency a level must stay within")
+    parser.add_argument("--max-cpu", type=float, default=0.8, help="share of a core the app may use at a sustainable level")
+    parser.add_argument("--first-delta-ms", type=float, default=200.0, help="fake model's delay before each response")
+    parser.add_argument("--delta-interval-ms", type=float, default=50.0, help="fake model's delay between audio deltas")
+    parser.add_argument("--workers", type=int, default=1, help="serve the app with gunicorn and this many workers when above 1")
+    parser.add_argument("--audio-deltas", type=int, default=20, help="audio deltas per fake response")
+    parser.add_argument("--app-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the app, e.g. LOG_SAMPLE_RATES=search=0.1, may be repeated")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,107 @@
+"""
+Event loop time spent logging one conversation's turns, print based versus structured.
+
+Replays the log output of a scripted order conversation (a menu search, two
+order updates, reading the order back and the connection closing) as the
+backend used to write it, with print and f-strings, and as it writes it now
+through structured_logging's queue handler. Output goes to a pipe without
+buffering, as with PYTHONUNBUFFERED=1 in the container. Reports the CPU time
+per turn on the calling thread, which is the event loop's share; with the
+queue handler the formatting and writing happen on the listener thread. The
+structured variant also runs with sampling, which drops events before their
+records are created, without the caller lookup (LOG_SKIP_CALLER), which can't
+be switched back on so it comes after the other INFO runs, and at WARNING.
+
+Usage (from app/backend):
+    python benchmarks/logging_overhead.py [--conversations 2000]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from menu_search import DEFAULT_MENU_PATH, MenuSearchIndex  # noqa: E402
+from structured_logging import configure_logging, session_id_var  # noqa: E402
+
+TURNS = 4
+ARGS = {"action": "add", "item_name": "Latte", "size": "large", "quantity": 1, "price": 4.5}
+SUMMARY = json.dumps({"items": [{"item": "Latte", "size": "large", "quantity": 1, "price": 4.5, "display": "Large Latte"},
+                                {"item": "Whipped Cream", "size": "standard", "quantity": 1, "price": 0.5, "display": "Whipped Cream"}],
+                      "total": 5.0, "tax": 0.4, "finalTotal": 5.4})
+
+
+logger = logging.getLogger("coffee-chat")
+order_logger = logging.getLogger("order_state")
+
+
+def print_conversation(session_id: str, results: str):
+    print("\nStarting local search for 'latte' in the menu.")
+    print(f"Search results: {results}")
+    for _ in range(2):
+        print(f"\nUpdating the current order for session {session_id}.")
+        print(f"Arguments: {ARGS}")
+        order_logger.info(f"Added Large Latte in session {session_id}")
+        print(f"Updated Order Summary: {SUMMARY}")
+    print(f"\nRetrieving the current order summary for session {session_id}.")
+    print(f"Order Summary: {SUMMARY}")
+    print("Closing OpenAI's realtime socket connection.")
+
+
+def log_conversation(session_id: str, results: str):
+    logger.info("Searching the menu for %r", "latte", extra={"event": "search"})
+    logger.debug("Search results: %s", results, extra={"event": "search.results"})
+    for _ in range(2):
+        logger.info("Updating the order: %s", ARGS, extra={"event": "order.update", "session_id": session_id})
+        order_logger.info("%s %s", "Added", "Large Latte", extra={"event": "order.change", "session_id": session_id})
+        logger.debug("Updated order summary: %s", SUMMARY, extra={"event": "order.summary", "session_id": session_id})
+    logger.info("Reading back the order", extra={"event": "order.read", "session_id": session_id})
+    logger.debug("Order summary: %s", SUMMARY, extra={"event": "order.summary", "session_id": session_id})
+    logger.info("Client closed the connection, closing its upstream socket", extra={"event": "relay.close"})
+
+
+async def run(conversations: int, conversation) -> float:
+    index = MenuSearchIndex.from_file(DEFAULT_MENU_PATH)
+    results = index.snippets.join([hit["id"] for hit in index.search("latte", top=5)], "full")
+    start = time.thread_time()
+    for i in range(conversations):
+        session_id = f"session-{i}"
+        session_id_var.set(session_id)
+        conversation(session_id, results)
+        # Give the loop a chance to run, as it would between turns
+        await asyncio.sleep(0)
+    return (time.thread_time() - start) / (conversations * TURNS)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=2000)
+    args = parser.parse_args()
+
+    sink = subprocess.Popen(["cat"], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, bufsize=0)
+    with io.TextIOWrapper(sink.stdin, write_through=True) as output:
+        logging.basicConfig(level=logging.INFO, stream=output, force=True)
+        with contextlib.redirect_stdout(output):
+            before = asyncio.run(run(args.conversations, print_conversation))
+        print(f"print and f-strings         : {before * 1e6:6.1f}us per turn on the event loop")
+
+        for label, level, rates, skip_caller in (("structured, INFO", "INFO", {}, False),
+                                                 ("structured, INFO, sampled", "INFO", {"search": 0.1, "order.update": 0.1, "order.change": 0.1, "order.read": 0.1, "relay.close": 0.1}, False),
+                                                 ("structured, INFO, no caller", "INFO", {}, True),
+                                                 ("structured, WARNING", "WARNING", {}, True)):
+            configure_logging(level, sample_rates=rates, stream=output, skip_caller=skip_caller)
+            after = asyncio.run(run(args.conversations, log_conversation))
+            change = f"{before / after:.1f}x less" if after <= before else f"{after / before:.1f}x more"
+            print(f"{label:28s}: {after * 1e6:6.1f}us per turn on the event loop ({change})")
+    sink.wait()
+
+
+if __name__ == "__main__":
+    main()
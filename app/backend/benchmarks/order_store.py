@@ -0,0 +1,206 @@
+"""
+Micro-benchmark for the order session stores.
+
+Compares the in-memory store, which keeps line items in a dict keyed by
+(item, size) with an incremental total and a lazily cached summary, against a
+replica of the earlier list-scan store that rebuilt the summary on every change.
+Two workloads are timed:
+
+  * a large group order: hundreds of distinct line items with repeated
+    quantity updates, each followed by a summary read as the tools do
+  * thousands of concurrent sessions each placing a small order, reporting
+    throughput and the memory held per session
+
+The Redis store is timed on the same workloads against --redis-url, or against
+an in-process fakeredis server when no URL is given and fakeredis is installed.
+It is also checked for lost updates by several simulated workers, each with its
+own connection, adding to and removing from the same order concurrently.
+
+Usage (from app/backend):
+    python benchmarks/order_store.py [--items 500] [--updates 5000] [--sessions 5000] [--redis-url redis://localhost:6379/0]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+from collections.abc import Iterable
+from typing import Callable, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from models import OrderItem, OrderSummary  # noqa: E402
+from session_store import (  # noqa: E402
+    InMemorySessionStore,
+    RedisSessionStore,
+    SessionStore,
+    format_display,
+)
+
+SIZES = ["small", "medium", "large", "standard", "pot"]
+
+
+class LegacySessionStore(SessionStore):
+    """
+    The previous store: a list scanned for each update and a summary rebuilt after every change.
+    """
+    def __init__(self):
+        self.sessions = {}
+
+    def _update_summary(self, session_id: str):
+        session = self.sessions[session_id]
+        total = sum(item.price * item.quantity for item in session["order_state"])
+        tax = total * 0.08
+        session["order_summary"] = OrderSummary(items=session["order_state"], total=total, tax=tax, finalTotal=total + tax)
+
+    async def create(self, session_id: str):
+        self.sessions[session_id] = {"order_state": [], "order_summary": None}
+        self._update_summary(session_id)
+
+    async def update(self, session_id: str, action: str, item_name: str, size: str, quantity: int, price: float) -> Optional[str]:
+        order_state = self.sessions[session_id]["order_state"]
+        index = next((i for i, item in enumerate(order_state) if item.item == item_name and item.size == size), -1)
+        if action == "add":
+            if index != -1:
+                order_state[index].quantity += quantity
+            else:
+                order_state.append(OrderItem(item=item_name, size=size, quantity=quantity, price=price, display=format_display(item_name, size)))
+        elif action == "remove" and index != -1:
+            if order_state[index].quantity > quantity:
+                order_state[index].quantity -= quantity
+            else:
+                order_state.pop(index)
+        self._update_summary(session_id)
+        return None
+
+    async def summary(self, session_id: str) -> OrderSummary:
+        return self.sessions[session_id]["order_summary"]
+
+    async def release(self, session_id: str, grace: float = 0):
+        self.sessions.pop(session_id, None)
+
+    async def resume(self, session_id: str) -> bool:
+        return session_id in self.sessions
+
+    async def touch(self, session_ids: Iterable[str]):
+        pass
+
+
+def updates(items: int, count: int, seed: int = 7):
+    rng = random.Random(seed)
+    catalog = [(f"Item {i}", SIZES[i % len(SIZES)], round(2 + (i % 40) * 0.25, 2)) for i in range(items)]
+    ops = [("add", name, size, 1, price) for name, size, price in catalog]
+    for _ in range(count):
+        name, size, price = rng.choice(catalog)
+        ops.append((rng.choice(("add", "add", "remove")), name, size, 1, price))
+    return ops
+
+
+async def bench_group_order(store: SessionStore, ops) -> tuple[float, str]:
+    session_id = str(uuid.uuid4())
+    await store.create(session_id)
+    start = time.perf_counter()
+    for action, name, size, quantity, price in ops:
+        await store.update(session_id, action, name, size, quantity, price)
+        summary = await store.summary_json(session_id)
+    return time.perf_counter() - start, summary
+
+
+async def bench_sessions(store: SessionStore, sessions: int) -> tuple[float, float]:
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    for i in range(sessions):
+        session_id = str(uuid.uuid4())
+        await store.create(session_id)
+        await store.update(session_id, "add", "Latte", SIZES[i % 3], 1, 4.5)
+        await store.update(session_id, "add", "Croissant", "standard", 2, 3.25)
+        await store.update(session_id, "add", "Latte", SIZES[i % 3], 1, 4.5)
+        await store.summary_json(session_id)
+    elapsed = time.perf_counter() - start
+    held = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    return elapsed, held / sessions
+
+
+async def check_concurrent_workers(connect: Callable[[], SessionStore], workers: int = 8, updates_per_worker: int = 200):
+    stores = [connect() for _ in range(workers)]
+    session_id = str(uuid.uuid4())
+    await stores[0].create(session_id)
+
+    async def worker(store: SessionStore) -> int:
+        # Adds three lattes then removes one, so each round leaves two more in the order
+        for _ in range(updates_per_worker // 4):
+            await store.update(session_id, "add", "Latte", "large", 1, 4.5)
+            await store.update(session_id, "add", "Latte", "large", 1, 4.5)
+            await store.update(session_id, "remove", "Latte", "large", 1, 0)
+            await store.update(session_id, "add", "Latte", "large", 1, 4.5)
+        return 2 * (updates_per_worker // 4)
+
+    expected = sum(await asyncio.gather(*(worker(store) for store in stores)))
+    summary = await stores[0].summary(session_id)
+    quantity = summary.items[0].quantity if summary.items else 0
+    print(f"  {workers} workers updating one order concurrently: {quantity} lattes, expected {expected}, "
+          f"total ${summary.total:.2f} {'ok' if quantity == expected and summary.total == expected * 4.5 else 'LOST UPDATES'}")
+    for store in stores:
+        await store.close()
+
+
+def redis_connector(url: Optional[str]) -> Optional[Callable[[], SessionStore]]:
+    if url:
+        # One prefix for every connection so the simulated workers share sessions, apart from real orders
+        key_prefix = f"coffee-chat-bench:{uuid.uuid4()}:"
+        return lambda: RedisSessionStore.from_url(url, key_prefix=key_prefix)
+    try:
+        import fakeredis
+    except ImportError:
+        return None
+    server = fakeredis.FakeServer()
+    return lambda: RedisSessionStore(fakeredis.FakeAsyncRedis(server=server, decode_responses=True))
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=500, help="distinct line items in the group order")
+    parser.add_argument("--updates", type=int, default=5000, help="quantity updates after the items are added")
+    parser.add_argument("--sessions", type=int, default=5000, help="concurrent sessions for the throughput run")
+    parser.add_argument("--redis-url", help="Redis server for the Redis store, defaults to an in-process fakeredis")
+    args = parser.parse_args()
+
+    ops = updates(args.items, args.updates)
+    legacy_elapsed, legacy_summary = await bench_group_order(LegacySessionStore(), ops)
+    indexed_elapsed, indexed_summary = await bench_group_order(InMemorySessionStore(), ops)
+    assert OrderSummary.model_validate_json(legacy_summary).items == OrderSummary.model_validate_json(indexed_summary).items
+    print(f"group order ({args.items} items, {len(ops)} updates with a read after each):")
+    print(f"  legacy   : {legacy_elapsed * 1e6 / len(ops):8.1f}us per update")
+    print(f"  in-memory: {indexed_elapsed * 1e6 / len(ops):8.1f}us per update ({legacy_elapsed / indexed_elapsed:.1f}x)")
+
+    legacy_elapsed, legacy_bytes = await bench_sessions(LegacySessionStore(), args.sessions)
+    indexed_elapsed, indexed_bytes = await bench_sessions(InMemorySessionStore(), args.sessions)
+    print(f"{args.sessions} concurrent sessions (3 updates and a read each):")
+    print(f"  legacy   : {args.sessions / legacy_elapsed:10,.0f} sessions/s, {legacy_bytes:,.0f} bytes per session")
+    print(f"  in-memory: {args.sessions / indexed_elapsed:10,.0f} sessions/s, {indexed_bytes:,.0f} bytes per session")
+
+    connect = redis_connector(args.redis_url)
+    if connect is None:
+        print("redis: skipped, pass --redis-url or install fakeredis")
+        return
+    print(f"redis ({args.redis_url or 'fakeredis'}):")
+    store = connect()
+    redis_ops = ops[:min(len(ops), 1000)]
+    elapsed, redis_summary = await bench_group_order(store, redis_ops)
+    _, memory_summary = await bench_group_order(InMemorySessionStore(), redis_ops)
+    assert redis_summary == memory_summary
+    print(f"  group order: {elapsed * 1e6 / len(redis_ops):8.1f}us per update over {len(redis_ops)} updates")
+    sessions = min(args.sessions, 1000)
+    elapsed, _ = await bench_sessions(store, sessions)
+    print(f"  sessions   : {sessions / elapsed:10,.0f} sessions/s")
+    await store.close()
+    await check_concurrent_workers(connect)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,138 @@
+"""
+Cost of the realtime relay's hot-path instrumentation.
+
+Times the bookkeeping the relay does per frame (counting it, and on every
+frame_metrics_interval-th frame updating the frame and byte counters, reading
+the clock twice and observing the processing-time histogram) in isolation,
+then runs the middle tier against the local fake realtime server, scrapes
+/metrics and works out the CPU time per relayed frame. Fails if the
+instrumentation costs more than --budget percent of that. The CPU time
+includes the fake server and the clients running in the same process, so the
+budget is kept well below what it would be for the relay alone.
+
+Usage (from app/backend):
+    python benchmarks/relay_metrics_overhead.py [--clients 20] [--turns 5] [--budget 1]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import timeit
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+from azure.core.credentials import AzureKeyCredential  # noqa: E402
+from fake_realtime import FakeRealtimeServer  # noqa: E402
+
+from metrics import Counter, Histogram, metrics_registry  # noqa: E402
+from rtmt import _RELAY_OVERHEAD_BUCKETS, RTMiddleTier, Tool  # noqa: E402
+from tools import update_order, update_order_tool_schema  # noqa: E402
+
+FRAME = '{"type": "response.audio.delta", "delta": "AAAA"}'
+
+
+def instrumentation_seconds(interval: int, count: int = 500000) -> float:
+    # Standalone copies of the relay's metrics, so the timing loop doesn't count towards the registry's
+    frames, received = Counter("frames", ""), Counter("bytes", "")
+    overhead = Histogram("overhead", "", buckets=_RELAY_OVERHEAD_BUCKETS)
+    session = SimpleNamespace(frames_to_client=0)
+
+    def instrumented():
+        unflushed_bytes = 0
+        for _ in range(count):
+            session.frames_to_client += 1
+            unflushed_bytes += len(FRAME)
+            timed = session.frames_to_client % interval == 0
+            if timed:
+                frames.inc(interval)
+                received.inc(unflushed_bytes)
+                unflushed_bytes = 0
+                started = time.perf_counter()
+            if timed:
+                overhead.observe(time.perf_counter() - started)
+
+    def bare():
+        for _ in range(count):
+            session.frames_to_client += 1
+
+    return (min(timeit.repeat(instrumented, number=1, repeat=5)) - min(timeit.repeat(bare, number=1, repeat=5))) / count
+
+
+async def run_client(http: aiohttp.ClientSession, url: str, turns: int):
+    async with http.ws_connect(url) as ws:
+        await ws.receive()
+        await ws.send_json({"type": "session.update", "session": {"turn_detection": {"type": "server_vad"}}})
+        for _ in range(turns):
+            await ws.send_json({"type": "input_audio_buffer.append", "audio": "AAAA"})
+            await ws.send_json({"type": "input_audio_buffer.commit"})
+            responses_done = 0
+            while responses_done < 2:
+                msg = await ws.receive()
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    raise ConnectionError("relay closed the connection")
+                if '"response.done"' in msg.data[:40]:
+                    responses_done += 1
+
+
+def metric_total(exposition: str, name: str) -> float:
+    return sum(float(line.rsplit(" ", 1)[1]) for line in exposition.splitlines() if line.startswith(name + "{") or line.startswith(name + " "))
+
+
+async def main(args) -> int:
+    per_frame_instrumentation = instrumentation_seconds(RTMiddleTier.frame_metrics_interval)
+
+    fake = FakeRealtimeServer(audio_deltas=50, transcript_deltas=True, audio_chunk_bytes=2400)
+    await fake.start()
+    rtmt = RTMiddleTier(endpoint=fake.endpoint, deployment="fake", credentials=AzureKeyCredential("fake"))
+    rtmt.tools["update_order"] = Tool(schema=update_order_tool_schema, target=lambda args, session_id: update_order(args, session_id))
+    app = web.Application()
+    rtmt.attach_to_app(app, "/realtime")
+    metrics_registry.attach_to_app(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+    base_url = f"http://{host}:{port}"
+
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as http:
+            cpu_start = time.process_time()
+            await asyncio.gather(*(run_client(http, f"{base_url}/realtime", args.turns) for _ in range(args.clients)))
+            cpu = time.process_time() - cpu_start
+            async with http.get(f"{base_url}/metrics") as response:
+                content_type = response.headers["Content-Type"]
+                exposition = await response.text()
+    finally:
+        await runner.cleanup()
+        await fake.stop()
+
+    frames = metric_total(exposition, "rtmt_relay_frames_total")
+    processing = metric_total(exposition, "rtmt_relay_frame_processing_seconds_sum")
+    sampled = metric_total(exposition, "rtmt_relay_frame_processing_seconds_count")
+    speech_count = metric_total(exposition, "rtmt_speech_stopped_to_first_audio_seconds_count")
+    speech_sum = metric_total(exposition, "rtmt_speech_stopped_to_first_audio_seconds_sum")
+    tool_count = metric_total(exposition, "rtmt_tool_call_seconds_count")
+    tool_sum = metric_total(exposition, "rtmt_tool_call_seconds_sum")
+    cpu_per_frame = cpu / frames
+    share = per_frame_instrumentation / cpu_per_frame * 100
+
+    print(f"/metrics: {len(exposition.splitlines())} lines, {content_type}")
+    print(f"{frames:.0f} frames relayed, {cpu_per_frame * 1e6:.1f}us CPU per frame end to end, "
+          f"{processing / sampled * 1e6:.1f}us of it inspecting and rewriting")
+    print(f"speech stopped to first audio: {speech_sum / max(speech_count, 1) * 1000:.1f}ms mean over {speech_count:.0f} turns, "
+          f"tool calls {tool_sum / max(tool_count, 1) * 1000:.2f}ms mean over {tool_count:.0f}")
+    print(f"instrumentation: {per_frame_instrumentation * 1e9:.0f}ns per frame, {share:.2f}% of the relay CPU (budget {args.budget}%)")
+    return 0 if share <= args.budget else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=1.0, help="most the instrumentation may add, in percent of the relay CPU per frame")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args)))
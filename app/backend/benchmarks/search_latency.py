@@ -0,0 +1,94 @@
+"""
+Latency and recall benchmark for the search tool backends.
+
+Replays the recorded customer queries in search_queries.json against the local
+in-memory menu index and reports per-query latency and recall@5 against the
+items each query is expected to surface. With --azure the same queries are also
+sent to the Azure AI Search index configured in .env for comparison.
+
+Usage (from app/backend):
+    python benchmarks/search_latency.py [--repeat 200] [--azure]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from menu_search import MenuSearchIndex  # noqa: E402
+
+QUERIES_PATH = os.path.join(os.path.dirname(__file__), "search_queries.json")
+
+
+def recall(returned_ids: list[str], relevant: list[str]) -> float:
+    return sum(1 for item_id in relevant if item_id in returned_ids) / len(relevant)
+
+
+def report(name: str, latencies: list[float], recalls: list[float]):
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{name}: p50 {p50 * 1e6:,.1f}us, p99 {p99 * 1e6:,.1f}us, mean recall@5 {statistics.mean(recalls):.2f}")
+
+
+def bench_local(queries: list[dict], repeat: int):
+    start = time.perf_counter()
+    index = MenuSearchIndex.from_file()
+    print(f"local index built in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    latencies, recalls = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results = index.search(query["query"], top=5)
+        latencies.append(time.perf_counter() - start)
+        recalls.append(recall([r["id"] for r in results], query["relevant"]))
+    report("local (first call)", latencies, recalls)
+
+    latencies = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query["query"], top=5)
+            latencies.append(time.perf_counter() - start)
+    report("local (warm)", latencies, recalls)
+
+
+async def bench_azure(queries: list[dict]):
+    from azure.core.credentials import AzureKeyCredential
+    from azure.search.documents.aio import SearchClient
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    client = SearchClient(os.environ["AZURE_SEARCH_ENDPOINT"], os.environ["AZURE_SEARCH_INDEX"], AzureKeyCredential(os.environ["AZURE_SEARCH_API_KEY"]))
+    latencies, recalls = [], []
+    async with client:
+        for query in queries:
+            start = time.perf_counter()
+            results = await client.search(search_text=query["query"], query_type="semantic",
+                                          semantic_configuration_name=os.environ.get("AZURE_SEARCH_SEMANTIC_CONFIGURATION") or "default",
+                                          top=5, select=["id"])
+            returned_ids = [r["id"] async for r in results]
+            latencies.append(time.perf_counter() - start)
+            recalls.append(recall(returned_ids, query["relevant"]))
+    report("azure ai search", latencies, recalls)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--azure", action="store_true", help="also query the Azure AI Search index from .env")
+    args = parser.parse_args()
+
+    with open(QUERIES_PATH, encoding="utf-8") as queries_file:
+        queries = json.load(queries_file)
+    bench_local(queries, args.repeat)
+    if args.azure:
+        asyncio.run(bench_azure(queries))
+
+
+if __name__ == "__main__":
+    main()
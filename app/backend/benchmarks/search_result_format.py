@@ -0,0 +1,77 @@
+"""
+CPU and token cost of formatting search tool results.
+
+Compares the original per-hit f-string concatenation with the precomputed
+snippet table for each field projection, over the recorded queries in
+search_queries.json. Tokens are counted with tiktoken's o200k_base encoding
+(the GPT-4o tokenizer) when it is available, otherwise estimated at four
+characters per token.
+
+Usage (from app/backend):
+    python benchmarks/search_result_format.py [--repeat 2000]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from menu_search import MenuSearchIndex  # noqa: E402
+from search_format import PROJECTIONS  # noqa: E402
+
+QUERIES_PATH = os.path.join(os.path.dirname(__file__), "search_queries.json")
+
+
+def legacy_format(hits: list[dict]) -> str:
+    results = ""
+    for r in hits:
+        results += f"[{r['id']}]: Category: {r['category']}, Name: {r['name']}, Description: {r['description']}, Long Description: {r['longDescription']}, Origin: {r['origin']}, Caffeine Content: {r['caffeineContent']}, Brewing Method: {r['brewingMethod']}, Popularity: {r['popularity']}, Sizes: {r['sizes']}\n-----\n"
+    return results
+
+
+def token_counter():
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("o200k_base")
+        return lambda text: len(encoding.encode(text)), "tiktoken o200k_base"
+    except Exception:
+        # Not installed, or the encoding can't be downloaded
+        return lambda text: len(text) / 4, "estimated at 4 chars/token"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    with open(QUERIES_PATH, encoding="utf-8") as queries_file:
+        queries = [query["query"] for query in json.load(queries_file)]
+    index = MenuSearchIndex.from_file()
+    hit_lists = [index.search(query, top=5) for query in queries]
+    id_lists = [[hit["id"] for hit in hits] for hits in hit_lists]
+    count_tokens, tokenizer = token_counter()
+    calls = args.repeat * len(hit_lists)
+
+    start = time.process_time()
+    for _ in range(args.repeat):
+        for hits in hit_lists:
+            legacy_format(hits)
+    legacy_us = (time.process_time() - start) / calls * 1e6
+    legacy_tokens = sum(count_tokens(legacy_format(hits)) for hits in hit_lists) / len(hit_lists)
+    print(f"tokens {tokenizer}")
+    print(f"legacy concatenation: {legacy_us:.2f}us CPU, {legacy_tokens:.0f} tokens per tool call")
+
+    for projection in PROJECTIONS:
+        start = time.process_time()
+        for _ in range(args.repeat):
+            for ids in id_lists:
+                index.snippets.join(ids, projection)
+        snippet_us = (time.process_time() - start) / calls * 1e6
+        tokens = sum(count_tokens(index.snippets.join(ids, projection)) for ids in id_lists) / len(id_lists)
+        print(f"snippets [{projection}]: {snippet_us:.2f}us CPU, {tokens:.0f} tokens per tool call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+How the relay copes with a client that reads slower than the realtime API sends.
+
+A fake realtime server streams one long response (--deltas audio deltas, each
+followed by a transcript delta) as fast as it can, and a client reads it back
+with --read-delay seconds between frames over a link with small socket
+buffers, like a kiosk on a poor network. The relay is run unbuffered, as it was
+before the relay queues, and then with a --queue-kb queue towards the client
+under each overflow policy. Each run reports when the relay had read the whole
+response from upstream, when the client had it, how much of the transcript
+arrived as deltas and the relay's queue counters.
+
+Usage (from app/backend):
+    python benchmarks/slow_client.py [--deltas 300] [--read-delay 0.002] [--queue-kb 512]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+from azure.core.credentials import AzureKeyCredential  # noqa: E402
+from fake_realtime import FakeRealtimeServer, transcript_word  # noqa: E402
+
+from metrics import metrics_registry  # noqa: E402
+from rtmt import RelayOverflowPolicy, RTMiddleTier, RTSession, peek_message_type  # noqa: E402
+
+# Socket buffers of the client link; loopback defaults would absorb megabytes
+SOCKET_BUFFER_BYTES = 32 * 1024
+
+
+class TimedMiddleTier(RTMiddleTier):
+    upstream_read_at = 0.0
+
+    async def _process_message_to_client(self, msg, session: RTSession):
+        if peek_message_type(msg.data) == "response.done":
+            self.upstream_read_at = time.monotonic()
+        return await super()._process_message_to_client(msg, session)
+
+
+def small_buffer_socket(addr_info) -> socket.socket:
+    family, type_, proto, _, _ = addr_info
+    sock = socket.socket(family=family, type=type_, proto=proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_BYTES)
+    return sock
+
+
+async def limit_send_buffer(request: web.Request, response: web.StreamResponse):
+    request.transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_BYTES)
+
+
+def counter(name: str) -> float:
+    return metrics_registry.counter(name, "", {"direction": "to_client"}).value
+
+
+async def run(server: FakeRealtimeServer, queue_bytes: int, policy: RelayOverflowPolicy, read_delay: float) -> str:
+    rtmt = TimedMiddleTier(endpoint=server.endpoint, deployment="fake", credentials=AzureKeyCredential("fake"))
+    rtmt.client_queue_bytes = queue_bytes
+    rtmt.slow_client_policy = policy
+    app = web.Application()
+    app.on_response_prepare.append(limit_send_buffer)
+    rtmt.attach_to_app(app, "/realtime")
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+
+    dropped, coalesced = counter("rtmt_relay_frames_dropped_total"), counter("rtmt_relay_frames_coalesced_total")
+    high_water = metrics_registry.histogram("rtmt_relay_queue_high_water_bytes", "", {"direction": "to_client"})
+    high_water_sum = high_water.sum
+    transcript = ""
+    transcript_frames = 0
+    outcome = "incomplete"
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(socket_factory=small_buffer_socket)) as http:
+            async with http.ws_connect(f"http://{host}:{port}/realtime") as ws:
+                await ws.send_json({"type": "input_audio_buffer.commit"})
+                start = time.monotonic()
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    event = json.loads(msg.data)
+                    if event["type"] == "response.audio_transcript.delta":
+                        transcript += event["delta"]
+                        transcript_frames += 1
+                    elif event["type"] == "response.done":
+                        outcome = "complete"
+                        break
+                    await asyncio.sleep(read_delay)
+                client_done = time.monotonic() - start
+                if outcome != "complete" and ws.closed:
+                    outcome = "disconnected"
+        # The session reports its high-water mark once the handler has finished
+        await asyncio.sleep(0.1)
+    finally:
+        await runner.cleanup()
+    expected = "".join(transcript_word(i) for i in range(server.audio_deltas))
+    upstream = f"{(rtmt.upstream_read_at - start) * 1000:6.0f}ms" if rtmt.upstream_read_at else "     -  "
+    return (f"upstream read in {upstream}, client {outcome:<12} in {client_done * 1000:6.0f}ms, "
+            f"transcript {'intact' if transcript == expected else 'partial'} over {transcript_frames:3} deltas, "
+            f"{counter('rtmt_relay_frames_dropped_total') - dropped:3.0f} dropped, {counter('rtmt_relay_frames_coalesced_total') - coalesced:3.0f} coalesced, "
+            f"queue high water {(high_water.sum - high_water_sum) / 1024:4.0f} KiB")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--deltas", type=int, default=300, help="audio deltas in the response, 100ms of 24kHz audio each")
+    parser.add_argument("--read-delay", type=float, default=0.002, help="seconds the client takes per frame")
+    parser.add_argument("--queue-kb", type=int, default=512, help="relay queue towards the client")
+    args = parser.parse_args()
+
+    server = FakeRealtimeServer(audio_deltas=args.deltas, tool_name=None, transcript_deltas=True)
+    await server.start()
+    try:
+        print(f"unbuffered         : {await run(server, 0, RelayOverflowPolicy.COALESCE, args.read_delay)}")
+        for policy in RelayOverflowPolicy:
+            print(f"{args.queue_kb}KiB {policy.value:<10}: {await run(server, args.queue_kb * 1024, policy, args.read_delay)}")
+        print(f"{4 * args.queue_kb}KiB coalesce  : {await run(server, 4 * args.queue_kb * 1024, RelayOverflowPolicy.COALESCE, args.read_delay)}")
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,129 @@
+"""
+Load balancing and failover across several realtime upstream endpoints.
+
+Runs the middle tier against three local fake realtime servers: a fast one, a
+slow one (slower handshake and responses) and a flaky one that rejects every
+handshake with a 503 during the first phase and recovers for the second. Waves
+of clients run a tool-calling turn each. Reports per phase how the connections
+spread over the endpoints, how many clients needed a failover, how many failed
+outright (should be none), the time from commit to first response audio, and
+the circuit state of the flaky endpoint.
+
+Usage (from app/backend):
+    python benchmarks/upstream_failover.py [--waves 10] [--clients 20] [--cooldown 1.0]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+from azure.core.credentials import AzureKeyCredential  # noqa: E402
+from fake_realtime import FakeRealtimeServer  # noqa: E402
+
+from metrics import metrics_registry  # noqa: E402
+from rtmt import RTMiddleTier, Tool  # noqa: E402
+from tools import update_order, update_order_tool_schema  # noqa: E402
+
+
+async def run_client(http: aiohttp.ClientSession, url: str) -> float:
+    async with http.ws_connect(url) as ws:
+        await ws.receive()
+        await ws.send_json({"type": "session.update", "session": {"turn_detection": {"type": "server_vad"}}})
+        await ws.send_json({"type": "input_audio_buffer.append", "audio": "AAAA"})
+        start = time.perf_counter()
+        await ws.send_json({"type": "input_audio_buffer.commit"})
+        first_audio = None
+        responses_done = 0
+        while responses_done < 2:
+            msg = await ws.receive()
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                raise ConnectionError(f"connection closed after {responses_done} responses")
+            event = json.loads(msg.data)
+            if event["type"] == "response.audio.delta" and first_audio is None:
+                first_audio = time.perf_counter() - start
+            elif event["type"] == "response.done":
+                responses_done += 1
+        return first_audio
+
+
+async def run_phase(name: str, http: aiohttp.ClientSession, url: str, servers: dict[str, FakeRealtimeServer], waves: int, clients: int):
+    failovers = metrics_registry.counter("rtmt_upstream_failovers_total", "")
+    connections_before = {label: server.connections for label, server in servers.items()}
+    failovers_before = failovers.value
+    first_audio, failed = [], 0
+    for _ in range(waves):
+        results = await asyncio.gather(*(run_client(http, url) for _ in range(clients)), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                failed += 1
+            else:
+                first_audio.append(result)
+    spread = ", ".join(f"{label} {server.connections - connections_before[label]}" for label, server in servers.items())
+    print(f"{name}: {waves * clients} clients -> {spread}; {failovers.value - failovers_before:.0f} failovers, {failed} failed clients")
+    if first_audio:
+        first_audio.sort()
+        print(f"  first response audio p50 {statistics.median(first_audio) * 1000:.0f}ms, "
+              f"p99 {first_audio[int(len(first_audio) * 0.99) - 1] * 1000:.0f}ms")
+    return failed
+
+
+async def main(args) -> int:
+    servers = {
+        "fast": FakeRealtimeServer(audio_deltas=5, response_delay=0.02),
+        "slow": FakeRealtimeServer(audio_deltas=5, connect_delay=0.05, response_delay=0.25),
+        "flaky": FakeRealtimeServer(audio_deltas=5, response_delay=0.02, reject_status=503),
+    }
+    for server in servers.values():
+        await server.start()
+
+    rtmt = RTMiddleTier(endpoint=servers["fast"].endpoint, deployment="fake", credentials=AzureKeyCredential("fake"))
+    rtmt.add_upstream(servers["slow"].endpoint)
+    rtmt.add_upstream(servers["flaky"].endpoint)
+    # Every failed probe doubles the cooldown, capped here so the recovery phase starts soon
+    rtmt.upstreams.base_cooldown = args.cooldown
+    rtmt.upstreams.max_cooldown = args.cooldown * 4
+    rtmt.tools["update_order"] = Tool(schema=update_order_tool_schema, target=lambda args, session_id: update_order(args, session_id))
+    app = web.Application()
+    rtmt.attach_to_app(app, "/realtime")
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+    url = f"http://{host}:{port}/realtime"
+    flaky = rtmt.upstreams.endpoints[2]
+
+    try:
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as http:
+            failed = await run_phase("flaky down", http, url, servers, args.waves, args.clients)
+            print(f"  flaky: {servers['flaky'].rejected_connections} rejected handshakes, circuit "
+                  f"{'open' if flaky.is_open(time.monotonic()) else 'closed'}, cooldown {flaky.cooldown:.1f}s")
+
+            servers["flaky"].reject_status = None
+            await asyncio.sleep(max(0.0, flaky.open_until - time.monotonic()))
+            failed += await run_phase("flaky recovered", http, url, servers, args.waves, args.clients)
+            print(f"  flaky: circuit {'open' if flaky.is_open(time.monotonic()) else 'closed'}")
+            for upstream, label in zip(rtmt.upstreams.endpoints, servers):
+                print(f"  {label}: connect {upstream.connect_seconds * 1000:.1f}ms, "
+                      f"first token {(upstream.first_token_seconds or 0) * 1000:.0f}ms (moving averages)")
+    finally:
+        await runner.cleanup()
+        for server in servers.values():
+            await server.stop()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--waves", type=int, default=10)
+    parser.add_argument("--clients", type=int, default=20, help="concurrent clients per wave")
+    parser.add_argument("--cooldown", type=float, default=1.0, help="seconds an endpoint's circuit stays open at first")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,127 @@
+"""
+Audio kept from upstream by the middle tier's voice activity gate.
+
+Builds a kiosk session from coffeetest.wav: room noise while the customer
+reads the menu, the recording, a pause, the recording again and noise until
+the session ends, cut into the 100ms appends useRealtime sends. The gate is
+run over it directly, reporting the audio held back, the cost per frame and
+whether every frame of speech (and the pause after it that server turn
+detection needs) still went upstream. The same session is then streamed through
+the middle tier to a fake realtime server with the gate off and on.
+
+Usage (from app/backend):
+    python benchmarks/vad_savings.py [--menu-seconds 8] [--pause-seconds 4] [--noise-db -58]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+from audio_coalescing import SAMPLE_RATE, WAV_PATH, load_audio  # noqa: E402
+from azure.core.credentials import AzureKeyCredential  # noqa: E402
+from fake_realtime import FakeRealtimeServer  # noqa: E402
+
+from rtmt import RTMiddleTier  # noqa: E402
+from voice_activity import VoiceActivityGate  # noqa: E402
+
+FRAME_BYTES = 4800
+TURN_DETECTION = {"type": "server_vad", "threshold": 0.7, "prefix_padding_ms": 300, "silence_duration_ms": 500}
+
+
+def build_session(menu_seconds: float, pause_seconds: float, noise_db: float) -> tuple[list[str], list[bool]]:
+    """
+    Append frames of the session, and for each whether it holds speech.
+    """
+    rng = np.random.default_rng(7)
+    speech = np.frombuffer(load_audio(WAV_PATH, 60.0), dtype="<i2").astype(np.float32)
+
+    def noise(seconds: float) -> np.ndarray:
+        return rng.normal(0.0, 32768 * 10 ** (noise_db / 20), int(seconds * SAMPLE_RATE)).astype(np.float32)
+
+    parts = [(noise(menu_seconds), False), (speech, True), (noise(pause_seconds), False), (speech, True), (noise(3.0), False)]
+    frames, is_speech = [], []
+    for samples, speaking in parts:
+        pcm = np.clip(samples, -32768, 32767).astype("<i2").tobytes()
+        for offset in range(0, len(pcm) - FRAME_BYTES + 1, FRAME_BYTES):
+            chunk = pcm[offset:offset + FRAME_BYTES]
+            frames.append(json.dumps({"type": "input_audio_buffer.append", "audio": base64.b64encode(chunk).decode("ascii")}))
+            # The recording's own lead-in and tail are near silent, only frames well above the noise count as speech
+            level = 10 * np.log10(np.mean((np.frombuffer(chunk, dtype="<i2") / 32768.0) ** 2) + 1e-12)
+            is_speech.append(speaking and level > noise_db + 12)
+    return frames, is_speech
+
+
+def run_gate(frames: list[str], is_speech: list[bool]):
+    gate = VoiceActivityGate()
+    gate.follow_turn_detection(TURN_DETECTION)
+    forwarded = set()
+    # Both utterances are the same audio, so frames are told apart by identity
+    index_of = {id(frame): i for i, frame in enumerate(frames)}
+    start = time.perf_counter()
+    for frame in frames:
+        for sent in gate.process(frame):
+            forwarded.add(index_of[id(sent)])
+    elapsed = time.perf_counter() - start
+    gate.clear()
+    seconds = len(frames) * FRAME_BYTES / (2 * SAMPLE_RATE)
+    missed = [i for i, speaking in enumerate(is_speech) if speaking and i not in forwarded]
+    # Server turn detection needs the silence after the last word of each utterance
+    ends = [i for i in range(len(is_speech) - 1) if is_speech[i] and not any(is_speech[i + 1:i + 11])]
+    short_pauses = [i for i in ends if not all(j in forwarded for j in range(i + 1, min(i + 6, len(frames))))]
+    print(f"gate alone: {len(frames)} frames ({seconds:.1f}s), held back {gate.seconds_saved:.1f}s ({gate.seconds_saved / seconds:.0%}, "
+          f"{gate.bytes_saved / 1024:.0f} KiB of PCM), {elapsed / len(frames) * 1e6:.0f}us per frame")
+    print(f"  speech frames held back: {len(missed)} of {sum(is_speech)}, utterance ends without 500ms of trailing audio: {len(short_pauses)}")
+
+
+async def run_relay(frames: list[str], vad_enabled: bool) -> int:
+    server = FakeRealtimeServer(tool_name=None)
+    await server.start()
+    rtmt = RTMiddleTier(endpoint=server.endpoint, deployment="fake", credentials=AzureKeyCredential("fake"))
+    rtmt.vad_enabled = vad_enabled
+    app = web.Application()
+    rtmt.attach_to_app(app, "/realtime")
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+    try:
+        async with aiohttp.ClientSession() as http:
+            async with http.ws_connect(f"http://{host}:{port}/realtime") as ws:
+                await ws.receive()
+                await ws.send_json({"type": "session.update", "session": {"turn_detection": TURN_DETECTION}})
+                for frame in frames:
+                    await ws.send_str(frame)
+                await asyncio.sleep(0.2)
+        await asyncio.sleep(0.05)
+    finally:
+        await runner.cleanup()
+        await server.stop()
+    return server.audio_bytes_received
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--menu-seconds", type=float, default=8.0, help="noise before the customer speaks")
+    parser.add_argument("--pause-seconds", type=float, default=4.0, help="noise between the two utterances")
+    parser.add_argument("--noise-db", type=float, default=-58.0, help="room noise level in dBFS")
+    args = parser.parse_args()
+
+    frames, is_speech = build_session(args.menu_seconds, args.pause_seconds, args.noise_db)
+    run_gate(frames, is_speech)
+    without_gate = await run_relay(frames, False)
+    with_gate = await run_relay(frames, True)
+    print(f"through the middle tier: {without_gate / 1024:.0f} KiB of audio upstream without the gate, "
+          f"{with_gate / 1024:.0f} KiB with it ({1 - with_gate / without_gate:.0%} less)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,40 @@
+"""
+Gunicorn settings for serving the backend with one aiohttp worker per core, picked up from the working
+directory by `python -m gunicorn app:create_app`.
+
+Workers share nothing: gunicorn forks them before the app is loaded, so each builds its own app in
+create_app, with its own upstream connections, search clients and token cache. Order sessions are only
+shared when they are kept in Redis (ORDER_SESSION_STORE=redis), which is why a single worker is the
+default otherwise, a client that reconnects to another worker would lose its order. /metrics reports
+the worker that answers the scrape.
+
+On SIGHUP gunicorn starts new workers and stops the old ones, and on SIGTERM it stops all of them. A
+stopping worker closes its listening socket, lets each live conversation get to the end of its turn,
+then closes it so the client reconnects elsewhere and resumes its order (rtmt.drain_timeout).
+"""
+import multiprocessing
+import os
+import secrets
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+worker_class = "aiohttp.GunicornWebWorker"
+workers = int(os.environ.get("WEB_WORKERS") or (multiprocessing.cpu_count() if os.environ.get("ORDER_SESSION_STORE") == "redis" else 1))
+# Set SO_REUSEPORT on the listening socket, so a new gunicorn can bind the port while the old one drains
+reuse_port = True
+# Seconds a stopping worker gets before it is killed, longer than the realtime drain timeout
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT") or 30)
+
+# Workers inherit the environment, create_app reads the worker count from it and resume tokens must
+# verify on any worker
+os.environ["WEB_WORKERS"] = str(workers)
+_resume_secret_generated = not os.environ.get("ORDER_SESSION_RESUME_SECRET")
+if _resume_secret_generated:
+    os.environ["ORDER_SESSION_RESUME_SECRET"] = secrets.token_urlsafe(32)
+
+def when_ready(server):
+    if _resume_secret_generated and os.environ.get("ORDER_SESSION_STORE") == "redis":
+        server.log.warning("ORDER_SESSION_RESUME_SECRET is not set, so resume tokens only verify on this server's workers. "
+                           "Set it to the same value on every replica sharing the Redis store")
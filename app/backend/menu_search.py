@@ -0,0 +1,173 @@
+import difflib
+import json
+import logging
+import math
+import re
+import unicodedata
+from pathlib import Path
+from typing import Any, Optional
+
+from search_format import SnippetTable
+
+logger = logging.getLogger("coffee-chat")
+
+# Default location of the café menu, the same catalogue the frontend renders and the Azure index is built from
+DEFAULT_MENU_PATH = Path(__file__).resolve().parent.parent / "frontend" / "src" / "data" / "menuItems.json"
+
+# How much a query term matching each field counts towards an item's score
+FIELD_WEIGHTS = {
+    "name": 4.0,
+    "category": 2.0,
+    "description": 1.5,
+    "origin": 1.5,
+    "brewingMethod": 1.0,
+    "caffeineContent": 1.0,
+    "popularity": 0.5,
+    "longDescription": 0.5,
+}
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+# Misspelled terms are memoized, cleared when it grows past this many entries
+_FUZZY_CACHE_SIZE = 4096
+_STOP_WORDS = frozenset("a an and any are can do does for from have how i in is it me menu of on or please the there this to what which with you your".split())
+
+def _fold(text: str) -> str:
+    # Lowercase and strip accents so "Café" and "cafe" index the same
+    return unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii").lower()
+
+def _stem(token: str) -> str:
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+def tokenize(text: str) -> list[str]:
+    return [_stem(token) for token in _TOKEN_PATTERN.findall(_fold(text)) if token not in _STOP_WORDS]
+
+def _document_key(category: str, name: str) -> str:
+    # Same key scheme as the menu ingestion notebook so ids match the Azure index
+    return re.sub(r"[^a-zA-Z0-9_\-]", "_", f"{category}_{name.replace(' ', '_')}".lower())
+
+class MenuSearchIndex:
+    """
+    In-memory search over the café menu, a local stand-in for the Azure AI Search index.
+
+    Builds a weighted inverted index over the menu fields at load time, falls back to fuzzy
+    matching for misspelled terms and, when precomputed item embeddings are supplied, fills
+    the remaining result slots with the nearest neighbours of the lexical hits.
+    """
+    def __init__(self, documents: list[dict[str, Any]], embeddings: Any = None):
+        self.documents = documents
+        self.snippets = SnippetTable(documents)
+        self._postings: dict[str, list[tuple[int, float]]] = {}
+        self._name_tokens = [frozenset(tokenize(document["name"])) for document in documents]
+        self._name_vocabulary = sorted(set().union(*self._name_tokens))
+        self._fuzzy_cache: dict[str, Optional[str]] = {}
+        self._fuzzy_name_cache: dict[str, list[str]] = {}
+
+        for index, document in enumerate(documents):
+            weights: dict[str, float] = {}
+            for field, weight in FIELD_WEIGHTS.items():
+                for token in tokenize(document[field]):
+                    weights[token] = weights.get(token, 0.0) + weight
+            for token, weight in weights.items():
+                self._postings.setdefault(token, []).append((index, weight))
+
+        count = len(documents)
+        self._idf = {token: math.log(1 + count / len(postings)) for token, postings in self._postings.items()}
+        # Candidates for fuzzy matching, bucketed by first letter since typos rarely change it
+        self._vocabulary: dict[str, list[str]] = {}
+        for token in self._postings:
+            self._vocabulary.setdefault(token[0], []).append(token)
+
+        self._embeddings = None
+        if embeddings is not None:
+            import numpy as np
+            matrix = np.asarray(embeddings, dtype=np.float32)
+            if matrix.shape[0] != count:
+                raise ValueError(f"Expected {count} menu item embeddings, got {matrix.shape[0]}")
+            self._embeddings = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+    @classmethod
+    def from_file(cls, menu_path: str | Path = DEFAULT_MENU_PATH, embeddings_path: Optional[str | Path] = None) -> "MenuSearchIndex":
+        """
+        Load the menu JSON, and optionally a .npy matrix with one embedding row per item in menu order.
+        """
+        with open(menu_path, encoding="utf-8") as menu_file:
+            menu = json.load(menu_file)
+        documents = []
+        for category in menu["menuItems"]:
+            for item in category["items"]:
+                documents.append({
+                    "id": _document_key(category["category"], item["name"]),
+                    "category": category["category"],
+                    "name": item["name"],
+                    "description": item.get("description", ""),
+                    "longDescription": item.get("longDescription", ""),
+                    "origin": item.get("origin", ""),
+                    "caffeineContent": item.get("caffeineContent", ""),
+                    "brewingMethod": item.get("brewingMethod", ""),
+                    "popularity": item.get("popularity", ""),
+                    "sizes": json.dumps(item["sizes"]),
+                })
+        embeddings = None
+        if embeddings_path:
+            import numpy as np
+            embeddings = np.load(embeddings_path)
+        logger.info("Loaded %d menu items into the local search index from %s", len(documents), menu_path)
+        return cls(documents, embeddings)
+
+    def _resolve(self, token: str) -> Optional[str]:
+        if token in self._idf:
+            return token
+        if token not in self._fuzzy_cache:
+            if len(self._fuzzy_cache) >= _FUZZY_CACHE_SIZE:
+                self._fuzzy_cache.clear()
+            matches = difflib.get_close_matches(token, self._vocabulary.get(token[0], []), n=1, cutoff=0.8)
+            self._fuzzy_cache[token] = matches[0] if matches else None
+        return self._fuzzy_cache[token]
+
+    def _name_matches(self, token: str) -> list[str]:
+        if token not in self._fuzzy_name_cache:
+            if len(self._fuzzy_name_cache) >= _FUZZY_CACHE_SIZE:
+                self._fuzzy_name_cache.clear()
+            self._fuzzy_name_cache[token] = difflib.get_close_matches(token, self._name_vocabulary, n=3, cutoff=0.8)
+        return self._fuzzy_name_cache[token]
+
+    def search(self, query: str, top: int = 5, query_vector: Any = None) -> list[dict[str, Any]]:
+        tokens = tokenize(query)
+        scores: dict[int, float] = {}
+        for token in tokens:
+            resolved = self._resolve(token)
+            if resolved is None:
+                continue
+            idf = self._idf[resolved]
+            for index, weight in self._postings[resolved]:
+                scores[index] = scores.get(index, 0.0) + idf * weight
+
+        # Mentioning every word of an item's name, allowing for typos, outranks any number of partial matches
+        name_terms = {match for token in tokens for match in self._name_matches(token)}
+        for index, name_tokens in enumerate(self._name_tokens):
+            if name_tokens and name_tokens <= name_terms:
+                scores[index] = scores.get(index, 0.0) + 100.0
+
+        ranked = sorted(scores, key=scores.__getitem__, reverse=True)
+        if self._embeddings is not None:
+            ranked = self._rank_with_embeddings(ranked, scores, top, query_vector)
+        return [self.documents[index] for index in ranked[:top]]
+
+    def _rank_with_embeddings(self, ranked: list[int], scores: dict[int, float], top: int, query_vector: Any) -> list[int]:
+        import numpy as np
+        if query_vector is not None:
+            vector = np.asarray(query_vector, dtype=np.float32)
+            similarities = self._embeddings @ (vector / np.linalg.norm(vector))
+            best = max(scores.values(), default=0.0) or 1.0
+            hybrid = {index: similarities[index] + scores.get(index, 0.0) / best for index in range(len(self.documents))}
+            return sorted(hybrid, key=hybrid.__getitem__, reverse=True)
+        if not ranked or len(ranked) >= top:
+            return ranked
+        # No query embedding available offline, so use the lexical hits as the query in embedding space
+        hits = ranked[:top]
+        centroid = np.average(self._embeddings[hits], axis=0, weights=[scores[index] for index in hits])
+        similarities = self._embeddings @ centroid
+        neighbours = [int(index) for index in np.argsort(-similarities) if int(index) not in scores]
+        return ranked + neighbours
@@ -0,0 +1,139 @@
+import bisect
+import threading
+from typing import Optional
+
+from aiohttp import web
+
+# Latency buckets in seconds, tuned for realtime voice turns (tens of ms up to several seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metric:
+    kind: str
+    name: str
+    description: str
+    labels: dict[str, str]
+
+    def __init__(self, name: str, description: str, labels: Optional[dict[str, str]] = None):
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+
+    def _label_text(self, extra: Optional[dict[str, str]] = None) -> str:
+        labels = {**self.labels, **(extra or {})}
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: Optional[dict[str, str]] = None):
+        super().__init__(name, description, labels)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{self._label_text()} {self.value}"]
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels: Optional[dict[str, str]] = None):
+        super().__init__(name, description, labels)
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{self._label_text()} {self.value}"]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: Optional[dict[str, str]] = None, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        # One slot per bucket plus +Inf, kept non-cumulative so observe() is a single increment
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{self._label_text({'le': str(bound)})} {cumulative}")
+        lines.append(f"{self.name}_bucket{self._label_text({'le': '+Inf'})} {self.count}")
+        lines.append(f"{self.name}_sum{self._label_text()} {self.sum}")
+        lines.append(f"{self.name}_count{self._label_text()} {self.count}")
+        return lines
+
+class MetricsRegistry:
+    """
+    Process-wide collection of metrics. Lookups happen once at setup time; the returned
+    objects are then updated directly on hot paths.
+    """
+    def __init__(self):
+        self._metrics: dict[tuple, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls: type, name: str, description: str, labels: Optional[dict[str, str]], **kwargs) -> Metric:
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = cls(name, description, labels, **kwargs)
+                self._metrics[key] = metric
+            return metric
+
+    def counter(self, name: str, description: str, labels: Optional[dict[str, str]] = None) -> Counter:
+        return self._get_or_create(Counter, name, description, labels)
+
+    def gauge(self, name: str, description: str, labels: Optional[dict[str, str]] = None) -> Gauge:
+        return self._get_or_create(Gauge, name, description, labels)
+
+    def histogram(self, name: str, description: str, labels: Optional[dict[str, str]] = None, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, description, labels, buckets=buckets)
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        described = set()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in sorted(metrics, key=lambda m: m.name):
+            if metric.name not in described:
+                lines.append(f"# HELP {metric.name} {metric.description}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                described.add(metric.name)
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    async def _metrics_handler(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    def attach_to_app(self, app: web.Application, path: str = "/metrics"):
+        app.router.add_get(path, self._metrics_handler)
+
+# Shared registry for the backend
+metrics_registry = MetricsRegistry()
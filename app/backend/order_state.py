@@ -1,77 +1,140 @@
-from typing import List, Dict
-from models import OrderItem, OrderSummary
+import asyncio
+import base64
+import hashlib
+import hmac
 import logging
+import secrets
 import uuid
+from collections import OrderedDict
+from itertools import islice
+from typing import Optional
+
+from aiohttp import web
+
+from metrics import metrics_registry
+from models import OrderSummary
+from session_store import InMemorySessionStore, SessionStore, format_display
 
 logger = logging.getLogger("order_state")
 
+_live_sessions = metrics_registry.gauge("order_sessions_live", "Order sessions held by this worker's session store")
+_session_memory = metrics_registry.gauge("order_session_memory_bytes", "Approximate bytes held per live order session, sampled from recently active sessions")
+
 class OrderState:
     _instance = None
 
+    # Seconds a session is kept after its client disconnects, so a reconnecting client can pick it up again
+    close_grace: float = 0
+    # Signs resume tokens, every worker that shares a session store needs the same secret
+    resume_secret: bytes = secrets.token_bytes(32)
+    # How often the sweeper runs and the most sessions it removes, and touches, per run, so one tick never
+    # stalls the loop. Connected sessions are touched in rotation, so each one is touched within the idle
+    # timeout while a worker has fewer than sweep_batch * idle_ttl / sweep_interval of them (60,000 by default)
+    sweep_interval: float = 30
+    sweep_batch: int = 1000
+
     def __new__(cls):
         if cls._instance is None:
-            cls._instance = super(OrderState, cls).__new__(cls)
-            cls._instance.sessions = {}
+            cls._instance = super().__new__(cls)
+            cls._instance.store = InMemorySessionStore()
+            # Sessions with a client connected to this worker, kept from expiring until they are closed,
+            # least recently touched first
+            cls._instance._connected = OrderedDict()
+            cls._instance._sweep_task = None
         return cls._instance
 
-    def _update_summary(self, session_id: str):
-        session = self.sessions[session_id]
-        total = sum(item.price * item.quantity for item in session["order_state"])
-        tax = total * 0.08  # 8% tax
-        finalTotal = total + tax
-        session["order_summary"] = OrderSummary(items=session["order_state"], total=total, tax=tax, finalTotal=finalTotal)
-        logger.info(f"Order Summary Updated for session {session_id}: {session['order_summary']}")
+    def use_store(self, store: SessionStore):
+        """
+        Keep sessions in the given store, e.g. a RedisSessionStore shared by every worker.
+        """
+        self.store = store
 
-    def create_session(self) -> str:
+    async def create_session(self) -> str:
         session_id = str(uuid.uuid4())
-        self.sessions[session_id] = {
-            "order_state": [],
-            "order_summary": OrderSummary(items=[], total=0.0, tax=0.0, finalTotal=0.0)
-        }
-        self._update_summary(session_id)
-        logger.info(f"Session created with ID {session_id}")
+        await self.store.create(session_id)
+        self._connected[session_id] = None
+        logger.info("Session created with ID %s", session_id)
+        return session_id
+
+    def issue_resume_token(self, session_id: str) -> str:
+        """
+        A token the client presents when it reconnects to get this session back, the session id
+        plus a signature so a client can't take over another client's order by guessing ids.
+        """
+        return f"{session_id}.{self._sign(session_id)}"
+
+    def _sign(self, session_id: str) -> str:
+        digest = hmac.new(self.resume_secret, session_id.encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:18]).decode()
+
+    async def resume_session(self, resume_token: str) -> Optional[str]:
+        """
+        Return the session id the token was issued for if that session can still be resumed, otherwise None.
+        """
+        session_id, _, signature = resume_token.partition(".")
+        if not signature or not hmac.compare_digest(signature.encode(), self._sign(session_id).encode()):
+            return None
+        if not await self.store.resume(session_id):
+            return None
+        self._connected[session_id] = None
+        logger.info("Session %s resumed", session_id)
         return session_id
 
-    def handle_order_update(self, session_id: str, action: str, item_name: str, size: str, quantity: int, price: float):
-        session = self.sessions[session_id]
-        order_state = session["order_state"]
-
-        formatted_size = ""
-        if size.lower() == "standard":
-            formatted_size = ""
-        elif size.lower() == "kannchen":
-            formatted_size = "Kannchen of "
-        elif size.lower() == "pot":
-            formatted_size = "Pot of "
-        else:
-            formatted_size = f"{size.capitalize()} "
-
-        display = f"{formatted_size}{item_name}".strip()
-
-        existing_item_index = next((index for index, order_item in enumerate(order_state) if order_item.item == item_name and order_item.size == size), -1)
-
-        if action == "add":
-            if existing_item_index != -1:
-                order_state[existing_item_index].quantity += quantity
-                logger.info(f"Updated quantity for {display} in session {session_id}")
-            else:
-                order_state.append(OrderItem(item=item_name, size=size, quantity=quantity, price=price, display=display))
-                logger.info(f"Added {display} to session {session_id}")
-        elif action == "remove":
-            if existing_item_index != -1:
-                if order_state[existing_item_index].quantity > quantity:
-                    order_state[existing_item_index].quantity -= quantity
-                    logger.info(f"Decreased quantity for {display} in session {session_id}")
-                else:
-                    order_state.pop(existing_item_index)
-                    logger.info(f"Removed {display} from session {session_id}")
-
-        self._update_summary(session_id)
-
-    def get_order_summary(self, session_id: str) -> OrderSummary:
-        order_summary = self.sessions[session_id]["order_summary"]
-        logger.info(f"Order Summary Retrieved for session {session_id}: {order_summary}")
-        return order_summary
+    async def close_session(self, session_id: str):
+        """
+        Called when the session's client disconnects. The session is removed now, or after close_grace seconds.
+        """
+        self._connected.pop(session_id, None)
+        await self.store.release(session_id, self.close_grace)
+
+    async def handle_order_update(self, session_id: str, action: str, item_name: str, size: str, quantity: int, price: float):
+        change = await self.store.update(session_id, action, item_name, size, quantity, price)
+        if change is not None:
+            logger.info("%s %s", change, format_display(item_name, size), extra={"event": "order.change", "session_id": session_id})
+
+    async def get_order_summary(self, session_id: str) -> OrderSummary:
+        return await self.store.summary(session_id)
+
+    async def get_order_summary_json(self, session_id: str) -> str:
+        return await self.store.summary_json(session_id)
+
+    async def sweep(self) -> int:
+        # A connected client may go longer than the idle timeout without changing its order
+        touched = list(islice(self._connected, self.sweep_batch))
+        for session_id in touched:
+            self._connected.move_to_end(session_id)
+        await self.store.touch(touched)
+        removed = await self.store.sweep(self.sweep_batch)
+        if (live := self.store.live_sessions()) is not None:
+            _live_sessions.set(live)
+        if (memory := self.store.memory_per_session()) is not None:
+            _session_memory.set(memory)
+        if removed:
+            logger.info("Expired %d order sessions", removed)
+        return removed
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                removed = await self.sweep()
+            except Exception:
+                logger.exception("Order session sweep failed")
+                removed = 0
+            # A full batch means there is a backlog, yield to the loop and keep going instead of waiting a whole interval
+            await asyncio.sleep(0 if removed >= self.sweep_batch else self.sweep_interval)
+
+    def attach_to_app(self, app: web.Application):
+        async def on_startup(_):
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+        async def on_cleanup(_):
+            if self._sweep_task is not None:
+                self._sweep_task.cancel()
+                self._sweep_task = None
+            await self.store.close()
+
+        app.on_startup.append(on_startup)
+        app.on_cleanup.append(on_cleanup)
 
 # Create a singleton instance of OrderState
-order_state_singleton = OrderState()
\ No newline at end of file
+order_state_singleton = OrderState()
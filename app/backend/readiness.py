@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable, Callable
+
+from aiohttp import web
+
+from metrics import metrics_registry
+
+logger = logging.getLogger("coffee-chat")
+
+_warm_up_seconds = metrics_registry.gauge("app_warm_up_seconds", "Time from app startup until every warm-up step finished and the readiness probe passed")
+
+class ReadinessProbe:
+    """
+    Whether this worker is ready to take traffic. Work a worker needs done before serving customers,
+    like fetching the first bearer tokens or loading an SDK, is registered with warm_up and runs in
+    the background once the app starts, so the worker listens right away and the load balancer waits
+    on the probe instead. A failed warm-up step is retried until it succeeds.
+    """
+    retry_interval: float = 5
+
+    def __init__(self):
+        self._warm_ups: dict[str, Callable[[], Awaitable]] = {}
+        self._pending: set[str] = set()
+        self._tasks: list[asyncio.Task] = []
+        self._started_at = 0.0
+
+    def warm_up(self, name: str, warm: Callable[[], Awaitable]):
+        """
+        Run warm when the app starts and hold the probe back until it has succeeded.
+        """
+        self._warm_ups[name] = warm
+
+    @property
+    def ready(self) -> bool:
+        return not self._pending
+
+    async def _run(self, name: str, warm: Callable[[], Awaitable]):
+        while True:
+            try:
+                await warm()
+                break
+            except Exception as e:
+                logger.warning("Warm-up step %s failed, retrying in %.0fs: %s", name, self.retry_interval, e)
+                await asyncio.sleep(self.retry_interval)
+        self._pending.discard(name)
+        if not self._pending:
+            elapsed = time.monotonic() - self._started_at
+            _warm_up_seconds.set(elapsed)
+            logger.info("Ready to serve, warm-up took %.2fs", elapsed)
+
+    async def _handler(self, request: web.Request) -> web.Response:
+        if self._pending:
+            return web.json_response({"status": "warming_up", "waiting_for": sorted(self._pending)}, status=503)
+        return web.json_response({"status": "ready"})
+
+    def attach_to_app(self, app: web.Application, path: str = "/ready"):
+        async def on_startup(_):
+            self._started_at = time.monotonic()
+            self._pending = set(self._warm_ups)
+            self._tasks = [asyncio.create_task(self._run(name, warm)) for name, warm in self._warm_ups.items()]
+
+        async def on_cleanup(_):
+            for task in self._tasks:
+                task.cancel()
+            self._tasks = []
+            # The next app registers its own warm-ups
+            self._warm_ups.clear()
+
+        app.router.add_get(path, self._handler)
+        app.on_startup.append(on_startup)
+        app.on_cleanup.append(on_cleanup)
+
+readiness_probe = ReadinessProbe()
@@ -1,18 +1,264 @@
 import asyncio
+import base64
 import json
 import logging
+import re
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
 from enum import Enum
-from typing import Any, Callable, Optional
+from typing import Any, Optional
 
 import aiohttp
 from aiohttp import web
-from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from azure.core.credentials import AzureKeyCredential, TokenCredential
 
+from metrics import metrics_registry
 from order_state import order_state_singleton  # Import the order state singleton
+from structured_logging import session_id_var
+from token_cache import TokenCache
+from upstream_pool import UpstreamEndpoint, UpstreamPool
+from voice_activity import VoiceActivityGate
 
 logger = logging.getLogger("coffee-chat")
 
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+_upstream_connect_seconds = metrics_registry.histogram("rtmt_upstream_connect_seconds", "Time to open a realtime websocket to Azure OpenAI")
+_warm_pool_hits = metrics_registry.counter("rtmt_warm_pool_hits_total", "Client connections served from the warm upstream pool")
+_warm_pool_misses = metrics_registry.counter("rtmt_warm_pool_misses_total", "Client connections that had to open an upstream socket")
+_time_to_first_audio = metrics_registry.histogram("rtmt_time_to_first_audio_seconds", "Time from client connect until its first audio frame is sent upstream")
+_sessions_resumed = metrics_registry.counter("rtmt_sessions_resumed_total", "Client connections that reattached to an existing order session")
+_reconnect_to_first_audio = metrics_registry.histogram("rtmt_reconnect_to_first_audio_seconds", "Time from a resumed client connect until the first response audio is relayed to it")
+_audio_appends_coalesced = metrics_registry.counter("rtmt_audio_appends_coalesced_total", "Client input_audio_buffer.append frames merged into the upstream frame before them")
+_audio_coalesce_wait = metrics_registry.histogram("rtmt_audio_coalesce_wait_seconds", "Time audio was held back waiting for more frames to merge with")
+_slow_client_disconnects = metrics_registry.counter("rtmt_relay_slow_client_disconnects_total", "Clients disconnected for falling too far behind the relay")
+_active_connections = metrics_registry.gauge("rtmt_active_connections", "Client websockets currently connected to the middle tier")
+_drained_connections = {
+    outcome: metrics_registry.counter("rtmt_drained_connections_total", "Client websockets closed by a worker shutting down, between turns (idle) or when the drain timed out", {"outcome": outcome})
+    for outcome in ("idle", "timeout")
+}
+_speech_to_first_audio = metrics_registry.histogram("rtmt_speech_stopped_to_first_audio_seconds", "Time from the end of the customer's speech (or a manual commit) until the first response audio reaches the client")
+
+def _tool_call_seconds(tool: str, outcome: str):
+    return metrics_registry.histogram("rtmt_tool_call_seconds", "Time from dispatching a tool call until its output is ready", {"tool": tool, "outcome": outcome})
+
+# Byte buckets for per-connection queue high-water marks, 4 KiB up to 8 MiB
+_QUEUE_BYTE_BUCKETS = (4096, 16384, 65536, 262144, 1048576, 2097152, 4194304, 8388608)
+_queued_bytes = {direction: metrics_registry.gauge("rtmt_relay_queued_bytes", "Frames buffered in the relay waiting for the receiving socket, across connections", {"direction": direction})
+                 for direction in ("to_server", "to_client")}
+_queue_high_water = {direction: metrics_registry.histogram("rtmt_relay_queue_high_water_bytes", "Most bytes a connection had buffered in the relay at once", {"direction": direction}, buckets=_QUEUE_BYTE_BUCKETS)
+                     for direction in ("to_server", "to_client")}
+_frames_dropped = {direction: metrics_registry.counter("rtmt_relay_frames_dropped_total", "Stale frames dropped because the receiving socket fell behind", {"direction": direction})
+                   for direction in ("to_server", "to_client")}
+_frames_coalesced = {direction: metrics_registry.counter("rtmt_relay_frames_coalesced_total", "Delta frames merged into an earlier queued frame because the receiving socket fell behind", {"direction": direction})
+                     for direction in ("to_server", "to_client")}
+_relay_frames = {direction: metrics_registry.counter("rtmt_relay_frames_total", "Text frames received for relaying", {"direction": direction})
+                 for direction in ("to_server", "to_client")}
+_relay_bytes = {direction: metrics_registry.counter("rtmt_relay_bytes_total", "Bytes of text frames received for relaying", {"direction": direction})
+                for direction in ("to_server", "to_client")}
+# Microsecond-scale buckets for the middle tier's own work on each frame, 10us up to 10ms
+_RELAY_OVERHEAD_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+_relay_overhead = {direction: metrics_registry.histogram("rtmt_relay_frame_processing_seconds", "Time the middle tier spends inspecting and rewriting each frame, excluding waits on the sockets", {"direction": direction}, buckets=_RELAY_OVERHEAD_BUCKETS)
+                   for direction in ("to_server", "to_client")}
+
+# Event types the middle tier rewrites or consumes. Every other frame from the server (audio deltas,
+# transcripts, ...) is relayed byte-for-byte when the fast path is enabled.
+_CLIENT_BOUND_REWRITE_TYPES = frozenset({
+    "session.created",
+    "response.output_item.added",
+    "conversation.item.created",
+    "response.function_call_arguments.delta",
+    "response.function_call_arguments.done",
+    "response.output_item.done",
+    "response.done",
+})
+
+# Server events that start a turn's wait for the model, and the deltas that end it
+_TURN_START_TYPES = frozenset({
+    "input_audio_buffer.commit",
+    "input_audio_buffer.committed",
+    "response.create",
+})
+_FIRST_TOKEN_TYPES = frozenset({
+    "response.audio.delta",
+    "response.audio_transcript.delta",
+    "response.text.delta",
+})
+
+# Both the realtime API and the frontend serialize "type" as the first key, so it can be read
+# from the head of the frame without decoding the (mostly base64 audio) remainder.
+_LEADING_TYPE_PATTERN = re.compile(r'\s*\{\s*"type"\s*:\s*"([^"\\]*)"')
+
+def peek_message_type(data: str) -> Optional[str]:
+    """
+    Return the event type of a realtime frame if it is the leading key, otherwise None.
+    """
+    match = _LEADING_TYPE_PATTERN.match(data)
+    return match.group(1) if match else None
+
+# Client frames are untrusted, so the only ones relayed without parsing are audio appends shaped like
+# the frontend's, type then audio, where nothing could be read as a second "type" by a JSON parser
+_PLAIN_AUDIO_APPEND_PATTERN = re.compile(r'\s*\{\s*"type"\s*:\s*"input_audio_buffer\.append"\s*,\s*"audio"\s*:\s*"')
+
+def is_plain_audio_append(data: str) -> bool:
+    """
+    Whether a client frame is an input_audio_buffer.append with no escapes and no "type" key after
+    its audio, so the leading type is the one the realtime API reads.
+    """
+    match = _PLAIN_AUDIO_APPEND_PATTERN.match(data)
+    if match is None or "\\" in data:
+        return False
+    # Base64 has no quotes, so the audio ends at the next one and only the keys after it are left
+    end = data.find('"', match.end())
+    return end != -1 and '"type"' not in data[end + 1:]
+
+# Frames a client that falls behind can lose or have merged without harm: each transcript is sent
+# again in full by its response.audio_transcript.done
+_DROPPABLE_TYPES = frozenset({
+    "response.audio_transcript.delta",
+})
+_COALESCIBLE_TYPES = frozenset({
+    "response.audio_transcript.delta",
+    "response.text.delta",
+})
+
+class RelayOverflowPolicy(Enum):
+    # Drop the queued transcript deltas, then wait for the socket to catch up
+    DROP = "drop"
+    # Merge the queued deltas of each transcript into one frame, then wait for the socket to catch up
+    COALESCE = "coalesce"
+    # Disconnect the client
+    DISCONNECT = "disconnect"
+
+class RelayQueue:
+    """
+    Bounded buffer of frames between the socket one direction of the relay reads from and the one
+    it writes to, so a slow receiver doesn't stall the reader until max_bytes are waiting. Past
+    that the policy applies, and put() waits for the writer to drain the queue below max_bytes
+    unless the policy disconnected the connection.
+    """
+    def __init__(self, direction: str, max_bytes: int = 2 * 1024 * 1024, policy: RelayOverflowPolicy = RelayOverflowPolicy.COALESCE):
+        self.direction = direction
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.high_water = 0
+        self.overflowed = False
+        self._frames: deque[tuple[Optional[str], str]] = deque()
+        self._bytes = 0
+        self._closed = False
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    @property
+    def queued_bytes(self) -> int:
+        return self._bytes
+
+    def _set_frames(self, frames: deque[tuple[Optional[str], str]]):
+        queued = sum(len(data) for _, data in frames)
+        _queued_bytes[self.direction].inc(queued - self._bytes)
+        self._frames = frames
+        self._bytes = queued
+
+    def _drop_stale(self):
+        frames = deque(frame for frame in self._frames if frame[0] not in _DROPPABLE_TYPES)
+        _frames_dropped[self.direction].inc(len(self._frames) - len(frames))
+        self._set_frames(frames)
+
+    def _coalesce(self):
+        frames: list[list] = []
+        # (type, item id, content index) -> index in frames of the delta that absorbs the later ones
+        targets: dict[tuple, int] = {}
+        coalesced = 0
+        for message_type, data in self._frames:
+            if message_type in _COALESCIBLE_TYPES:
+                event = json.loads(data)
+                key = (message_type, event.get("item_id"), event.get("content_index"))
+                if key in targets:
+                    frames[targets[key]][1]["delta"] += event.get("delta", "")
+                    coalesced += 1
+                    continue
+                targets[key] = len(frames)
+                frames.append([message_type, event])
+            else:
+                frames.append([message_type, data])
+        if coalesced:
+            _frames_coalesced[self.direction].inc(coalesced)
+            self._set_frames(deque((message_type, data if isinstance(data, str) else json.dumps(data)) for message_type, data in frames))
+
+    async def put(self, data: str) -> bool:
+        """
+        Queue a frame, returns False if the queue is closed, e.g. because the policy disconnected the connection.
+        """
+        if self._closed:
+            return False
+        self._frames.append((peek_message_type(data), data))
+        self._bytes += len(data)
+        _queued_bytes[self.direction].inc(len(data))
+        self.high_water = max(self.high_water, self._bytes)
+        self._not_empty.set()
+        if self._bytes > self.max_bytes:
+            if self.policy is RelayOverflowPolicy.DISCONNECT:
+                self.overflowed = True
+                self.close(discard=True)
+                return False
+            if self.policy is RelayOverflowPolicy.DROP:
+                self._drop_stale()
+            else:
+                self._coalesce()
+        while self._bytes > self.max_bytes and not self._closed:
+            self._not_full.clear()
+            await self._not_full.wait()
+        return not self._closed
+
+    async def get(self) -> Optional[str]:
+        """
+        Next frame to send, or None once the queue is closed and drained.
+        """
+        while not self._frames:
+            if self._closed:
+                return None
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        return self._pop()
+
+    async def get_if(self, message_type: str, timeout: float) -> Optional[str]:
+        """
+        Next frame if it is of message_type, waiting up to timeout seconds for one to be queued. Returns
+        None, leaving the queue as it is, when the next frame is of another type or none arrives in time.
+        """
+        if not self._frames and not self._closed and timeout > 0:
+            self._not_empty.clear()
+            try:
+                await asyncio.wait_for(self._not_empty.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if not self._frames or self._frames[0][0] != message_type:
+            return None
+        return self._pop()
+
+    def _pop(self) -> str:
+        _, data = self._frames.popleft()
+        self._bytes -= len(data)
+        _queued_bytes[self.direction].dec(len(data))
+        if self._bytes <= self.max_bytes:
+            self._not_full.set()
+        return data
+
+    def close(self, discard: bool = False):
+        """
+        Stop accepting frames; the writer still drains what is queued unless discard is set.
+        """
+        self._closed = True
+        if discard:
+            self._set_frames(deque())
+        self._not_empty.set()
+        self._not_full.set()
+
 class ToolResultDirection(Enum):
     TO_SERVER = 1
     TO_CLIENT = 2
@@ -33,10 +279,13 @@ class ToolResult:
 class Tool:
     target: Callable[..., ToolResult]
     schema: Any
+    # Seconds before a call is abandoned, falls back to RTMiddleTier.tool_timeout when None
+    timeout: Optional[float]
 
-    def __init__(self, target: Any, schema: Any):
+    def __init__(self, target: Any, schema: Any, timeout: Optional[float] = None):
         self.target = target
         self.schema = schema
+        self.timeout = timeout
 
 class RTToolCall:
     tool_call_id: str
@@ -46,6 +295,112 @@ class RTToolCall:
         self.tool_call_id = tool_call_id
         self.previous_id = previous_id
 
+class RTToolExecutor:
+    """
+    Runs the tool calls of one realtime connection as background tasks so the relay keeps
+    streaming server frames while tools execute. Calls are grouped by the response that made
+    them, and a response's outputs are delivered only once all of its calls have finished.
+    """
+    def __init__(self, max_concurrency: int):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._pending: dict[Optional[str], list[asyncio.Task]] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def _spawn(self, coro: Awaitable) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _limited(self, coro: Awaitable) -> Any:
+        async with self._semaphore:
+            return await coro
+
+    def submit(self, response_id: Optional[str], coro: Awaitable) -> None:
+        self._pending.setdefault(response_id, []).append(self._spawn(self._limited(coro)))
+
+    def complete_response(self, response_id: Optional[str], on_done: Callable[[list[Any]], Awaitable]) -> bool:
+        """
+        Schedule on_done with the results of every call made by the response, returns False if it made none.
+        """
+        tasks = self._pending.pop(response_id, None)
+        if not tasks:
+            return False
+        self._spawn(self._finish(tasks, on_done))
+        return True
+
+    async def _finish(self, tasks: list[asyncio.Task], on_done: Callable[[list[Any]], Awaitable]):
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error("Tool call failed: %s", result)
+        try:
+            await on_done([result for result in results if not isinstance(result, BaseException)])
+        except ConnectionResetError:
+            # The upstream socket went away while the tools were running
+            pass
+
+    @property
+    def busy(self) -> bool:
+        # Includes a response's tool calls until their outputs are queued upstream
+        return bool(self._tasks)
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+        self._pending.clear()
+
+class RTSession:
+    """
+    State owned by a single client websocket: its order session, the upstream realtime socket,
+    the relay queues towards each socket, tool calls in flight and relay counters.
+    """
+    def __init__(self, client_ws: web.WebSocketResponse, order_session_id: str, tool_concurrency: int, resumed: bool = False,
+                 to_server: Optional[RelayQueue] = None, to_client: Optional[RelayQueue] = None):
+        self.client_ws = client_ws
+        self.order_session_id = order_session_id
+        self.resumed = resumed
+        self.server_ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self.upstream: Optional[UpstreamEndpoint] = None
+        # When the current turn started waiting on the model, for the upstream's time to first token
+        self.turn_started_at: Optional[float] = None
+        # When the customer stopped speaking, until the response audio reaches them
+        self.speech_stopped_at: Optional[float] = None
+        # Whether the upstream has heard the customer start speaking, and is producing a response
+        self.speaking = False
+        self.responding = False
+        self.to_server = to_server if to_server is not None else RelayQueue("to_server")
+        self.to_client = to_client if to_client is not None else RelayQueue("to_client")
+        self.tools_pending: dict[str, RTToolCall] = {}
+        self.tool_executor = RTToolExecutor(tool_concurrency)
+        self.frames_to_server = 0
+        self.frames_to_client = 0
+        self.connected_at = time.monotonic()
+        self.first_audio_forwarded = False
+        self.first_response_audio_relayed = False
+        # When the client last sent audio and how long it waited before that, for audio coalescing
+        self.last_audio_at = 0.0
+        self.audio_gap = float("inf")
+        # Holds back the client's silent audio when the middle tier runs voice activity detection
+        self.voice_activity: Optional[VoiceActivityGate] = None
+
+    def is_idle(self) -> bool:
+        """
+        Whether the conversation is between turns: the customer isn't speaking, nothing is waiting on
+        the model and no response or tool call is under way.
+        """
+        return not (self.speaking or self.responding or self.tool_executor.busy) \
+            and self.turn_started_at is None and self.speech_stopped_at is None
+
+    def close(self):
+        self.tool_executor.cancel()
+        self.tools_pending.clear()
+        for queue in (self.to_server, self.to_client):
+            queue.close(discard=True)
+            _queue_high_water[queue.direction].observe(queue.high_water)
+        if self.voice_activity is not None:
+            self.voice_activity.close(self.order_session_id)
+
 class RTMiddleTier:
     endpoint: str
     deployment: str
@@ -53,7 +408,7 @@ class RTMiddleTier:
     
     # Tools are server-side only for now, though the case could be made for client-side tools
     # in addition to server-side tools that are invisible to the client
-    tools: dict[str, Tool] = {}
+    tools: dict[str, Tool]
 
     # Server-enforced configuration, if set, these will override the client's configuration
     # Typically at least the model name and system message will be set by the server
@@ -64,37 +419,141 @@ class RTMiddleTier:
     disable_audio: Optional[bool] = None
     voice_choice: Optional[str] = None
     api_version: str = "2024-10-01-preview"
-    _tools_pending = {}
-    _token_provider = None
-    _session_map = {}
+    # Relay frames the middle tier never rewrites without parsing them as JSON
+    fast_path: bool = True
+    # Maximum tool calls running at once per connection, and default per-call timeout in seconds
+    tool_concurrency: int = 4
+    tool_timeout: Optional[float] = 30.0
+    # Shared upstream connector tuning. Every client holds an upstream socket for its whole conversation,
+    # so the connection limit is also the most conversations a process serves at once
+    upstream_connection_limit: int = 1000
+    upstream_keepalive_timeout: float = 30.0
+    upstream_dns_cache_ttl: int = 300
+    # Number of pre-opened upstream realtime sockets kept ready for new clients (0 disables the pool),
+    # and how long in seconds an idle pooled socket is kept before it is recycled
+    warm_pool_size: int = 0
+    warm_pool_max_age: float = 60.0
+    # Relay counters are updated and a frame's processing time sampled every nth frame, doing it for every
+    # frame would cost more than most frames take to process
+    frame_metrics_interval: int = 8
+    # Seconds before a connect to an upstream endpoint is given up on and the next one is tried
+    upstream_connect_timeout: float = 10.0
+    # Bytes buffered per connection towards each socket before the overflow policy applies; the
+    # policy only matters towards the client, a slow upstream always just slows the client down
+    server_queue_bytes: int = 1024 * 1024
+    client_queue_bytes: int = 2 * 1024 * 1024
+    slow_client_policy: RelayOverflowPolicy = RelayOverflowPolicy.COALESCE
+    # Merge consecutive input_audio_buffer.append frames from a client into upstream frames of up to
+    # this many bytes of audio (0 disables), waiting at most audio_coalesce_window seconds for more
+    audio_coalesce_bytes: int = 0
+    audio_coalesce_window: float = 0.02
+    # Hold back silent PCM16 client audio instead of forwarding it (needs NumPy). The last vad_pre_roll
+    # seconds of silence go up ahead of speech and vad_hangover seconds follow it, at least as much as
+    # the session's server turn detection pads and waits for
+    vad_enabled: bool = False
+    vad_pre_roll: float = 0.3
+    vad_hangover: float = 1.0
+    vad_margin_db: float = 10.0
+    # Seconds a shutting down worker waits for each live conversation to get between turns before closing
+    # its socket, the client then reconnects to another worker with its resume token
+    drain_timeout: float = 20.0
+    _token_cache: Optional[TokenCache] = None
+    _owns_token_cache: bool = False
 
-    def __init__(self, endpoint: str, deployment: str, credentials: AzureKeyCredential | DefaultAzureCredential, voice_choice: Optional[str] = None):
+    def __init__(self, endpoint: str, deployment: str, credentials: AzureKeyCredential | TokenCredential | TokenCache, voice_choice: Optional[str] = None):
         self.endpoint = endpoint
         self.deployment = deployment
         self.voice_choice = voice_choice
+        self.tools = {}
+        # The endpoint and deployment given here are the first of the upstreams, add_upstream adds more
+        self.upstreams = UpstreamPool([UpstreamEndpoint(endpoint, deployment)])
+        # Live connections keyed by order session id
+        self._sessions: dict[str, RTSession] = {}
+        self._http_session: Optional[aiohttp.ClientSession] = None
+        self._warm_pool: deque[tuple[float, aiohttp.ClientWebSocketResponse, UpstreamEndpoint]] = deque()
+        self._warm_pool_wakeup = asyncio.Event()
+        self._warm_pool_task: Optional[asyncio.Task] = None
         if voice_choice is not None:
             logger.info("Realtime voice choice set to %s", voice_choice)
         if isinstance(credentials, AzureKeyCredential):
             self.key = credentials.key
         else:
-            self._token_provider = get_bearer_token_provider(credentials, "https://cognitiveservices.azure.com/.default")
-            self._token_provider() # Warm up during startup so we have a token cached when the first request arrives
+            # Tokens are fetched at startup and refreshed in the background so connects never block on them
+            self._owns_token_cache = not isinstance(credentials, TokenCache)
+            self._token_cache = TokenCache(credentials) if self._owns_token_cache else credentials
+            self._token_cache.track(COGNITIVE_SERVICES_SCOPE)
+
+    def add_upstream(self, endpoint: str, deployment: Optional[str] = None, weight: float = 1.0, key: Optional[str] = None, name: Optional[str] = None):
+        """
+        Add a realtime endpoint to balance clients across and fail over to, with the same deployment by default.
+        """
+        self.upstreams.endpoints.append(UpstreamEndpoint(endpoint, deployment or self.deployment, weight, key, name))
+
+    async def _execute_tool_call(self, item: dict, tool_call: RTToolCall, session: RTSession) -> dict:
+        tool = self.tools[item["name"]]
+        args = json.loads(item["arguments"])
+        timeout = tool.timeout if tool.timeout is not None else self.tool_timeout
+        started = time.monotonic()
+        outcome = "ok"
+        try:
+            if item["name"] in ["update_order", "get_order"]:
+                result = await asyncio.wait_for(tool.target(args, session.order_session_id), timeout)
+            else:
+                result = await asyncio.wait_for(tool.target(args), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Tool %s timed out after %s seconds", item["name"], timeout)
+            result = ToolResult(f"The {item['name']} tool timed out, please try again.", ToolResultDirection.TO_SERVER)
+            outcome = "timeout"
+        except Exception as e:
+            logger.error("Tool %s failed: %s", item["name"], e)
+            result = ToolResult(f"The {item['name']} tool failed.", ToolResultDirection.TO_SERVER)
+            outcome = "error"
+        _tool_call_seconds(item["name"], outcome).observe(time.monotonic() - started)
+
+        if result.destination == ToolResultDirection.TO_CLIENT:
+            # TODO: this will break clients that don't know about this extra message, rewrite 
+            # this to be a regular text message with a special marker of some sort
+            await session.to_client.put(json.dumps({
+                "type": "extension.middle_tier_tool_response",
+                "previous_item_id": tool_call.previous_id,
+                "tool_name": item["name"],
+                "tool_result": result.to_text()
+            }))
+        return {
+            "type": "conversation.item.create",
+            "item": {
+                "type": "function_call_output",
+                "call_id": item["call_id"],
+                "output": result.to_text() if result.destination == ToolResultDirection.TO_SERVER else ""
+            }
+        }
+
+    async def _send_tool_outputs(self, session: RTSession, outputs: list[dict]):
+        for output in outputs:
+            await session.to_server.put(json.dumps(output))
+        await session.to_server.put(json.dumps({
+            "type": "response.create"
+        }))
+
+    async def _process_message_to_client(self, msg: str, session: RTSession) -> Optional[str]:
+        if self.fast_path:
+            message_type = peek_message_type(msg.data)
+            if message_type is not None and message_type not in _CLIENT_BOUND_REWRITE_TYPES:
+                return msg.data
 
-    async def _process_message_to_client(self, msg: str, client_ws: web.WebSocketResponse, server_ws: web.WebSocketResponse) -> Optional[str]:
         message = json.loads(msg.data)
         updated_message = msg.data
-        session_id = self._session_map[client_ws]
         if message is not None:
             match message["type"]:
                 case "session.created":
-                    session = message["session"]
+                    session_config = message["session"]
                     # Hide the instructions, tools and max tokens from clients, if we ever allow client-side 
                     # tools, this will need updating
-                    session["instructions"] = ""
-                    session["tools"] = []
-                    session["voice"] = self.voice_choice
-                    session["tool_choice"] = "none"
-                    session["max_response_output_tokens"] = None
+                    session_config["instructions"] = ""
+                    session_config["tools"] = []
+                    session_config["voice"] = self.voice_choice
+                    session_config["tool_choice"] = "none"
+                    session_config["max_response_output_tokens"] = None
                     updated_message = json.dumps(message)
 
                 case "response.output_item.added":
@@ -104,8 +563,8 @@ class RTMiddleTier:
                 case "conversation.item.created":
                     if "item" in message and message["item"]["type"] == "function_call":
                         item = message["item"]
-                        if item["call_id"] not in self._tools_pending:
-                            self._tools_pending[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"])
+                        if item["call_id"] not in session.tools_pending:
+                            session.tools_pending[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"])
                         updated_message = None
                     elif "item" in message and message["item"]["type"] == "function_call_output":
                         updated_message = None
@@ -119,38 +578,14 @@ class RTMiddleTier:
                 case "response.output_item.done":
                     if "item" in message and message["item"]["type"] == "function_call":
                         item = message["item"]
-                        tool_call = self._tools_pending[message["item"]["call_id"]]
-                        tool = self.tools[item["name"]]
-                        args = item["arguments"]
-                        if item["name"] in ["update_order", "get_order"]:
-                            result = await tool.target(json.loads(args), session_id)
-                        else:
-                            result = await tool.target(json.loads(args))
-                        await server_ws.send_json({
-                            "type": "conversation.item.create",
-                            "item": {
-                                "type": "function_call_output",
-                                "call_id": item["call_id"],
-                                "output": result.to_text() if result.destination == ToolResultDirection.TO_SERVER else ""
-                            }
-                        })
-                        if result.destination == ToolResultDirection.TO_CLIENT:
-                            # TODO: this will break clients that don't know about this extra message, rewrite 
-                            # this to be a regular text message with a special marker of some sort
-                            await client_ws.send_json({
-                                "type": "extension.middle_tier_tool_response",
-                                "previous_item_id": tool_call.previous_id,
-                                "tool_name": item["name"],
-                                "tool_result": result.to_text()
-                            })
+                        tool_call = session.tools_pending.pop(item["call_id"])
+                        # Run the tool in the background so audio and transcripts keep flowing meanwhile
+                        session.tool_executor.submit(message.get("response_id"), self._execute_tool_call(item, tool_call, session))
                         updated_message = None
 
                 case "response.done":
-                    if len(self._tools_pending) > 0:
-                        self._tools_pending.clear() # Any chance tool calls could be interleaved across different outstanding responses?
-                        await server_ws.send_json({
-                            "type": "response.create"
-                        })
+                    response_id = message.get("response", {}).get("id")
+                    session.tool_executor.complete_response(response_id, lambda outputs: self._send_tool_outputs(session, outputs))
                     if "response" in message:
                         replace = False
                         try:
@@ -159,89 +594,410 @@ class RTMiddleTier:
                                     message["response"]["output"].pop(i)
                                     replace = True
                         except IndexError as e:
-                            logging.error(f"Error processing message: {e}")
+                            logger.error("Error processing message: %s", e)
                         if replace:
                             updated_message = json.dumps(message)
 
         return updated_message
 
-    async def _process_message_to_server(self, msg: str, ws: web.WebSocketResponse) -> Optional[str]:
+    async def _process_message_to_server(self, msg: str, session: RTSession) -> Optional[str]:
+        if self.fast_path and is_plain_audio_append(msg.data):
+            return msg.data
+
         message = json.loads(msg.data)
         updated_message = msg.data
         if message is not None:
             match message["type"]:
                 case "session.update":
-                    session = message["session"]
-                    if self.system_message is not None:
-                        session["instructions"] = self.system_message
-                    if self.temperature is not None:
-                        session["temperature"] = self.temperature
-                    if self.max_tokens is not None:
-                        session["max_response_output_tokens"] = self.max_tokens
-                    if self.disable_audio is not None:
-                        session["disable_audio"] = self.disable_audio
-                    if self.voice_choice is not None:
-                        session["voice"] = self.voice_choice
-                    session["tool_choice"] = "auto" if len(self.tools) > 0 else "none"
-                    session["tools"] = [tool.schema for tool in self.tools.values()]
+                    if session.voice_activity is not None:
+                        if message["session"].get("input_audio_format", "pcm16") != "pcm16":
+                            # Only PCM16 can be inspected, forward everything from here on
+                            session.voice_activity.close(session.order_session_id)
+                            session.voice_activity = None
+                        else:
+                            session.voice_activity.follow_turn_detection(message["session"].get("turn_detection"))
+                    self._enforce_session_config(message["session"])
                     updated_message = json.dumps(message)
 
         return updated_message
 
-    async def _forward_messages(self, ws: web.WebSocketResponse):
-        async with aiohttp.ClientSession(base_url=self.endpoint) as session:
-            params = { "api-version": self.api_version, "deployment": self.deployment}
-            headers = {}
-            if "x-ms-client-request-id" in ws.headers:
-                headers["x-ms-client-request-id"] = ws.headers["x-ms-client-request-id"]
-            if self.key is not None:
-                headers = { "api-key": self.key }
-            else:
-                headers = { "Authorization": f"Bearer {self._token_provider()}" } # NOTE: no async version of token provider, maybe refresh token on a timer?
-            async with session.ws_connect("/openai/realtime", headers=headers, params=params) as target_ws:
-                async def from_client_to_server():
+    async def _queue_to_server(self, session: RTSession, new_msg: str) -> bool:
+        frames = [new_msg]
+        if session.voice_activity is not None:
+            message_type = peek_message_type(new_msg)
+            if message_type == "input_audio_buffer.append":
+                frames = session.voice_activity.process(new_msg)
+            elif message_type == "input_audio_buffer.commit":
+                # A manual commit gets the held pre-roll, so it never commits an empty buffer
+                frames = session.voice_activity.flush() + frames
+            elif message_type == "input_audio_buffer.clear":
+                session.voice_activity.clear()
+        for frame in frames:
+            if not await session.to_server.put(frame):
+                return False
+        return True
+
+    async def _coalesce_audio(self, session: RTSession, first: str) -> str:
+        """
+        Merge the append frames that follow first in the client's queue, or arrive within the window,
+        into a single append. Audio is decoded and encoded once for the whole batch; the event ids of
+        the merged frames are dropped. Clients that send audio less often than the window only have
+        frames that already queued up merged, waiting for the next one would just delay this one.
+        """
+        started = time.monotonic()
+        deadline = started + (self.audio_coalesce_window if session.audio_gap < self.audio_coalesce_window else 0.0)
+        frames = [first]
+        # Decoded size estimated from the frame length, base64 being 4 characters for 3 bytes
+        size = len(first) * 3 // 4
+        while size < self.audio_coalesce_bytes:
+            next_msg = await session.to_server.get_if("input_audio_buffer.append", deadline - time.monotonic())
+            if next_msg is None:
+                break
+            frames.append(next_msg)
+            size += len(next_msg) * 3 // 4
+        _audio_coalesce_wait.observe(time.monotonic() - started)
+        if len(frames) == 1:
+            return first
+        _audio_appends_coalesced.inc(len(frames) - 1)
+        audio = b"".join(base64.b64decode(json.loads(frame)["audio"]) for frame in frames)
+        return json.dumps({"type": "input_audio_buffer.append", "audio": base64.b64encode(audio).decode("ascii")})
+
+    def _enforce_session_config(self, session: dict) -> dict:
+        if self.system_message is not None:
+            session["instructions"] = self.system_message
+        if self.temperature is not None:
+            session["temperature"] = self.temperature
+        if self.max_tokens is not None:
+            session["max_response_output_tokens"] = self.max_tokens
+        if self.disable_audio is not None:
+            session["disable_audio"] = self.disable_audio
+        if self.voice_choice is not None:
+            session["voice"] = self.voice_choice
+        session["tool_choice"] = "auto" if len(self.tools) > 0 else "none"
+        session["tools"] = [tool.schema for tool in self.tools.values()]
+        return session
+
+    async def _replay_session(self, session: RTSession):
+        """
+        Seed the new upstream conversation of a resumed client with the server configuration and its
+        current order, so the customer carries on where they left off instead of ordering again.
+        """
+        summary = await order_state_singleton.get_order_summary_json(session.order_session_id)
+        await session.to_server.put(json.dumps({"type": "session.update", "session": self._enforce_session_config({})}))
+        # The whole order goes up as one conversation item rather than an item per line
+        await session.to_server.put(json.dumps({
+            "type": "conversation.item.create",
+            "item": {
+                "type": "message",
+                "role": "system",
+                "content": [{
+                    "type": "input_text",
+                    "text": f"The customer reconnected and is continuing their order. Their current order is: {summary}"
+                }]
+            }
+        }))
+        # Bring the client's order display back in sync, e.g. after a page reload
+        await session.to_client.put(json.dumps({
+            "type": "extension.middle_tier_tool_response",
+            "previous_item_id": None,
+            "tool_name": "update_order",
+            "tool_result": summary
+        }))
+
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        # One application-lifetime session so upstream connects reuse the DNS cache and connector
+        if self._http_session is None or self._http_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.upstream_connection_limit,
+                ttl_dns_cache=self.upstream_dns_cache_ttl,
+                keepalive_timeout=self.upstream_keepalive_timeout)
+            self._http_session = aiohttp.ClientSession(connector=connector)
+        return self._http_session
+
+    async def _upstream_headers(self, upstream: UpstreamEndpoint, ws: Optional[web.WebSocketResponse] = None) -> dict[str, str]:
+        headers = {}
+        if ws is not None and "x-ms-client-request-id" in ws.headers:
+            headers["x-ms-client-request-id"] = ws.headers["x-ms-client-request-id"]
+        if upstream.key is not None or self.key is not None:
+            headers["api-key"] = upstream.key or self.key
+        else:
+            token = await self._token_cache.get_token(COGNITIVE_SERVICES_SCOPE)
+            headers["Authorization"] = f"Bearer {token.token}"
+        return headers
+
+    async def _connect_upstream(self, upstream: UpstreamEndpoint, headers: dict[str, str]) -> aiohttp.ClientWebSocketResponse:
+        params = { "api-version": self.api_version, "deployment": upstream.deployment}
+        target_ws = await asyncio.wait_for(
+            self._get_http_session().ws_connect(f"{upstream.endpoint}/openai/realtime", headers=headers, params=params),
+            self.upstream_connect_timeout)
+        return target_ws
+
+    async def _open_upstream(self, ws: Optional[web.WebSocketResponse] = None) -> tuple[aiohttp.ClientWebSocketResponse, UpstreamEndpoint]:
+        """
+        Connect to the best upstream endpoint, failing over to the others in turn when a connect fails.
+        """
+        error: Optional[Exception] = None
+        for attempt, upstream in enumerate(self.upstreams.candidates()):
+            self.upstreams.connecting(upstream)
+            start = time.monotonic()
+            try:
+                target_ws = await self._connect_upstream(upstream, await self._upstream_headers(upstream, ws))
+            except asyncio.CancelledError:
+                upstream.probing = False
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                self.upstreams.record_failure(upstream, e)
+                error = e
+                continue
+            elapsed = time.monotonic() - start
+            _upstream_connect_seconds.observe(elapsed)
+            self.upstreams.record_connect(upstream, elapsed, failover=attempt > 0)
+            return target_ws, upstream
+        raise error
+
+    async def _acquire_upstream(self, ws: web.WebSocketResponse) -> tuple[aiohttp.ClientWebSocketResponse, UpstreamEndpoint]:
+        while self._warm_pool:
+            opened_at, target_ws, upstream = self._warm_pool.popleft()
+            self._warm_pool_wakeup.set()
+            if not target_ws.closed and time.monotonic() - opened_at < self.warm_pool_max_age and not upstream.is_open(time.monotonic()):
+                _warm_pool_hits.inc()
+                return target_ws, upstream
+            await target_ws.close()
+        _warm_pool_misses.inc()
+        return await self._open_upstream(ws)
+
+    async def _maintain_warm_pool(self):
+        while True:
+            now = time.monotonic()
+            while self._warm_pool and (self._warm_pool[0][1].closed or now - self._warm_pool[0][0] >= self.warm_pool_max_age):
+                _, stale_ws, _ = self._warm_pool.popleft()
+                await stale_ws.close()
+            while len(self._warm_pool) < self.warm_pool_size:
+                try:
+                    target_ws, upstream = await self._open_upstream()
+                except Exception as e:
+                    logger.warning("Failed to pre-open upstream realtime socket: %s", e)
+                    break
+                self._warm_pool.append((time.monotonic(), target_ws, upstream))
+            self._warm_pool_wakeup.clear()
+            try:
+                await asyncio.wait_for(self._warm_pool_wakeup.wait(), self.warm_pool_max_age / 2)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _on_startup(self, app: web.Application):
+        self._get_http_session()
+        if self.warm_pool_size > 0:
+            self._warm_pool_task = asyncio.create_task(self._maintain_warm_pool())
+
+    async def _on_shutdown(self, app: web.Application):
+        # The worker has stopped listening, so no new clients arrive while the live ones drain
+        if self._sessions:
+            logger.info("Draining %d realtime connections", len(self._sessions))
+            await asyncio.gather(*(self._drain(session) for session in list(self._sessions.values())))
+
+    async def _drain(self, session: RTSession):
+        deadline = time.monotonic() + self.drain_timeout
+        while not session.is_idle() and time.monotonic() < deadline and not session.client_ws.closed:
+            await asyncio.sleep(0.1)
+        if session.client_ws.closed:
+            return
+        _drained_connections["idle" if session.is_idle() else "timeout"].inc()
+        await session.client_ws.close(code=aiohttp.WSCloseCode.SERVICE_RESTART, message=b"Server restarting")
+
+    async def _on_cleanup(self, app: web.Application):
+        if self._warm_pool_task is not None:
+            self._warm_pool_task.cancel()
+        while self._warm_pool:
+            _, target_ws, _ = self._warm_pool.popleft()
+            await target_ws.close()
+        if self._http_session is not None:
+            await self._http_session.close()
+
+    async def _forward_messages(self, session: RTSession):
+        ws = session.client_ws
+        target_ws, session.upstream = await self._acquire_upstream(ws)
+        async with target_ws:
+            session.server_ws = target_ws
+            if session.resumed:
+                await self._replay_session(session)
+
+            # Each direction has a reader filling a bounded queue and a writer draining it, so a slow
+            # client doesn't hold up reading from upstream until its queue is full
+            async def from_client_to_server():
+                frames, received, overhead = _relay_frames["to_server"], _relay_bytes["to_server"], _relay_overhead["to_server"]
+                interval = self.frame_metrics_interval
+                unflushed_bytes = 0
+                try:
                     async for msg in ws:
                         if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_server(msg, ws)
-                            if new_msg is not None:
-                                await target_ws.send_str(new_msg)
+                            session.frames_to_server += 1
+                            unflushed_bytes += len(msg.data)
+                            timed = session.frames_to_server % interval == 0
+                            if timed:
+                                frames.inc(interval)
+                                received.inc(unflushed_bytes)
+                                unflushed_bytes = 0
+                                started = time.perf_counter()
+                            message_type = peek_message_type(msg.data)
+                            if self.audio_coalesce_bytes > 0 and message_type == "input_audio_buffer.append":
+                                now = time.monotonic()
+                                session.audio_gap = now - session.last_audio_at
+                                session.last_audio_at = now
+                            elif message_type == "input_audio_buffer.commit":
+                                session.speech_stopped_at = time.monotonic()
+                            new_msg = await self._process_message_to_server(msg, session)
+                            if timed:
+                                overhead.observe(time.perf_counter() - started)
+                            if new_msg is not None and not await self._queue_to_server(session, new_msg):
+                                break
                         else:
-                            print("Error: unexpected message type:", msg.type)
-                    
-                    # Means it is gracefully closed by the client then time to close the target_ws
-                    if target_ws:
-                        print("Closing OpenAI's realtime socket connection.")
-                        await target_ws.close()
-                        
-                async def from_server_to_client():
+                            logger.warning("Unexpected %s frame from the client", msg.type.name, extra={"event": "relay.unexpected_frame"})
+                finally:
+                    frames.inc(session.frames_to_server % interval)
+                    received.inc(unflushed_bytes)
+                session.to_server.close()
+
+            async def send_to_server():
+                while (new_msg := await session.to_server.get()) is not None:
+                    message_type = peek_message_type(new_msg)
+                    is_audio = message_type == "input_audio_buffer.append"
+                    if message_type in _TURN_START_TYPES and (message_type == "response.create" or session.turn_started_at is None):
+                        session.turn_started_at = time.monotonic()
+                    if is_audio and self.audio_coalesce_bytes > 0:
+                        new_msg = await self._coalesce_audio(session, new_msg)
+                    await target_ws.send_str(new_msg)
+                    if is_audio and not session.first_audio_forwarded:
+                        session.first_audio_forwarded = True
+                        _time_to_first_audio.observe(time.monotonic() - session.connected_at)
+
+                # Means it is gracefully closed by the client then time to close the target_ws
+                if target_ws:
+                    logger.info("Client closed the connection, closing its upstream socket", extra={"event": "relay.close"})
+                    await target_ws.close()
+
+            async def from_server_to_client():
+                frames, received, overhead = _relay_frames["to_client"], _relay_bytes["to_client"], _relay_overhead["to_client"]
+                interval = self.frame_metrics_interval
+                unflushed_bytes = 0
+                try:
                     async for msg in target_ws:
                         if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_client(msg, ws, target_ws)
-                            if new_msg is not None:
-                                await ws.send_str(new_msg)
+                            session.frames_to_client += 1
+                            unflushed_bytes += len(msg.data)
+                            timed = session.frames_to_client % interval == 0
+                            if timed:
+                                frames.inc(interval)
+                                received.inc(unflushed_bytes)
+                                unflushed_bytes = 0
+                                started = time.perf_counter()
+                            message_type = peek_message_type(msg.data)
+                            if message_type in _FIRST_TOKEN_TYPES and session.turn_started_at is not None:
+                                self.upstreams.record_first_token(session.upstream, time.monotonic() - session.turn_started_at)
+                                session.turn_started_at = None
+                            elif message_type in _TURN_START_TYPES and session.turn_started_at is None:
+                                session.turn_started_at = time.monotonic()
+                            elif message_type == "input_audio_buffer.speech_stopped":
+                                session.speech_stopped_at = time.monotonic()
+                                session.speaking = False
+                            elif message_type == "input_audio_buffer.speech_started":
+                                session.speaking = True
+                            elif message_type == "response.created":
+                                session.responding = True
+                            elif message_type == "response.done":
+                                session.responding = False
+                            new_msg = await self._process_message_to_client(msg, session)
+                            if timed:
+                                overhead.observe(time.perf_counter() - started)
+                            if new_msg is not None and not await session.to_client.put(new_msg):
+                                break
                         else:
-                            print("Error: unexpected message type:", msg.type)
-
-                try:
-                    await asyncio.gather(from_client_to_server(), from_server_to_client())
-                except ConnectionResetError:
-                    # Ignore the errors resulting from the client disconnecting the socket
-                    pass
+                            logger.warning("Unexpected %s frame from upstream", msg.type.name, extra={"event": "relay.unexpected_frame"})
                 finally:
-                    # Clean up the session map when the connection is closed
-                    if ws in self._session_map:
-                        del self._session_map[ws]
+                    frames.inc(session.frames_to_client % interval)
+                    received.inc(unflushed_bytes)
+                session.to_client.close()
+
+            async def send_to_client():
+                while (new_msg := await session.to_client.get()) is not None:
+                    await ws.send_str(new_msg)
+                    if (session.speech_stopped_at is not None or (session.resumed and not session.first_response_audio_relayed)) \
+                            and peek_message_type(new_msg) == "response.audio.delta":
+                        now = time.monotonic()
+                        if session.speech_stopped_at is not None:
+                            _speech_to_first_audio.observe(now - session.speech_stopped_at)
+                            session.speech_stopped_at = None
+                        if session.resumed and not session.first_response_audio_relayed:
+                            session.first_response_audio_relayed = True
+                            _reconnect_to_first_audio.observe(now - session.connected_at)
+                # Closed here rather than by the reader so the close frame never interrupts a send
+                if session.to_client.overflowed:
+                    _slow_client_disconnects.inc()
+                    logger.warning("Disconnecting client of session %s, %d bytes behind", session.order_session_id, session.to_client.high_water)
+                    await ws.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER, message=b"Client too slow")
+
+            relay_tasks = [asyncio.create_task(relay()) for relay in (from_client_to_server, send_to_server, from_server_to_client, send_to_client)]
+            try:
+                await asyncio.gather(*relay_tasks)
+            except ConnectionResetError:
+                # Ignore the errors resulting from the client disconnecting the socket
+                pass
+            finally:
+                for task in relay_tasks:
+                    task.cancel()
 
     async def _websocket_handler(self, request: web.Request):
         ws = web.WebSocketResponse()
         await ws.prepare(request)
         
-        # Create a new session for each WebSocket connection
-        session_id = order_state_singleton.create_session()
-        self._session_map[ws] = session_id
+        # Reattach a reconnecting client to its order session, otherwise create a new session for the connection
+        order_session_id = None
+        if resume_token := request.query.get("resume_token"):
+            order_session_id = await order_state_singleton.resume_session(resume_token)
+        resumed = order_session_id is not None
+        if resumed:
+            _sessions_resumed.inc()
+        else:
+            order_session_id = await order_state_singleton.create_session()
+        # Everything logged while serving this connection, tool calls included, carries its session id
+        session_id_token = session_id_var.set(order_session_id)
 
-        await self._forward_messages(ws)
+        session = RTSession(ws, order_session_id, self.tool_concurrency, resumed,
+                            to_server=RelayQueue("to_server", self.server_queue_bytes),
+                            to_client=RelayQueue("to_client", self.client_queue_bytes, self.slow_client_policy))
+        if self.vad_enabled:
+            session.voice_activity = VoiceActivityGate(pre_roll=self.vad_pre_roll, hangover=self.vad_hangover, margin_db=self.vad_margin_db)
+        # Registered before the previous socket is closed, so its handler sees it no longer owns the session
+        stale = self._sessions.get(order_session_id)
+        self._sessions[order_session_id] = session
+        _active_connections.inc()
+        try:
+            if stale is not None:
+                # The previous socket of this client hasn't noticed it is gone yet. Resume again once it is
+                # closed, so the session is held by this connection whatever its old handler did meanwhile
+                await stale.client_ws.close()
+                await order_state_singleton.resume_session(resume_token)
+            await ws.send_json({
+                "type": "extension.session_resume",
+                "resume_token": order_state_singleton.issue_resume_token(order_session_id),
+                "resumed": resumed
+            })
+            await self._forward_messages(session)
+        finally:
+            # Stop any tool calls still running for the disconnected client and forget the connection,
+            # unless the client already came back on a new connection that owns the session now
+            session.close()
+            _active_connections.dec()
+            if self._sessions.get(order_session_id) is session:
+                del self._sessions[order_session_id]
+                await order_state_singleton.close_session(order_session_id)
+            session_id_var.reset(session_id_token)
         return ws
     
     def attach_to_app(self, app, path):
         app.router.add_get(path, self._websocket_handler)
+        if self._owns_token_cache:
+            self._token_cache.attach_to_app(app)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        app.on_cleanup.append(self._on_cleanup)
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from typing import Any, Optional
+
+from aiohttp import web
+
+from metrics import metrics_registry
+
+logger = logging.getLogger("coffee-chat")
+
+_PUNCTUATION_PATTERN = re.compile(r"[^\w\s]")
+
+_hits = metrics_registry.counter("search_cache_hits_total", "Search tool calls answered from the result cache")
+_misses = metrics_registry.counter("search_cache_misses_total", "Search tool calls that went to the search backend")
+_coalesced = metrics_registry.counter("search_cache_coalesced_total", "Search tool calls that waited on an identical in-flight search")
+_evictions = metrics_registry.counter("search_cache_evictions_total", "Cached search results dropped because they expired or were least recently used")
+_invalidations = metrics_registry.counter("search_cache_invalidations_total", "Times the whole search result cache was cleared")
+
+class SearchResultCache:
+    """
+    TTL + LRU cache for search tool results keyed on normalized queries. Identical lookups that
+    arrive while a search is in flight wait for that search instead of issuing their own.
+
+    Each worker and replica keeps its own cache. An IndexerWatcher clears it when the indexer that
+    fills the index finishes a run; without one, a result from before a reindex is served for up
+    to ttl seconds more.
+    """
+    def __init__(self, max_entries: int = 256, ttl: float = 300.0, fold_accents: bool = True):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.fold_accents = fold_accents
+        self._entries: OrderedDict[tuple[str, str], tuple[float, Any]] = OrderedDict()
+        self._inflight: dict[tuple[str, str], asyncio.Future] = {}
+        # Bumped on invalidation so searches started before it don't repopulate the cache
+        self._generation = 0
+
+    def normalize(self, query: str) -> str:
+        text = query.casefold()
+        if self.fold_accents:
+            text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+        return " ".join(_PUNCTUATION_PATTERN.sub(" ", text).split())
+
+    def invalidate(self):
+        self._entries.clear()
+        self._generation += 1
+        _invalidations.inc()
+        logger.info("Search result cache invalidated")
+
+    async def get_or_compute(self, query: str, compute: Callable[[], Awaitable[Any]], namespace: str = "") -> Any:
+        """
+        Return the cached result for the query, or compute and cache it. The namespace keeps results
+        for the same query apart when they differ in shape, e.g. different field projections.
+        """
+        now = time.monotonic()
+        key = (namespace, self.normalize(query))
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                _hits.inc()
+                return value
+            del self._entries[key]
+            _evictions.inc()
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            _coalesced.inc()
+            # Shield so a waiter being cancelled doesn't cancel the search the others are waiting on
+            return await asyncio.shield(inflight)
+
+        _misses.inc()
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        generation = self._generation
+        try:
+            value = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Retrieved here so it isn't reported when nobody was waiting
+            raise
+        finally:
+            del self._inflight[key]
+
+        future.set_result(value)
+        if generation == self._generation:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                _evictions.inc()
+        return value
+
+class IndexerWatcher:
+    """
+    Clears a search result cache when the indexer that fills the index finishes a new run. Every
+    worker polls the indexer's status itself, so all workers and replicas drop their stale results
+    within one poll interval of a reindex, however it was started.
+    """
+    def __init__(self, cache: SearchResultCache, get_client: Callable[[], Awaitable[Any]], indexer_name: str, interval: float = 60):
+        self.cache = cache
+        self.indexer_name = indexer_name
+        self.interval = interval
+        self._get_client = get_client
+        self._last_run: Optional[tuple] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def check(self) -> bool:
+        """
+        Fetch the indexer's status and invalidate the cache if a run finished since the last check.
+        The first check only records the latest run. Returns whether the cache was invalidated.
+        """
+        status = await (await self._get_client()).get_indexer_status(self.indexer_name)
+        last = status.last_result
+        if last is None or last.end_time is None:
+            # Never run, or still running, the documents it is writing show up once it ends
+            return False
+        run = (last.start_time, last.end_time)
+        # A scheduled run that found nothing new to index leaves the results as they were
+        changed = self._last_run is not None and run != self._last_run and last.item_count != 0
+        self._last_run = run
+        if changed:
+            logger.info("Indexer %s finished a run (%s)", self.indexer_name, last.status, extra={"event": "search.reindexed"})
+            self.cache.invalidate()
+        return changed
+
+    async def _watch(self):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        while True:
+            try:
+                await self.check()
+            except ResourceNotFoundError:
+                logger.info("No indexer %s, cached search results expire after their TTL only", self.indexer_name)
+                return
+            except Exception as e:
+                logger.warning("Checking indexer %s failed: %s", self.indexer_name, e)
+            await asyncio.sleep(self.interval)
+
+    def attach_to_app(self, app: web.Application):
+        async def on_startup(_):
+            self._task = asyncio.create_task(self._watch())
+
+        async def on_cleanup(_):
+            if self._task is not None:
+                self._task.cancel()
+                self._task = None
+
+        app.on_startup.append(on_startup)
+        app.on_cleanup.append(on_cleanup)
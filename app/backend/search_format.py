@@ -0,0 +1,59 @@
+import json
+from collections.abc import Iterable
+from typing import Any
+
+# Field projections the search tool can return, from everything the index has down to what a price question needs
+PROJECTIONS: dict[str, tuple[str, ...]] = {
+    "full": ("category", "name", "description", "longDescription", "origin", "caffeineContent", "brewingMethod", "popularity", "sizes"),
+    "summary": ("category", "name", "description", "sizes"),
+    "price": ("name", "sizes"),
+}
+DEFAULT_PROJECTION = "full"
+
+_LABELS = {
+    "category": "Category",
+    "name": "Name",
+    "description": "Description",
+    "longDescription": "Long Description",
+    "origin": "Origin",
+    "caffeineContent": "Caffeine Content",
+    "brewingMethod": "Brewing Method",
+    "popularity": "Popularity",
+    "sizes": "Sizes",
+}
+
+def _compact_sizes(sizes: str) -> str:
+    # '[{"size": "small", "price": 2.5}, ...]' -> 'small $2.50, ...', a fraction of the tokens
+    try:
+        return ", ".join(f"{size['size']} ${size['price']:.2f}" for size in json.loads(sizes))
+    except (TypeError, ValueError, KeyError):
+        return str(sizes)
+
+def render_snippet(document: dict[str, Any], projection: str = DEFAULT_PROJECTION) -> str:
+    """
+    Serialize one search hit as '[id]: Label: value, ...' followed by the '-----' separator.
+    The full projection keeps the raw sizes JSON so its output is unchanged from earlier releases.
+    """
+    values = []
+    for field in PROJECTIONS[projection]:
+        value = document[field]
+        if field == "sizes" and projection != "full":
+            value = _compact_sizes(value)
+        values.append(f"{_LABELS[field]}: {value}")
+    return f"[{document['id']}]: {', '.join(values)}\n-----\n"
+
+def render_results(documents: Iterable[dict[str, Any]], projection: str = DEFAULT_PROJECTION) -> str:
+    return "".join([render_snippet(document, projection) for document in documents])
+
+class SnippetTable:
+    """
+    Search result snippets for every menu item in every projection, serialized once at index
+    load time so answering a search is a dictionary lookup per hit and a single join.
+    """
+    def __init__(self, documents: Iterable[dict[str, Any]]):
+        documents = list(documents)
+        self._snippets = {projection: {document["id"]: render_snippet(document, projection) for document in documents} for projection in PROJECTIONS}
+
+    def join(self, ids: Iterable[str], projection: str = DEFAULT_PROJECTION) -> str:
+        snippets = self._snippets[projection]
+        return "".join([snippets[item_id] for item_id in ids])
@@ -0,0 +1,404 @@
+import json
+import sys
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Iterable
+from typing import Any, Optional
+
+from pydantic_core import to_json
+
+from metrics import metrics_registry
+from models import OrderItem, OrderSummary
+
+TAX_RATE = 0.08  # 8% tax
+
+_expired_idle = metrics_registry.counter("order_sessions_expired_total", "Order sessions removed by the sweeper", {"reason": "idle"})
+_expired_closed = metrics_registry.counter("order_sessions_expired_total", "Order sessions removed by the sweeper", {"reason": "closed"})
+
+def format_display(item_name: str, size: str) -> str:
+    formatted_size = ""
+    if size.lower() == "standard":
+        formatted_size = ""
+    elif size.lower() == "kannchen":
+        formatted_size = "Kannchen of "
+    elif size.lower() == "pot":
+        formatted_size = "Pot of "
+    else:
+        formatted_size = f"{size.capitalize()} "
+    return f"{formatted_size}{item_name}".strip()
+
+class OrderSession:
+    """
+    Line items of one order keyed by (item, size), with the running total kept in integer cents
+    so it can be updated incrementally without float drift. The pydantic summary and its JSON
+    are built on first read and cached until the next change; each line item keeps its own JSON
+    fragment so a change re-serializes only the item that changed.
+    """
+    def __init__(self):
+        self.items: dict[tuple[str, str], OrderItem] = {}
+        self.total_cents = 0
+        self._item_json: dict[tuple[str, str], str] = {}
+        self._summary: Optional[OrderSummary] = None
+        self._summary_json: Optional[str] = None
+        self.last_active = time.monotonic()
+
+    def _changed(self, key: tuple[str, str]):
+        self._item_json.pop(key, None)
+        self._summary = None
+        self._summary_json = None
+
+    def add(self, item_name: str, size: str, quantity: int, price: float) -> str:
+        key = (item_name, size)
+        existing = self.items.get(key)
+        if existing is not None:
+            existing.quantity += quantity
+            self.total_cents += round(existing.price * 100) * quantity
+            change = "Updated quantity for"
+        else:
+            self.items[key] = OrderItem(item=item_name, size=size, quantity=quantity, price=price, display=format_display(item_name, size))
+            self.total_cents += round(price * 100) * quantity
+            change = "Added"
+        self._changed(key)
+        return change
+
+    def remove(self, item_name: str, size: str, quantity: int) -> Optional[str]:
+        key = (item_name, size)
+        existing = self.items.get(key)
+        if existing is None:
+            return None
+        if existing.quantity > quantity:
+            existing.quantity -= quantity
+            self.total_cents -= round(existing.price * 100) * quantity
+            change = "Decreased quantity for"
+        else:
+            del self.items[key]
+            self.total_cents -= round(existing.price * 100) * existing.quantity
+            change = "Removed"
+        self._changed(key)
+        return change
+
+    def summary(self) -> OrderSummary:
+        if self._summary is None:
+            total = self.total_cents / 100
+            tax = total * TAX_RATE
+            self._summary = OrderSummary(items=list(self.items.values()), total=total, tax=tax, finalTotal=total + tax)
+        return self._summary
+
+    def summary_json(self) -> str:
+        if self._summary_json is None:
+            # Same output as OrderSummary.model_dump_json(), assembled from the cached item fragments
+            item_json = self._item_json
+            for key, item in self.items.items():
+                if key not in item_json:
+                    item_json[key] = item.model_dump_json()
+            total = self.total_cents / 100
+            tax = total * TAX_RATE
+            self._summary_json = (f'{{"items":[{",".join([item_json[key] for key in self.items])}],'
+                                  f'"total":{to_json(total).decode()},"tax":{to_json(tax).decode()},'
+                                  f'"finalTotal":{to_json(total + tax).decode()}}}')
+        return self._summary_json
+
+    def approximate_size(self) -> int:
+        """
+        Rough bytes held by this session: its containers, line items and cached serializations.
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.__dict__) + sys.getsizeof(self.items) + sys.getsizeof(self._item_json)
+        for key, item in self.items.items():
+            size += sys.getsizeof(key) + sys.getsizeof(item) + sys.getsizeof(item.__dict__)
+            size += sum(sys.getsizeof(value) for value in item.__dict__.values())
+        size += sum(sys.getsizeof(fragment) for fragment in self._item_json.values())
+        if self._summary_json is not None:
+            size += sys.getsizeof(self._summary_json)
+        return size
+
+class SessionStore(ABC):
+    """
+    Where order sessions are kept. OrderState delegates to one of these, so sessions can live in
+    this process or in a shared store that every worker and node reads and writes.
+
+    A session that isn't read, updated or touched for idle_ttl seconds expires. Sessions with a
+    connected client are touched regularly, so idle_ttl only catches sessions a worker lost track
+    of. release() is called when its client disconnects and either removes it right away or lets
+    it expire after a grace period.
+    """
+    def __init__(self, idle_ttl: float = 1800):
+        self.idle_ttl = idle_ttl
+
+    @abstractmethod
+    async def create(self, session_id: str):
+        ...
+
+    @abstractmethod
+    async def update(self, session_id: str, action: str, item_name: str, size: str, quantity: int, price: float) -> Optional[str]:
+        """
+        Apply an add or remove and return what changed ("Added", "Removed", ...) or None if nothing did.
+        """
+
+    @abstractmethod
+    async def summary(self, session_id: str) -> OrderSummary:
+        ...
+
+    async def summary_json(self, session_id: str) -> str:
+        return (await self.summary(session_id)).model_dump_json()
+
+    @abstractmethod
+    async def release(self, session_id: str, grace: float = 0):
+        ...
+
+    @abstractmethod
+    async def resume(self, session_id: str) -> bool:
+        """
+        Take back a released session before it expires. Returns False if it no longer exists.
+        """
+
+    @abstractmethod
+    async def touch(self, session_ids: Iterable[str]):
+        """
+        Restart the idle timeout of sessions whose clients are still connected. Sessions that no longer exist stay gone.
+        """
+
+    async def sweep(self, limit: int) -> int:
+        """
+        Remove at most limit expired sessions and return how many were removed.
+        """
+        return 0
+
+    def live_sessions(self) -> Optional[int]:
+        return None
+
+    def memory_per_session(self) -> Optional[float]:
+        return None
+
+    async def close(self):
+        pass
+
+class InMemorySessionStore(SessionStore):
+    """
+    Sessions in a dict in this process. Fastest, but a session is only visible to the worker that created it.
+
+    Sessions are kept least recently used first and released sessions in the order their grace
+    period ends, so the sweeper only looks at the front of each until it finds one still live.
+    """
+    def __init__(self, idle_ttl: float = 1800):
+        super().__init__(idle_ttl)
+        self.sessions: OrderedDict[str, OrderSession] = OrderedDict()
+        self._released: OrderedDict[str, float] = OrderedDict()
+
+    def _session(self, session_id: str) -> OrderSession:
+        session = self.sessions[session_id]
+        session.last_active = time.monotonic()
+        self.sessions.move_to_end(session_id)
+        return session
+
+    async def create(self, session_id: str):
+        self.sessions[session_id] = OrderSession()
+
+    async def update(self, session_id: str, action: str, item_name: str, size: str, quantity: int, price: float) -> Optional[str]:
+        session = self._session(session_id)
+        if action == "add":
+            return session.add(item_name, size, quantity, price)
+        if action == "remove":
+            return session.remove(item_name, size, quantity)
+        return None
+
+    async def summary(self, session_id: str) -> OrderSummary:
+        return self._session(session_id).summary()
+
+    async def summary_json(self, session_id: str) -> str:
+        return self._session(session_id).summary_json()
+
+    async def release(self, session_id: str, grace: float = 0):
+        if grace <= 0:
+            self.sessions.pop(session_id, None)
+            self._released.pop(session_id, None)
+        elif session_id in self.sessions:
+            self._released[session_id] = time.monotonic() + grace
+            self._released.move_to_end(session_id)
+
+    async def resume(self, session_id: str) -> bool:
+        if session_id not in self.sessions:
+            return False
+        self._released.pop(session_id, None)
+        self._session(session_id)
+        return True
+
+    async def touch(self, session_ids: Iterable[str]):
+        for session_id in session_ids:
+            if session_id in self.sessions:
+                self._session(session_id)
+
+    async def sweep(self, limit: int) -> int:
+        now = time.monotonic()
+        removed = 0
+        while self._released and removed < limit:
+            session_id, expires_at = next(iter(self._released.items()))
+            if expires_at > now:
+                break
+            del self._released[session_id]
+            if self.sessions.pop(session_id, None) is not None:
+                _expired_closed.inc()
+                removed += 1
+        while self.sessions and removed < limit:
+            session_id, session = next(iter(self.sessions.items()))
+            if session.last_active + self.idle_ttl > now:
+                break
+            del self.sessions[session_id]
+            self._released.pop(session_id, None)
+            _expired_idle.inc()
+            removed += 1
+        return removed
+
+    def live_sessions(self) -> int:
+        return len(self.sessions)
+
+    def memory_per_session(self, sample: int = 64) -> float:
+        # Averaged over the most recently active sessions, sizing every session would make a tick cost O(sessions)
+        sizes = []
+        for session_id in reversed(self.sessions):
+            sizes.append(self.sessions[session_id].approximate_size())
+            if len(sizes) >= sample:
+                break
+        return sum(sizes) / len(sizes) if sizes else 0.0
+
+class RedisSessionStore(SessionStore):
+    """
+    Sessions in Redis, or anything that speaks its protocol, so any worker or node can serve any
+    session. Each session is a hash recording when it was created, a hash of line item details
+    (item, size, price, display), a hash of quantities and a sorted set that keeps the order items
+    were first added in. Adds are a single MULTI/EXEC round trip built from HSETNX and HINCRBY, so
+    concurrent adds from different workers never lose an update. Removes use WATCH on the
+    quantities and retry if another worker changed them in between. Reads fetch the items in one
+    transaction.
+
+    Every command that touches a session also resets the TTL on its keys, so Redis expires idle
+    and released sessions itself and there is nothing to sweep.
+    """
+    def __init__(self, client: Any, key_prefix: str = "coffee-chat:order:", idle_ttl: float = 1800):
+        super().__init__(idle_ttl)
+        self._client = client
+        self.key_prefix = key_prefix
+
+    @classmethod
+    def from_url(cls, url: str, key_prefix: str = "coffee-chat:order:", idle_ttl: float = 1800) -> "RedisSessionStore":
+        from redis.asyncio import Redis
+
+        return cls(Redis.from_url(url, decode_responses=True), key_prefix, idle_ttl)
+
+    def _keys(self, session_id: str) -> tuple[str, str, str, str]:
+        prefix = f"{self.key_prefix}{session_id}"
+        return prefix, f"{prefix}:items", f"{prefix}:qty", f"{prefix}:seq"
+
+    @staticmethod
+    def _field(item_name: str, size: str) -> str:
+        return f"{item_name}\x1f{size}"
+
+    def _expire(self, pipe: Any, session_id: str, ttl: float):
+        for key in self._keys(session_id):
+            pipe.expire(key, max(1, int(ttl)))
+
+    async def create(self, session_id: str):
+        async with self._client.pipeline(transaction=True) as pipe:
+            pipe.hset(self._keys(session_id)[0], "created", time.time())
+            self._expire(pipe, session_id, self.idle_ttl)
+            await pipe.execute()
+
+    async def update(self, session_id: str, action: str, item_name: str, size: str, quantity: int, price: float) -> Optional[str]:
+        if action == "add":
+            return await self._add(session_id, item_name, size, quantity, price)
+        if action == "remove":
+            return await self._remove(session_id, item_name, size, quantity)
+        return None
+
+    async def _add(self, session_id: str, item_name: str, size: str, quantity: int, price: float) -> str:
+        session_key, items_key, qty_key, seq_key = self._keys(session_id)
+        field = self._field(item_name, size)
+        details = json.dumps({"item": item_name, "size": size, "price": price, "display": format_display(item_name, size)})
+        async with self._client.pipeline(transaction=True) as pipe:
+            pipe.exists(session_key)
+            pipe.hsetnx(items_key, field, details)
+            pipe.zadd(seq_key, {field: time.time()}, nx=True)
+            pipe.hincrby(qty_key, field, quantity)
+            self._expire(pipe, session_id, self.idle_ttl)
+            exists, added, *_ = await pipe.execute()
+        if not exists:
+            # The session expired, drop the keys this add recreated rather than bring back part of it
+            await self._client.delete(items_key, qty_key, seq_key)
+            raise KeyError(session_id)
+        return "Added" if added else "Updated quantity for"
+
+    async def _remove(self, session_id: str, item_name: str, size: str, quantity: int) -> Optional[str]:
+        from redis.exceptions import WatchError
+
+        _, items_key, qty_key, seq_key = self._keys(session_id)
+        field = self._field(item_name, size)
+        async with self._client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(qty_key)
+                    current = await pipe.hget(qty_key, field)
+                    if current is None:
+                        await pipe.unwatch()
+                        return None
+                    pipe.multi()
+                    if int(current) > quantity:
+                        pipe.hincrby(qty_key, field, -quantity)
+                        change = "Decreased quantity for"
+                    else:
+                        pipe.hdel(qty_key, field)
+                        pipe.hdel(items_key, field)
+                        pipe.zrem(seq_key, field)
+                        change = "Removed"
+                    self._expire(pipe, session_id, self.idle_ttl)
+                    await pipe.execute()
+                    return change
+                except WatchError:
+                    # Another worker changed this order between our read and write, read it again
+                    continue
+
+    async def summary(self, session_id: str) -> OrderSummary:
+        _, items_key, qty_key, seq_key = self._keys(session_id)
+        async with self._client.pipeline(transaction=True) as pipe:
+            pipe.zrange(seq_key, 0, -1)
+            pipe.hgetall(items_key)
+            pipe.hgetall(qty_key)
+            self._expire(pipe, session_id, self.idle_ttl)
+            fields, details, quantities, *_ = await pipe.execute()
+
+        items = []
+        total_cents = 0
+        for field in fields:
+            if field not in details or field not in quantities:
+                continue
+            item = OrderItem(**json.loads(details[field]), quantity=int(quantities[field]))
+            total_cents += round(item.price * 100) * item.quantity
+            items.append(item)
+        total = total_cents / 100
+        tax = total * TAX_RATE
+        return OrderSummary(items=items, total=total, tax=tax, finalTotal=total + tax)
+
+    async def release(self, session_id: str, grace: float = 0):
+        if grace <= 0:
+            await self._client.delete(*self._keys(session_id))
+            return
+        async with self._client.pipeline(transaction=True) as pipe:
+            self._expire(pipe, session_id, grace)
+            await pipe.execute()
+
+    async def resume(self, session_id: str) -> bool:
+        async with self._client.pipeline(transaction=True) as pipe:
+            pipe.exists(self._keys(session_id)[0])
+            self._expire(pipe, session_id, self.idle_ttl)
+            exists, *_ = await pipe.execute()
+        return bool(exists)
+
+    async def touch(self, session_ids: Iterable[str]):
+        # EXPIRE leaves missing keys missing, so this never brings back part of an expired session
+        async with self._client.pipeline(transaction=False) as pipe:
+            for session_id in session_ids:
+                self._expire(pipe, session_id, self.idle_ttl)
+            if len(pipe):
+                await pipe.execute()
+
+    async def close(self):
+        await self._client.aclose()
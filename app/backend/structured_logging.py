@@ -0,0 +1,177 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+from typing import Optional, TextIO
+
+# Order session of the conversation being served, set per client connection so every record logged
+# while serving it, from tool calls too, carries the session id
+session_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("session_id", default=None)
+
+# Attributes every LogRecord has, anything else on a record came in through extra= and is a field
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+class SessionFilter(logging.Filter):
+    """
+    Stamps records with the session id of the conversation being served, unless the call passed one.
+    """
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "session_id", None) is None:
+            record.session_id = session_id_var.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps one in every 1/rate records of each sampled event, dropping all of them at rate 0. An event
+    is named with extra={"event": ...}, otherwise its message template is the event. Errors are
+    always kept.
+    """
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.intervals = {event: max(1, round(1 / rate)) if rate > 0 else 0 for event, rate in rates.items()}
+        self._seen: dict[str, int] = {}
+
+    def keep(self, level: int, event: object) -> bool:
+        if not self.intervals or level >= logging.ERROR:
+            return True
+        interval = self.intervals.get(event)
+        if interval is None:
+            return True
+        if interval == 0:
+            return False
+        seen = self._seen.get(event, 0)
+        self._seen[event] = seen + 1
+        return seen % interval == 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return self.keep(record.levelno, getattr(record, "event", record.msg))
+
+# Sampling applied by SampledLogger, set by configure_logging when there are sample rates
+_sampling: Optional[SamplingFilter] = None
+
+class SampledLogger(logging.Logger):
+    """
+    Drops sampled out events before their record is created, so they cost neither the record nor the
+    stdlib's walk up the stack to find the caller.
+    """
+    def _log(self, level, msg, args, exc_info=None, extra=None, stack_info=False, stacklevel=1):
+        if _sampling is not None and not _sampling.keep(level, extra.get("event", msg) if extra else msg):
+            return
+        # This frame is one more between the caller and the stdlib's lookup of it
+        super()._log(level, msg, args, exc_info, extra, stack_info, stacklevel + 1)
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        session_id = getattr(record, "session_id", None)
+        return f"{text} [session {session_id}]" if session_id else text
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record, with the fields passed through extra= alongside the message.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock prepare() formats the message where it is logged; leaving that to the listener thread
+    # means the event loop only pays for creating the record. Log values that won't change afterwards.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def parse_sample_rates(text: str) -> dict[str, float]:
+    """
+    Parse event=rate pairs separated by commas, e.g. "search=0.1,order.read=0".
+    """
+    rates = {}
+    for pair in text.split(","):
+        if pair.strip():
+            event, rate = pair.rsplit("=", 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        # Drains the queue, so records logged just before exit are still written
+        _listener.stop()
+        _listener = None
+
+def _restart_listener():
+    global _listener
+    if _listener is not None:
+        # Threads don't survive a fork, a worker forked after logging was configured needs its own listener
+        _listener = logging.handlers.QueueListener(_listener.queue, *_listener.handlers)
+        _listener.start()
+
+atexit.register(_stop_listener)
+os.register_at_fork(after_in_child=_restart_listener)
+
+def configure_logging(level: str = "INFO", json_format: bool = False, sample_rates: Optional[dict[str, float]] = None,
+                      stream: TextIO = sys.stderr, skip_caller: bool = False):
+    """
+    Route the process's logging through a queue to a listener thread that formats and writes it, so
+    log output never blocks the event loop. Replaces any handlers already on the root logger, and
+    a listener started by an earlier call.
+
+    skip_caller stops the stdlib from walking the stack to find the file, line and function of every
+    record, most of the cost of creating one, by setting logging._srcfile to None as the logging
+    HOWTO's optimization section describes. Neither format shows the caller, but the switch is
+    process-wide and stays on: %(filename)s, %(lineno)d and %(funcName)s read as unknown in every
+    handler from then on.
+
+    With sample_rates, every named logger in the process becomes a SampledLogger, so sampled out events
+    are dropped before their record is created. Records of the root logger and of loggers of other
+    classes aren't sampled. The loggers stay SampledLoggers, they only sample while the last call had rates.
+    """
+    global _listener, _sampling
+    _stop_listener()
+    # Neither format shows the thread, so records don't collect it. The process id tells workers apart,
+    # and gunicorn's own log format needs it
+    logging.logThreads = False
+    logging.logMultiprocessing = False
+    if skip_caller:
+        logging._srcfile = None
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JsonFormatter() if json_format else TextFormatter())
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(log_queue)
+    handler.addFilter(SessionFilter())
+    _sampling = SamplingFilter(sample_rates) if sample_rates else None
+    if _sampling is not None:
+        # Module loggers are created on import, before this runs, so existing ones are switched over too
+        logging.setLoggerClass(SampledLogger)
+        for existing in logging.Logger.manager.loggerDict.values():
+            if type(existing) is logging.Logger:
+                existing.__class__ = SampledLogger
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
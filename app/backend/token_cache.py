@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from aiohttp import web
+from azure.core.credentials import AccessToken, TokenCredential
+
+from metrics import Counter, Histogram, metrics_registry
+from readiness import readiness_probe
+
+logger = logging.getLogger("coffee-chat")
+
+class TokenCache:
+    """
+    Async bearer token cache shared by the realtime middle tier and the search client.
+
+    Wraps a synchronous Azure credential, fetches tokens on a worker thread and refreshes every
+    tracked scope in the background ahead of expiry, so callers on the event loop get a cached
+    token without blocking. Implements the AsyncTokenCredential protocol so it can be handed
+    directly to async Azure SDK clients.
+    """
+    # Refresh this many seconds before a token expires
+    refresh_margin: float = 300
+    # Delay before retrying a failed refresh, and the longest the refresher sleeps between checks
+    retry_interval: float = 5
+    poll_interval: float = 60
+
+    def __init__(self, credential: TokenCredential):
+        self._credential = credential
+        self._tokens: dict[str, AccessToken] = {}
+        self._scopes: set[str] = set()
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def track(self, scope: str):
+        """
+        Keep a token for the scope fresh in the background from startup on.
+        """
+        self._scopes.add(scope)
+
+    def _metrics(self, scope: str) -> tuple[Histogram, Counter]:
+        labels = {"scope": scope}
+        return (metrics_registry.histogram("token_refresh_seconds", "Time to acquire a bearer token from the credential", labels),
+                metrics_registry.counter("token_refresh_failures_total", "Failed bearer token refreshes", labels))
+
+    async def _refresh(self, scope: str, stale: Optional[AccessToken]) -> AccessToken:
+        lock = self._locks.setdefault(scope, asyncio.Lock())
+        async with lock:
+            current = self._tokens.get(scope)
+            if current is not stale:
+                # Someone else refreshed the token while we waited for the lock
+                return current
+            latency, failures = self._metrics(scope)
+            start = time.monotonic()
+            try:
+                token = await asyncio.to_thread(self._credential.get_token, scope)
+            except Exception as e:
+                failures.inc()
+                logger.warning("Failed to refresh token for %s: %s", scope, e)
+                raise
+            latency.observe(time.monotonic() - start)
+            self._tokens[scope] = token
+            return token
+
+    async def get_token(self, *scopes: str, **kwargs) -> AccessToken:
+        scope = scopes[0]
+        self._scopes.add(scope)
+        token = self._tokens.get(scope)
+        if token is None or time.time() >= token.expires_on - self.retry_interval:
+            token = await self._refresh(scope, token)
+        return token
+
+    async def _refresh_loop(self):
+        while True:
+            now = time.time()
+            next_due = now + self.poll_interval
+            for scope in list(self._scopes):
+                token = self._tokens.get(scope)
+                if token is None or now >= token.expires_on - self.refresh_margin:
+                    try:
+                        token = await self._refresh(scope, token)
+                    except Exception:
+                        next_due = now + self.retry_interval
+                        continue
+                next_due = min(next_due, token.expires_on - self.refresh_margin)
+            await asyncio.sleep(max(next_due - time.time(), self.retry_interval))
+
+    async def warm(self):
+        """
+        Wait until every tracked scope has a token, raising if one can't be fetched.
+        """
+        await asyncio.gather(*(self.get_token(scope) for scope in list(self._scopes)))
+
+    async def start(self):
+        # The refresher's first pass fetches every tracked scope, without holding up startup
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def attach_to_app(self, app: web.Application):
+        async def on_startup(_):
+            await self.start()
+
+        async def on_cleanup(_):
+            await self.close()
+
+        app.on_startup.append(on_startup)
+        app.on_cleanup.append(on_cleanup)
+        # The worker isn't ready until its first tokens are in
+        readiness_probe.warm_up("bearer tokens", self.warm)
@@ -1,12 +1,22 @@
-from typing import Any
+import asyncio
+import importlib
+import logging
+from typing import TYPE_CHECKING, Any, Optional
 
 from order_state import order_state_singleton
-from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential
-from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import VectorizableTextQuery
+from azure.core.credentials import AzureKeyCredential, TokenCredential
 
+from menu_search import DEFAULT_MENU_PATH, MenuSearchIndex
+from readiness import readiness_probe
 from rtmt import RTMiddleTier, Tool, ToolResult, ToolResultDirection
+from search_cache import IndexerWatcher, SearchResultCache
+from search_format import DEFAULT_PROJECTION, PROJECTIONS, render_results
+from token_cache import TokenCache
+
+if TYPE_CHECKING:
+    from azure.search.documents.aio import SearchClient
+
+logger = logging.getLogger("coffee-chat")
 
 
 """"
@@ -30,6 +40,11 @@ search_tool_schema = {
             "query": {
                 "type": "string",
                 "description": "Search query"
+            },
+            "fields": {
+                "type": "string",
+                "description": "Details to return for each item: 'price' for names, sizes and prices only, 'summary' for a short description with sizes and prices, 'full' for everything.",
+                "enum": list(PROJECTIONS)
             }
         },
         "required": ["query"],
@@ -38,20 +53,24 @@ search_tool_schema = {
 }
 
 async def search(
-    search_client: SearchClient, 
+    search_client: "SearchClient",
     semantic_configuration: str,
     identifier_field: str,
     content_field: str,
     embedding_field: str,
     use_vector_query: bool,
-    args: Any) -> ToolResult:
+    args: Any,
+    default_projection: str = DEFAULT_PROJECTION) -> ToolResult:
 
     query = args['query']
-    print(f"\nStarting search for '{query}' in the knowledge base.")
+    projection = requested_projection(args, default_projection)
+    logger.info("Searching the knowledge base for %r", query, extra={"event": "search"})
     
     # Hybrid + Reranking query using Azure AI Search
     vector_queries = []
     if use_vector_query:
+        # Loaded along with the search client
+        from azure.search.documents.models import VectorizableTextQuery
         vector_queries.append(VectorizableTextQuery(text=query, k_nearest_neighbors=50, fields=embedding_field))
 
     # Perform the hybrid search
@@ -61,13 +80,27 @@ async def search(
         semantic_configuration_name=semantic_configuration,
         top=5,
         vector_queries=vector_queries,
-        select=["id", "category", "name", "description", "longDescription", "origin", "caffeineContent", "brewingMethod", "popularity", "sizes"],
+        select=["id", *PROJECTIONS[projection]],
     )
-    results = ""
+    results = render_results([r async for r in search_results], projection)
+    logger.debug("Search results: %s", results, extra={"event": "search.results"})
+    return ToolResult(results, ToolResultDirection.TO_SERVER)
+
+def requested_projection(args: Any, default_projection: str) -> str:
+    projection = args.get('fields') or default_projection
+    return projection if projection in PROJECTIONS else default_projection
+
+async def local_search(search_index: MenuSearchIndex, args: Any, default_projection: str = DEFAULT_PROJECTION) -> ToolResult:
+    """
+    Answer the search tool from the in-memory menu index instead of Azure AI Search.
+    """
+    query = args['query']
+    logger.info("Searching the menu for %r", query, extra={"event": "search"})
 
-    async for r in search_results:
-        results += f"[{r['id']}]: Category: {r['category']}, Name: {r['name']}, Description: {r['description']}, Long Description: {r['longDescription']}, Origin: {r['origin']}, Caffeine Content: {r['caffeineContent']}, Brewing Method: {r['brewingMethod']}, Popularity: {r['popularity']}, Sizes: {r['sizes']}\n-----\n"
-    print(f"Search results: {results}")
+    # Snippets were serialized when the index loaded, so this is a lookup per hit and one join
+    hits = search_index.search(query, top=5)
+    results = search_index.snippets.join([r['id'] for r in hits], requested_projection(args, default_projection))
+    logger.debug("Search results: %s", results, extra={"event": "search.results"})
     return ToolResult(results, ToolResultDirection.TO_SERVER)
 
 
@@ -119,16 +152,14 @@ async def update_order(args, session_id: str) -> ToolResult:
     """
     Update the current order by adding or removing items.
     """
-    print(f"\nUpdating the current order for session {session_id}.")
-    print(f"Arguments: {args}")
-    
+    logger.info("Updating the order: %s", args, extra={"event": "order.update", "session_id": session_id})
+
     # Update the order state on the backend
-    order_state_singleton.handle_order_update(session_id, args["action"], args["item_name"], args["size"], args.get("quantity", 0), args.get("price", 0.0))
+    await order_state_singleton.handle_order_update(session_id, args["action"], args["item_name"], args["size"], args.get("quantity", 0), args.get("price", 0.0))
 
-    order_summary = order_state_singleton.get_order_summary(session_id)
-    
-    json_order_summary = order_summary.model_dump_json()
-    print(f"Updated Order Summary: {json_order_summary}")
+    # The in-memory store serves this from cache until the order changes again
+    json_order_summary = await order_state_singleton.get_order_summary_json(session_id)
+    logger.debug("Updated order summary: %s", json_order_summary, extra={"event": "order.summary", "session_id": session_id})
 
     # Return the updated order state to the frontend client
     return ToolResult(json_order_summary, ToolResultDirection.TO_CLIENT)
@@ -159,33 +190,88 @@ async def get_order(session_id: str) -> ToolResult:
     """
     Retrieve the current order summary.
     """
-    print(f"\nRetrieving the current order summary for session {session_id}.")
-    
-    order_summary = order_state_singleton.get_order_summary(session_id)
-    print(f"Order Summary: {order_summary}")
-        
+    logger.info("Reading back the order", extra={"event": "order.read", "session_id": session_id})
+
+    json_order_summary = await order_state_singleton.get_order_summary_json(session_id)
+    logger.debug("Order summary: %s", json_order_summary, extra={"event": "order.summary", "session_id": session_id})
+
     # Return the order summary to the model
-    return ToolResult(order_summary.model_dump_json(), ToolResultDirection.TO_SERVER)
+    return ToolResult(json_order_summary, ToolResultDirection.TO_SERVER)
 
 
-# Attach tools to the RTMiddleTier instance
+# Attach tools to the RTMiddleTier instance. Returns the watcher that clears the search cache after a
+# reindex, if there is one, for the app to run
 def attach_tools_rtmt(rtmt: RTMiddleTier,
-    credentials: AzureKeyCredential | DefaultAzureCredential,
+    credentials: AzureKeyCredential | TokenCredential | TokenCache,
     search_endpoint: str, search_index: str,
     semantic_configuration: str,
     identifier_field: str,
     content_field: str,
     embedding_field: str,
     title_field: str,
-    use_vector_query: bool
-    ) -> None:
+    use_vector_query: bool,
+    search_backend: str = "azure",
+    menu_path: Optional[str] = None,
+    menu_embeddings_path: Optional[str] = None,
+    search_cache_size: int = 256,
+    search_cache_ttl: float = 300.0,
+    default_projection: str = DEFAULT_PROJECTION,
+    search_indexer: Optional[str] = None,
+    search_indexer_poll: float = 60.0
+    ) -> Optional[IndexerWatcher]:
 
-    if not isinstance(credentials, AzureKeyCredential):
-        credentials.get_token("https://search.azure.com/.default") # warm this up before we start getting requests
-    search_client = SearchClient(search_endpoint, search_index, credentials, user_agent="RTMiddleTier")
+    indexer_watcher = None
 
-    rtmt.tools["search"] = Tool(schema=search_tool_schema, target=lambda args: search(search_client, semantic_configuration, identifier_field, content_field, embedding_field, use_vector_query, args))
-    rtmt.tools["update_order"] = Tool(schema=update_order_tool_schema, target=lambda args, session_id: update_order(args, session_id))
-    rtmt.tools["get_order"] = Tool(schema=get_order_tool_schema, target=lambda _, session_id: get_order(session_id))
+    if search_backend == "local":
+        # Serve the search tool from the menu loaded in memory, no Azure AI Search round trip
+        menu_index = MenuSearchIndex.from_file(menu_path or DEFAULT_MENU_PATH, menu_embeddings_path)
+        rtmt.tools["search"] = Tool(schema=search_tool_schema, target=lambda args: local_search(menu_index, args, default_projection))
+    else:
+        if not isinstance(credentials, (AzureKeyCredential, TokenCache)):
+            # The async search client needs an async credential, and tokens are fetched off the event loop
+            credentials = TokenCache(credentials)
+        if isinstance(credentials, TokenCache):
+            credentials.track("https://search.azure.com/.default") # refreshed in the background from startup on
+        search_cache = SearchResultCache(max_entries=search_cache_size, ttl=search_cache_ttl) if search_cache_ttl > 0 else None
+        search_client: Optional[SearchClient] = None
+        search_client_lock = asyncio.Lock()
+
+        async def get_search_client() -> "SearchClient":
+            nonlocal search_client
+            async with search_client_lock:
+                if search_client is None:
+                    # The Azure AI Search SDK takes a while to import, so it is loaded on a worker thread once the
+                    # app has started rather than when it is created
+                    sdk = await asyncio.to_thread(importlib.import_module, "azure.search.documents.aio")
+                    search_client = sdk.SearchClient(search_endpoint, search_index, credentials, user_agent="RTMiddleTier")
+            return search_client
+
+        async def azure_search(args: Any) -> ToolResult:
+            return await search(await get_search_client(), semantic_configuration, identifier_field, content_field, embedding_field, use_vector_query, args, default_projection)
 
+        async def search_target(args: Any) -> ToolResult:
+            if search_cache is None:
+                return await azure_search(args)
+            # Repeats of a query, up to case, punctuation and accents, are answered without reaching Azure AI Search
+            return await search_cache.get_or_compute(args['query'], lambda: azure_search(args),
+                                                     namespace=requested_projection(args, default_projection))
 
+        readiness_probe.warm_up("search client", get_search_client)
+
+        if search_cache is not None and search_indexer and search_indexer_poll > 0:
+            indexer_client = None
+
+            async def get_indexer_client():
+                nonlocal indexer_client
+                if indexer_client is None:
+                    sdk = await asyncio.to_thread(importlib.import_module, "azure.search.documents.indexes.aio")
+                    indexer_client = sdk.SearchIndexerClient(search_endpoint, credentials, user_agent="RTMiddleTier")
+                return indexer_client
+
+            indexer_watcher = IndexerWatcher(search_cache, get_indexer_client, search_indexer, search_indexer_poll)
+
+        rtmt.tools["search"] = Tool(schema=search_tool_schema, target=search_target)
+
+    rtmt.tools["update_order"] = Tool(schema=update_order_tool_schema, target=lambda args, session_id: update_order(args, session_id))
+    rtmt.tools["get_order"] = Tool(schema=get_order_tool_schema, target=lambda _, session_id: get_order(session_id))
+    return indexer_watcher
@@ -0,0 +1,118 @@
+import hashlib
+import logging
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Union
+
+from metrics import metrics_registry
+
+logger = logging.getLogger("coffee-chat")
+
+_hits = metrics_registry.counter("tts_cache_hits_total", "Text-to-speech requests answered from the phrase cache")
+_misses = metrics_registry.counter("tts_cache_misses_total", "Text-to-speech requests that went to the Speech service")
+_evictions = metrics_registry.counter("tts_cache_evictions_total", "Cached phrases dropped to stay within the size budget")
+_seconds_saved = metrics_registry.counter("tts_cache_seconds_saved_total", "Synthesis time avoided by serving phrases from the cache")
+_cached_bytes = metrics_registry.gauge("tts_cache_bytes", "Audio held by the phrase cache")
+
+# Persisted phrases are memoryviews over read-only mappings of their files
+Audio = Union[bytes, memoryview]
+
+class TTSCache:
+    """
+    Content-addressed cache of synthesized phrases keyed by (voice, text), evicting the least
+    recently used phrases once max_bytes of audio is held.
+
+    With persist_dir set, every phrase is also written there under its key and the files are
+    memory-mapped rather than read, so a restarted worker starts warm without copying the audio
+    onto its heap. Entries are added from the speech worker threads, hence the lock.
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, persist_dir: Optional[Union[str, Path]] = None):
+        self.max_bytes = max_bytes
+        self.persist_dir = Path(persist_dir) if persist_dir else None
+        # key -> (audio, seconds it took to synthesize)
+        self._entries: OrderedDict[str, tuple[Audio, float]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._synthesis_seconds = 0.0
+        self._synthesized = 0
+        if self.persist_dir is not None:
+            self.persist_dir.mkdir(parents=True, exist_ok=True)
+            self._load()
+
+    @staticmethod
+    def key(voice: str, text: str) -> str:
+        return hashlib.sha256(f"{voice}\0{' '.join(text.split())}".encode()).hexdigest()
+
+    def _mean_synthesis_seconds(self) -> float:
+        return self._synthesis_seconds / self._synthesized if self._synthesized else 0.0
+
+    def _map(self, path: Path) -> Optional[memoryview]:
+        with open(path, "rb") as audio_file:
+            if os.fstat(audio_file.fileno()).st_size == 0:
+                return None
+            return memoryview(mmap.mmap(audio_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def _load(self):
+        # Oldest first so the most recently written phrases end up most recently used
+        paths = sorted(self.persist_dir.glob("*.wav"), key=lambda path: path.stat().st_mtime)
+        for path in paths:
+            audio = self._map(path)
+            if audio is not None:
+                self._insert(path.stem, audio, 0.0)
+        logger.info("Loaded %d cached phrases (%d bytes) from %s", len(self._entries), self._bytes, self.persist_dir)
+
+    def _insert(self, key: str, audio: Audio, synthesis_seconds: float):
+        # Called with the lock held, or from __init__
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key)[0])
+        self._entries[key] = (audio, synthesis_seconds)
+        self._bytes += len(audio)
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            evicted_key, (evicted, _) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            _evictions.inc()
+            if self.persist_dir is not None:
+                # The mapping stays valid for anyone still sending it, the file just goes away
+                (self.persist_dir / f"{evicted_key}.wav").unlink(missing_ok=True)
+        _cached_bytes.set(self._bytes)
+
+    def get(self, voice: str, text: str) -> Optional[Audio]:
+        key = self.key(voice, text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                _misses.inc()
+                return None
+            self._entries.move_to_end(key)
+        audio, synthesis_seconds = entry
+        _hits.inc()
+        _seconds_saved.inc(synthesis_seconds or self._mean_synthesis_seconds())
+        return audio
+
+    def __contains__(self, voice_text: tuple[str, str]) -> bool:
+        with self._lock:
+            return self.key(*voice_text) in self._entries
+
+    def put(self, voice: str, text: str, audio: bytes, synthesis_seconds: float) -> Audio:
+        """
+        Cache a synthesized phrase, returning the cached audio (memory-mapped when persisted).
+        """
+        if not audio or len(audio) > self.max_bytes:
+            return audio
+        key = self.key(voice, text)
+        cached: Audio = audio
+        if self.persist_dir is not None:
+            path = self.persist_dir / f"{key}.wav"
+            # Unique per process and thread, workers forked from one master can share thread idents
+            partial = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            partial.write_bytes(audio)
+            os.replace(partial, path)
+            cached = self._map(path) or audio
+        with self._lock:
+            self._synthesis_seconds += synthesis_seconds
+            self._synthesized += 1
+            self._insert(key, cached, synthesis_seconds)
+        return cached
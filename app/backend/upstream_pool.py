@@ -0,0 +1,133 @@
+import logging
+import random
+import time
+from typing import Optional
+from urllib.parse import urlparse
+
+from metrics import metrics_registry
+
+logger = logging.getLogger("coffee-chat")
+
+_failovers = metrics_registry.counter("rtmt_upstream_failovers_total", "Client connections that fell back to another upstream endpoint")
+
+class UpstreamEndpoint:
+    """
+    One realtime deployment the middle tier can connect to, with its health and latency estimates.
+    """
+    def __init__(self, endpoint: str, deployment: str, weight: float = 1.0, key: Optional[str] = None, name: Optional[str] = None):
+        self.endpoint = endpoint.rstrip("/")
+        self.deployment = deployment
+        self.weight = weight
+        # API key for this endpoint, when it differs from the middle tier's credentials
+        self.key = key
+        # The resource name of an Azure endpoint, host:port for anything addressed by IP
+        host = urlparse(self.endpoint).netloc or self.endpoint
+        self.name = name or (host if host.split(":")[0].replace(".", "").isdigit() else host.split(".")[0])
+        # Exponentially weighted moving averages in seconds, None until first measured
+        self.connect_seconds: Optional[float] = None
+        self.first_token_seconds: Optional[float] = None
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.cooldown = 0.0
+        self.probing = False
+        labels = {"endpoint": self.name}
+        self._connect_gauge = metrics_registry.gauge("rtmt_upstream_connect_ewma_seconds", "Moving average of the websocket handshake time per upstream endpoint", labels)
+        self._first_token_gauge = metrics_registry.gauge("rtmt_upstream_first_token_ewma_seconds", "Moving average of the time to the first response delta per upstream endpoint", labels)
+        self._open_gauge = metrics_registry.gauge("rtmt_upstream_circuit_open", "1 while connects to the upstream endpoint are suspended after repeated failures", labels)
+        self._connects = metrics_registry.counter("rtmt_upstream_connects_total", "Client connections served by each upstream endpoint", labels)
+        self._failures = metrics_registry.counter("rtmt_upstream_failures_total", "Failed connects per upstream endpoint", labels)
+
+    def is_open(self, now: float) -> bool:
+        return now < self.open_until
+
+    def latency(self, default: float) -> float:
+        """
+        Expected seconds from connecting to the first response audio; default for what hasn't been measured yet.
+        """
+        connect = self.connect_seconds if self.connect_seconds is not None else default / 2
+        first_token = self.first_token_seconds if self.first_token_seconds is not None else default / 2
+        return connect + first_token
+
+class UpstreamPool:
+    """
+    Picks the upstream endpoint for each client connection and tracks how each one is doing.
+
+    Selection is weighted and latency aware: two endpoints are drawn in proportion to their weight
+    and the one with the lower expected latency (moving averages of the handshake time and the time
+    to the first response delta) goes first, the rest follow in order of latency for failover.
+    After failure_threshold consecutive failed connects an endpoint's circuit opens and it is
+    skipped for a cooldown that doubles on every reopening, up to max_cooldown. Once the cooldown
+    has passed a single connect probes it, closing the circuit again on success.
+    """
+    def __init__(self, endpoints: list[UpstreamEndpoint], alpha: float = 0.3, failure_threshold: int = 3,
+                 cooldown: float = 10.0, max_cooldown: float = 300.0):
+        if not endpoints:
+            raise ValueError("At least one upstream endpoint is required")
+        self.endpoints = endpoints
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._random = random.Random()
+
+    def _ewma(self, current: Optional[float], sample: float) -> float:
+        return sample if current is None else self.alpha * sample + (1 - self.alpha) * current
+
+    def _default_latency(self) -> float:
+        # Unmeasured endpoints are assumed as fast as the fastest measured one, so they get tried
+        measured = [endpoint.latency(0.0) for endpoint in self.endpoints
+                    if endpoint.connect_seconds is not None and endpoint.first_token_seconds is not None]
+        return min(measured) if measured else 0.0
+
+    def candidates(self) -> list[UpstreamEndpoint]:
+        """
+        Endpoints to try for a new connection, in order.
+        """
+        now = time.monotonic()
+        default = self._default_latency()
+        available = [endpoint for endpoint in self.endpoints
+                     if not endpoint.is_open(now) and not (endpoint.probing and endpoint.cooldown > 0)]
+        ordered = sorted(available, key=lambda endpoint: endpoint.latency(default) / endpoint.weight)
+        if len(available) > 1:
+            first, second = self._random.choices(available, weights=[endpoint.weight for endpoint in available], k=2)
+            chosen = min(first, second, key=lambda endpoint: endpoint.latency(default))
+            ordered.remove(chosen)
+            ordered.insert(0, chosen)
+        # Endpoints with an open circuit are a last resort, soonest to reopen first
+        suspended = sorted((endpoint for endpoint in self.endpoints if endpoint not in available), key=lambda endpoint: endpoint.open_until)
+        return ordered + suspended
+
+    def connecting(self, endpoint: UpstreamEndpoint):
+        if endpoint.cooldown > 0:
+            # Past its cooldown, this connect is the probe
+            endpoint.probing = True
+
+    def record_connect(self, endpoint: UpstreamEndpoint, seconds: float, failover: bool):
+        if endpoint.cooldown > 0:
+            logger.info("Upstream %s recovered, closing its circuit", endpoint.name)
+        endpoint.connect_seconds = self._ewma(endpoint.connect_seconds, seconds)
+        endpoint.consecutive_failures = 0
+        endpoint.cooldown = 0.0
+        endpoint.probing = False
+        endpoint._connect_gauge.set(endpoint.connect_seconds)
+        endpoint._open_gauge.set(0)
+        endpoint._connects.inc()
+        if failover:
+            _failovers.inc()
+
+    def record_first_token(self, endpoint: UpstreamEndpoint, seconds: float):
+        endpoint.first_token_seconds = self._ewma(endpoint.first_token_seconds, seconds)
+        endpoint._first_token_gauge.set(endpoint.first_token_seconds)
+
+    def record_failure(self, endpoint: UpstreamEndpoint, error: BaseException):
+        endpoint._failures.inc()
+        endpoint.consecutive_failures += 1
+        if endpoint.probing or endpoint.consecutive_failures >= self.failure_threshold:
+            endpoint.cooldown = min(self.max_cooldown, endpoint.cooldown * 2 or self.base_cooldown)
+            endpoint.open_until = time.monotonic() + endpoint.cooldown
+            endpoint.probing = False
+            endpoint._open_gauge.set(1)
+            logger.warning("Upstream %s failed %d times in a row (%s), suspending it for %.0fs",
+                           endpoint.name, endpoint.consecutive_failures, error, endpoint.cooldown)
+        else:
+            logger.warning("Connecting to upstream %s failed: %s", endpoint.name, error)
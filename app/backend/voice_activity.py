@@ -0,0 +1,135 @@
+import base64
+import json
+import logging
+import math
+from collections import deque
+from typing import Optional
+
+from metrics import metrics_registry
+
+logger = logging.getLogger("coffee-chat")
+
+_bytes_saved = metrics_registry.counter("vad_audio_bytes_saved_total", "PCM16 audio bytes held back from upstream as silence")
+_seconds_saved = metrics_registry.counter("vad_audio_seconds_saved_total", "Seconds of audio held back from upstream as silence")
+_session_seconds_saved = metrics_registry.histogram("vad_session_audio_seconds_saved", "Seconds of silence held back from upstream per connection",
+                                                    buckets=(1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0))
+
+class VoiceActivityGate:
+    """
+    Holds back the silent stretches of one client's PCM16 input_audio_buffer.append frames.
+
+    Every frame is cut into short windows and classified with vectorized energy and zero-crossing
+    features: a window is speech when it is margin_db above the tracked noise floor, and windows
+    that cross zero as often as broadband noise does need twice that. Speech frames go upstream
+    along with the last pre_roll seconds held before them, so the start of a word is never clipped,
+    and frames keep going upstream for hangover seconds afterwards so turn detection on the server
+    still sees the pause that ends the turn. Everything else is dropped once it falls out of the
+    pre-roll.
+    """
+    def __init__(self, sample_rate: int = 24000, pre_roll: float = 0.3, hangover: float = 1.0, margin_db: float = 10.0,
+                 min_db: float = -70.0, max_zcr: float = 0.35, window: float = 0.01, min_speech_windows: int = 3):
+        self.sample_rate = sample_rate
+        self.pre_roll = pre_roll
+        self.hangover = hangover
+        self.margin_db = margin_db
+        # The noise floor never drops below min_db, so digital silence can't make every sound speech
+        self.min_db = min_db
+        self.max_zcr = max_zcr
+        self.min_speech_windows = min_speech_windows
+        self._window_samples = max(1, int(window * sample_rate))
+        self.noise_floor = -50.0
+        self.bytes_saved = 0
+        self.seconds_saved = 0.0
+        self.seconds_seen = 0.0
+        self._hangover_left = 0.0
+        self._held: deque[tuple[str, int, float]] = deque()
+        self._held_seconds = 0.0
+
+    def follow_turn_detection(self, turn_detection: Optional[dict]):
+        """
+        Keep at least the padding and silence the session's server VAD relies on.
+        """
+        if not turn_detection:
+            return
+        if (prefix_padding_ms := turn_detection.get("prefix_padding_ms")) is not None:
+            self.pre_roll = max(self.pre_roll, prefix_padding_ms / 1000)
+        if (silence_duration_ms := turn_detection.get("silence_duration_ms")) is not None:
+            self.hangover = max(self.hangover, silence_duration_ms / 1000 + 0.25)
+
+    def is_speech(self, pcm: bytes) -> bool:
+        import numpy as np
+
+        samples = np.frombuffer(pcm, dtype="<i2")
+        if samples.size == 0:
+            return False
+        count = samples.size // self._window_samples
+        if count == 0:
+            windows = samples.reshape(1, -1)
+        else:
+            windows = samples[:count * self._window_samples].reshape(count, self._window_samples)
+        windows = windows.astype(np.float32) / 32768.0
+        levels = 10.0 * np.log10(np.mean(windows * windows, axis=1) + 1e-12)
+        crossings = np.count_nonzero(np.diff(np.signbit(windows), axis=1), axis=1) / windows.shape[1]
+
+        threshold = self.noise_floor + self.margin_db
+        speech = (levels > threshold) & ((crossings < self.max_zcr) | (levels > threshold + self.margin_db))
+
+        # Follow the quiet end of each frame, falling quickly and rising with a ~10s time constant
+        quietest = float(np.percentile(levels, 20))
+        if quietest < self.noise_floor:
+            self.noise_floor = (self.noise_floor + quietest) / 2
+        else:
+            self.noise_floor += (quietest - self.noise_floor) * (1.0 - math.exp(-samples.size / self.sample_rate / 10.0))
+        self.noise_floor = max(self.noise_floor, self.min_db)
+        return int(np.count_nonzero(speech)) >= min(self.min_speech_windows, windows.shape[0])
+
+    def process(self, frame: str) -> list[str]:
+        """
+        Frames to forward upstream for one client append frame, none while the client is silent.
+        """
+        pcm = base64.b64decode(json.loads(frame)["audio"])
+        duration = len(pcm) / (2 * self.sample_rate)
+        self.seconds_seen += duration
+        if self.is_speech(pcm):
+            self._hangover_left = self.hangover
+            return self.flush() + [frame]
+        if self._hangover_left > 0:
+            self._hangover_left -= duration
+            return [frame]
+        self._held.append((frame, len(pcm), duration))
+        self._held_seconds += duration
+        # The tolerance keeps float drift in the running total from costing a whole frame of pre-roll
+        while self._held_seconds > self.pre_roll + 1e-6:
+            self._drop_oldest()
+        return []
+
+    def flush(self) -> list[str]:
+        """
+        Release the held pre-roll, e.g. before the client commits its input buffer.
+        """
+        frames = [frame for frame, _, _ in self._held]
+        self._held.clear()
+        self._held_seconds = 0.0
+        return frames
+
+    def _drop_oldest(self):
+        _, size, duration = self._held.popleft()
+        self._held_seconds -= duration
+        self.bytes_saved += size
+        self.seconds_saved += duration
+        _bytes_saved.inc(size)
+        _seconds_saved.inc(duration)
+
+    def clear(self):
+        """
+        Drop the held pre-roll, e.g. when the client clears its input buffer.
+        """
+        while self._held:
+            self._drop_oldest()
+
+    def close(self, session_id: str):
+        self.clear()
+        _session_seconds_saved.observe(self.seconds_saved)
+        if self.seconds_seen > 0:
+            logger.info("Session %s: held back %.1fs of %.1fs of audio as silence (%d bytes)",
+                        session_id, self.seconds_saved, self.seconds_seen, self.bytes_saved)
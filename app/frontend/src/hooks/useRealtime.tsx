@@ -1,3 +1,4 @@
+import { useCallback, useRef } from "react";
 import useWebSocket from "react-use-websocket";
 
 import {
@@ -9,6 +10,7 @@ import {
     ResponseDone,
     SessionUpdateCommand,
     ExtensionMiddleTierToolResponse,
+    ExtensionSessionResume,
     ResponseInputAudioTranscriptionCompleted
 } from "@/types";
 
@@ -51,16 +53,26 @@ export default function useRealTime({
     onReceivedInputAudioTranscriptionCompleted,
     onReceivedError
 }: Parameters) {
-    const wsEndpoint = useDirectAoaiApi
-        ? `${aoaiEndpointOverride}/openai/realtime?api-key=${aoaiApiKeyOverride}&deployment=${aoaiModelOverride}&api-version=2024-10-01-preview`
-        : `/realtime`;
+    const lastSessionUpdate = useRef<SessionUpdateCommand | null>(null);
+    // Kept for this page only, so a reload (the next customer at a kiosk) starts a new order
+    const resumeToken = useRef<string | null>(null);
+
+    // Read on every (re)connect so a dropped connection comes back to the same order
+    const getWsEndpoint = useCallback(() => {
+        if (useDirectAoaiApi) {
+            return `${aoaiEndpointOverride}/openai/realtime?api-key=${aoaiApiKeyOverride}&deployment=${aoaiModelOverride}&api-version=2024-10-01-preview`;
+        }
+        return resumeToken.current ? `/realtime?resume_token=${encodeURIComponent(resumeToken.current)}` : `/realtime`;
+    }, [useDirectAoaiApi, aoaiEndpointOverride, aoaiApiKeyOverride, aoaiModelOverride]);
 
-    const { sendJsonMessage } = useWebSocket(wsEndpoint, {
+    const { sendJsonMessage } = useWebSocket(getWsEndpoint, {
         onOpen: () => onWebSocketOpen?.(),
         onClose: () => onWebSocketClose?.(),
         onError: event => onWebSocketError?.(event),
         onMessage: event => onMessageReceived(event),
-        shouldReconnect: () => true
+        shouldReconnect: () => true,
+        // Come straight back when a restarting server worker hands the connection off, then back off
+        reconnectInterval: attempt => Math.min(250 * 2 ** attempt, 5000)
     });
 
     const startSession = () => {
@@ -82,6 +94,7 @@ export default function useRealTime({
             };
         }
 
+        lastSessionUpdate.current = command;
         sendJsonMessage(command);
     };
 
@@ -132,6 +145,15 @@ export default function useRealTime({
             case "extension.middle_tier_tool_response":
                 onReceivedExtensionMiddleTierToolResponse?.(message as ExtensionMiddleTierToolResponse);
                 break;
+            case "extension.session_resume": {
+                const { resume_token, resumed } = message as ExtensionSessionResume;
+                resumeToken.current = resume_token;
+                // The new upstream conversation only has the server's settings, restore ours
+                if (resumed && lastSessionUpdate.current) {
+                    sendJsonMessage(lastSessionUpdate.current);
+                }
+                break;
+            }
             case "error":
                 onReceivedError?.(message);
                 break;
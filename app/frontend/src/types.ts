@@ -77,6 +77,13 @@ export type ResponseDone = {
     };
 };
 
+// Sent by the middle tier when a connection opens, the token lets a reconnecting client resume its order
+export type ExtensionSessionResume = {
+    type: "extension.session_resume";
+    resume_token: string;
+    resumed: boolean;
+};
+
 // Represents a response from an extension middle tier tool
 export type ExtensionMiddleTierToolResponse = {
     type: "extension.middle_tier_tool.response";